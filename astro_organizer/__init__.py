@@ -4,12 +4,17 @@ import filters
 import string_conversions
 import tour
 import utils
+import visibility
+import session
+import query
 import qt_interface
 
 Body = body.Body
 MasterDatabase = catalogs.MasterDatabase
 MultiFilter = filters.MultiFilter
+ObservingSession = session.ObservingSession
 Tour = tour.Tour
+VisibilityCalendar = visibility.VisibilityCalendar
 
 create_date = utils.create_date
 sunrise = utils.sunrise
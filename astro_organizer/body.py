@@ -1,11 +1,38 @@
 from string_conversions import sac_to_ephem_dict, ngc_to_string
 #from catalogs import _NotesTable
 import ephem
+import math
+import uuid
 import tables
+import numpy as np
+
+import storage
+import ephemerides
 
 class _NotesTable(tables.IsDescription):
     additional_notes = tables.StringCol(512)
 
+def table_generation(table):
+    """Returns the generation of a table, a counter increased every time the
+    table is modified (see touch_table)."""
+    return getattr(table._v_attrs, "generation", 0)
+
+def touch_table(table):
+    """Marks a table as modified, invalidating what has been computed from
+    it (e.g. the query cache of catalogs.MasterDatabase)."""
+    table._v_attrs.generation = table_generation(table) + 1
+
+def table_token(table):
+    """Returns the token given to a table when it was created (see 
+    stamp_table), None for the tables created by older versions. Unlike the
+    generation, it changes when a table is removed and created again with 
+    the same name."""
+    return getattr(table._v_attrs, "token", None)
+
+def stamp_table(table):
+    """Gives a new table its token, see table_token."""
+    table._v_attrs.token = uuid.uuid4().hex
+
 class Body(object):
     """This class represents a generic body as stored in the database.
     Its attributes are fetched automatically from the database fields and they
@@ -18,14 +45,50 @@ class Body(object):
     sky_safari_entry.
     
     If an attribute is changed the corresponding entry in the database is updated.
+    
+    Two bodies are equal if they are the same row of the same catalog. 
+    catalogs.MasterDatabase returns the same object for the same row, as long
+    as it is referenced.
     """
     
-    def __init__(self, row_pointer):
+    __slots__ = ("_table", "_nrow", "_master_db", "_ephem_body", "__weakref__")
+    
+    def __init__(self, row_pointer, nrow = None, master_db = None):
+        """
+        Parameters:
+        row_pointer: a tables.Row pointing to the body, or the tables.Table 
+                     containing it if nrow is given.
+        nrow: the row number of the body.
+        master_db: the catalogs.MasterDatabase the body belongs to. If given,
+                   writes go through it (see MasterDatabase.batch).
+        """
         self._ephem_body = None
-        self._row_pointer = row_pointer
-        self._table = row_pointer.table
-        self._nrow = row_pointer.nrow
-        self._db = self._table._v_file        
+        self._master_db = master_db
+        if nrow is None:
+            self._table = row_pointer.table
+            self._nrow = row_pointer.nrow
+        else:
+            self._table = row_pointer
+            self._nrow = nrow
+    
+    @property
+    def _db(self):
+        return self._table._v_file
+    
+    def __eq__(self, other):
+        if not isinstance(other, Body):
+            return NotImplemented
+        return (self._nrow == other._nrow and 
+                self._table._v_pathname == other._table._v_pathname)
+    
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        if ret is NotImplemented:
+            return ret
+        return not ret
+    
+    def __hash__(self):
+        return hash((self._table._v_pathname, self._nrow))
 
     @property
     def field_names(self):
@@ -35,17 +98,53 @@ class Body(object):
         try:
             table = object.__getattribute__(self, "_table")
             nrow = object.__getattribute__(self, "_nrow")
-            return getattr(table.cols, name)[nrow]
+            master_db = object.__getattribute__(self, "_master_db")
+        except AttributeError:
+            raise AttributeError("There is no %s value in the table" % name)
+        
+        if master_db is not None:
+            columns = master_db._columns_of(table)
+            if columns is not None:
+                try:
+                    return columns.get(name, nrow)
+                except (ValueError, KeyError):
+                    raise AttributeError("There is no %s value in the table" %
+                                         name)
+            row = master_db._prefetched(table, nrow)
+            if row is not None:
+                try:
+                    return row[name]
+                except (ValueError, KeyError, IndexError):
+                    raise AttributeError("There is no %s value in the table" %
+                                         name)
+        try:
+            with storage.hdf5_lock:
+                return getattr(table.cols, name)[nrow]
         except AttributeError:
             raise AttributeError("There is no %s value in the table" % name)
     
     def __setattr__(self, name, value):
         try:
             col  = getattr(self._table.cols, name)
-            col[self._nrow] = value
-            self._table.flush()
         except AttributeError:
             object.__setattr__(self, name, value)                
+            return
+        
+        if self._master_db is not None:
+            self._master_db._set_cell(self._table, name, self._nrow, value)
+        else:
+            with storage.hdf5_lock:
+                col[self._nrow] = value
+                touch_table(self._table)
+                self._table.flush()
+        self._ephem_body = None
+    
+    def _writing(self):
+        """The context manager to hold while writing (see 
+        catalogs.MasterDatabase.writing)."""
+        if self._master_db is None:
+            return storage.hdf5_lock
+        return self._master_db.writing()
     
     def __repr__(self):        
         if self.additional_names != "":
@@ -53,71 +152,135 @@ class Body(object):
         else:
             return self.name
         
-    def ephem_string(self):
+    @property
+    def ephemeris(self):
+        """The ephemerides.Ephemeris of the catalog if the body moves (the 
+        planets, the Moon, comets), None otherwise."""
+        if self._master_db is not None:
+            return self._master_db.get_ephemeris(self._table.name)
+        with storage.hdf5_lock:
+            return ephemerides.load(self._table)
+    
+    def position(self, date = None):
+        """Returns the J2000 position (ra, dec) of the body, in radians. Only
+        the position of a moving body depends on the date (an ephem.Date, now
+        if None)."""
+        ephemeris = self.ephemeris
+        if ephemeris is None:
+            return self.ra, self.dec
+        if date is None:
+            date = ephem.now()
+        ra, dec = ephemeris.positions(float(date), [self._nrow])
+        if np.isnan(ra[0, 0]):
+            raise ValueError("%s is not covered by %s" % (ephem.Date(date),
+                                                          ephemeris))
+        return ra[0, 0], dec[0, 0]
+    
+    def ephem_string(self, date = None):
+        """Returns the xephem database line of the body. A moving body is 
+        described as a fixed one at its position at date (see position)."""
         string = []
         string.append(self.name)
         try:
             string.append("f|" + sac_to_ephem_dict[self.body_type])
         except KeyError:
             string.append("f|T")
-        string.append(str(ephem.hours(self.ra)))
-        string.append(str(ephem.degrees(self.dec)))
-        string.append(str(self.mag))
+        ephemeris = self.ephemeris
+        if ephemeris is None:
+            ra, dec, mag = self.ra, self.dec, self.mag
+        else:
+            ra, dec = self.position(date)
+            if date is None:
+                date = ephem.now()
+            mag = ephemeris.magnitudes(float(date), [self._nrow])[0, 0]
+        string.append(str(ephem.hours(ra)))
+        string.append(str(ephem.degrees(dec)))
+        string.append(str(mag))
         string.append("2000")
         
-        max_s = self.size_max
-        if len(max_s) == 0:
-            fp = 0
-        elif max_s[-1] == 'm': #arcmin
-            fp = float(max_s[:-1]) / 3437.74677078
-        elif max_s[-1] == 's': #arcsec
-            fp = float(max_s[:-1]) / 206264.806247
-        elif max_s[-1] == 'd': #degree
-            fp = float(max_s[:-1]) / 57.2957795131 
-        else:
-            raise ValueError("Unkwnown format for size_max: " + max_s)
-        string.append(str(fp * 206264.806247))
+        size = self.size_max_arcsec
+        if math.isnan(size):
+            size = 0
+        string.append(str(size))
         
         return ','.join(string)
     
     @property
     def ephem_body(self):
+        """An ephem.FixedBody for the body. For a moving body it is at its 
+        current position, see ephem_body_at."""
+        if self.ephemeris is not None:
+            return self.ephem_body_at(ephem.now())
         if self._ephem_body is None:
             self._ephem_body = ephem.readdb(self.ephem_string())
         return self._ephem_body
+    
+    def ephem_body_at(self, date):
+        """An ephem.FixedBody at the position of the body at date."""
+        if self.ephemeris is None:
+            return self.ephem_body
+        return ephem.readdb(self.ephem_string(date))
 
     def __get_additional_notes(self):
-        try:
-            node = self._db.getNode("/notes", self.name)
-        except tables.NoSuchNodeError:
-            return []
-        return [r["additional_notes"] for r in node.iterrows()]
+        name = self.name
+        db = self._db
+        with storage.hdf5_lock:
+            try:
+                node = db.getNode("/notes", name)
+            except tables.NoSuchNodeError:
+                return []
+            return [r["additional_notes"] for r in node.iterrows()]
 
     def __set_additional_notes(self, value):
         if len(value) > 512:
             raise ValueError("Input length is %d, maximum is 512" % len(value))
-        
+        with self._writing():
+            self.__append_note(value)
+    
+    def __append_note(self, value):
         try:
             node = self._db.getNode("/notes", self.name)
         except tables.NoSuchNodeError:
-            node = self._db.createTable("/notes", self.name, _NotesTable)
+            if self._master_db is not None:
+                options = self._master_db.storage.table_options("notes")
+            else:
+                options = {}
+            node = self._db.createTable("/notes", self.name, _NotesTable,
+                                        **options)
+            if self._master_db is not None:
+                self._master_db._created(node)
         
+        if self._master_db is not None:
+            self._master_db._appending(node)
         row = node.row
         row["additional_notes"] = value
         row.append()
-        node.flush()        
+        #tells the text indexes that the notes changed
+        touch_table(node._v_parent)
+        if self._master_db is not None:
+            self._master_db._written(node)
+        else:
+            node.flush()        
     
     def __delete_additional_notes(self):
-        try:
-            node = self._db.getNode("/notes", self.name)
-        except tables.NoSuchNodeError:        
-            return #silently ignore
-        
-        try:
-            node.removeRows(-1)
-        except NotImplementedError:
-            #weird pytables thing
-            self._db.removeNode("/notes", self.name)
+        with self._writing():
+            try:
+                node = self._db.getNode("/notes", self.name)
+            except tables.NoSuchNodeError:        
+                return #silently ignore
+            if node.nrows == 0:
+                return
+            
+            #the last note goes, the table is kept even if empty
+            if self._master_db is not None:
+                self._master_db._removing(node)
+            node.truncate(node.nrows - 1)
+            #tells the text indexes that the notes changed
+            touch_table(node._v_parent)
+            if self._master_db is not None:
+                self._master_db._written(node)
+            else:
+                node.flush()
         
     additional_notes = property(__get_additional_notes,
                                 __set_additional_notes,
@@ -143,12 +306,19 @@ class Body(object):
         #object id
         if self.body_type in ["STAR"]:
             object_id = 2
+        elif self.ephemeris is not None:
+            #solar system objects are found by name
+            object_id = 1
         else:
             object_id = 4
         lines.append("\tObjectID=%d,-1,-1" % object_id)
-        if use_additional_names:
+        if object_id == 1:
+            lines.append("\tCommonName=%s" % self.name)
+        elif use_additional_names:
             lines.append("\tCommonName=%s" % self.additional_names)
-        lines.append("\tCatalogNumber=%s" % strip_unwanted_spaces(self.name))
+        if object_id != 1:
+            lines.append("\tCatalogNumber=%s" % 
+                         strip_unwanted_spaces(self.name))
         if use_additional_names:
             lines.append("\tCatalogNumber=%s" % strip_unwanted_spaces(self.additional_names))
         
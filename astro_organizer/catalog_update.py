@@ -0,0 +1,209 @@
+import time
+import logging
+import collections
+import numpy as np
+
+import body
+import utils
+import storage
+import importers
+import text_index
+
+#values of the rows of the objects removed by an update: no name (see
+#catalogs.MasterDatabase.deleted_rows), no position and the SAC missing
+#magnitude, so that no query or calendar selects them
+_DELETED_NAN_COLUMNS = ("ra", "dec", "size_max_arcsec", "size_min_arcsec",
+                        "surface_brightness_mag")
+_MISSING_MAG = 99.9
+
+class UpdateReport(object):
+    """The outcome of update_catalog_from_sac.
+
+    Attributes:
+    catalog: the name of the catalog
+    inserted: the row numbers of the objects added
+    updated: the row numbers of the objects whose values changed
+    deleted: the row numbers of the objects removed
+    unchanged: how many objects are the same
+    seconds: how long the update took
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.inserted = np.zeros(0, np.int64)
+        self.updated = np.zeros(0, np.int64)
+        self.deleted = np.zeros(0, np.int64)
+        self.unchanged = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return ("UpdateReport: %s, %d inserted, %d updated, %d deleted, "
+                "%d unchanged" % (self.catalog, len(self.inserted),
+                                  len(self.updated), len(self.deleted),
+                                  self.unchanged))
+
+    @property
+    def changed(self):
+        """The row numbers of all the rows written, sorted."""
+        return np.union1d(np.union1d(self.inserted, self.updated),
+                          self.deleted)
+
+def _deleted_rows(dtype, count):
+    rows = np.zeros(count, dtype=dtype)
+    for c in _DELETED_NAN_COLUMNS:
+        rows[c] = np.nan
+    rows["mag"] = _MISSING_MAG
+    rows["central_star_mag"] = _MISSING_MAG
+    return rows
+
+def _same_rows(old, new):
+    """Returns a boolean array, True where two structured arrays have the
+    same values (NaN equals NaN)."""
+    same = np.ones(len(old), bool)
+    for c in old.dtype.names:
+        a, b = old[c], new[c]
+        equal = a == b
+        if a.dtype.kind == "f":
+            equal |= np.isnan(a) & np.isnan(b)
+        same &= equal
+    return same
+
+def _current_text_index(master_db, name):
+    """Returns the text_index.TextIndex of a catalog, in memory or stored, if
+    it is up to date, None otherwise: it is then built when needed (see 
+    catalogs.MasterDatabase.get_text_index)."""
+    index = master_db._text_indexes.get(name)
+    if index is None:
+        with storage.hdf5_lock:
+            index = text_index.load(master_db.db, name)
+    if index is None or index.signature != text_index.signature(master_db,
+                                                                name):
+        return None
+    return index
+
+def update_catalog_from_sac(master_db, name, sac_file_obj, batch_rows = 1024):
+    """Brings a catalog up to date with a Saguaro Astronomical Catalog csv
+    file, e.g. a new release, writing only what changed.
+
+    The file is read in blocks of batch_rows rows and its objects are matched
+    with the rows of the catalog by normalized name (see
+    importers.normalize_designation), objects with the same name in the
+    order they appear. Then:
+    - the rows that changed are rewritten in place, the others are not
+      touched. Each row stays where it is, so the tours, the notes, the
+      query cache entries and the calendars of the other rows stay valid.
+    - the objects no longer in the file are deleted: their rows are emptied
+      and left in place (see catalogs.MasterDatabase.deleted_rows)
+    - the new objects take the rows of the deleted ones first, then are
+      appended.
+    Everything is written in a single batch (see
+    catalogs.MasterDatabase.batch). The index of designations kept by
+    importers.get_index and the text index of the catalog (see
+    catalogs.MasterDatabase.get_text_index) are updated rather than built
+    again. The visibility
+    calendars are updated by the caller, see
+    catalogs.MasterDatabase.load_sac.
+
+    Parameters:
+    master_db: a catalogs.MasterDatabase instance
+    name: the name of the catalog
+    sac_file_obj: either a file or a string with its name
+    batch_rows: how many rows of the file are compared at once
+
+    Returns:
+    an UpdateReport
+    """
+    start = time.time()
+    table = master_db.get_catalog(name)
+    report = UpdateReport(name)
+    index = importers.current_index(master_db)
+    text = _current_text_index(master_db, name)
+    if text is not None:
+        #patched by the writes from now on, see 
+        #catalogs.MasterDatabase._patch_text_index
+        if text.notes is None:
+            text.notes = text_index.build_notes(master_db, name)
+        master_db._text_indexes[name] = text
+
+    #the rows of each name, in order
+    rows_of = collections.defaultdict(collections.deque)
+    for block in master_db.iter_chunks(name, ["name"]):
+        for nrow, key in zip(block.nrows,
+                             importers.normalize_column(block["name"])):
+            if key != "":
+                rows_of[key].append(nrow)
+    free = list(master_db.deleted_rows(name))
+    nrows_before = table.nrows
+
+    #the (row numbers, rows before, rows after) written, for the index
+    changes = []
+    updated = []
+    new_rows = []
+    with master_db.batch():
+        for rows in utils.read_sac_rows(sac_file_obj, table.dtype,
+                                        batch_rows):
+            keys = importers.normalize_column(rows["name"])
+            nrows = np.array([rows_of[k].popleft() if rows_of.get(k) else -1
+                              for k in keys], np.int64)
+            found = nrows >= 0
+            if not found.all():
+                new_rows.append(rows[~found])
+            nrows, rows = nrows[found], rows[found]
+            if len(nrows) == 0:
+                continue
+            old = table.readCoordinates(nrows)
+            changed = ~_same_rows(old, rows)
+            report.unchanged += len(nrows) - int(changed.sum())
+            if changed.any():
+                master_db._set_rows(table, nrows[changed], rows[changed])
+                changes.append((nrows[changed], old[changed], rows[changed]))
+                updated.append(nrows[changed])
+        if len(updated) != 0:
+            report.updated = np.concatenate(updated)
+
+        deleted = sorted(n for q in rows_of.itervalues() for n in q)
+        if len(deleted) != 0:
+            report.deleted = np.array(deleted, np.int64)
+            old = table.readCoordinates(report.deleted)
+            blank = _deleted_rows(table.dtype, len(deleted))
+            master_db._set_rows(table, report.deleted, blank)
+            changes.append((report.deleted, old, blank))
+            free = sorted(free + deleted)
+
+        if len(new_rows) != 0:
+            new_rows = np.concatenate(new_rows)
+            reused = np.array(free[:len(new_rows)], np.int64)
+            free = free[len(reused):]
+            if len(reused) != 0:
+                old = table.readCoordinates(reused)
+                master_db._set_rows(table, reused, new_rows[:len(reused)])
+                changes.append((reused, old, new_rows[:len(reused)]))
+            appended = new_rows[len(reused):]
+            nrows = np.arange(nrows_before, nrows_before + len(appended))
+            if len(appended) != 0:
+                text = master_db._text_index_of(table)
+                master_db._appending(table)
+                table.append(appended)
+                master_db._columns.pop(name, None)
+                master_db._written(table)
+                if text is not None:
+                    master_db._patch_text_index(text, nrows, None, appended)
+                changes.append((nrows, None, appended))
+            report.inserted = np.concatenate([reused, nrows])
+
+    generation = body.table_generation(table)
+    master_db._tombstones[name] = (generation, np.array(free, np.int64))
+    master_db.invalidate_query_cache(name)
+    if index is not None:
+        for nrows, old, new in changes:
+            index.replace(name, nrows, old, new)
+        index.signature = importers._signature(master_db, None)
+    text = master_db._text_index_of(table)
+    if text is not None and not master_db.read_only:
+        with master_db.writing():
+            text.save(master_db.db, master_db.storage.filters)
+        master_db._text_unsaved.discard(name)
+
+    report.seconds = time.time() - start
+    logging.info("%s", report)
+    return report
@@ -1,10 +1,31 @@
 import ephem
 import tables
 import logging
+import collections
+import contextlib
+import os
+import weakref
+import time
+import itertools
+import threading
+import numpy as np
 
 import tour
 import utils
 import body
+import visibility
+import filters
+import columnar
+import storage
+import ephemerides
+import scoring
+import session
+import importers
+import catalog_update
+import text_index
+import query
+import horizon
+import tracker
 
 class _TableBody(tables.IsDescription):
     name = tables.StringCol(20)
@@ -25,6 +46,11 @@ class _TableBody(tables.IsDescription):
     catalog = tables.StringCol(4)
     ngc_descr = tables.StringCol(55)
     notes = tables.StringCol(86)
+    
+    #numeric versions of the columns above, NaN when missing
+    size_max_arcsec = tables.Float64Col(dflt=np.nan)
+    size_min_arcsec = tables.Float64Col(dflt=np.nan)
+    surface_brightness_mag = tables.Float64Col(dflt=np.nan)
         
 
 class _Location(tables.IsDescription):
@@ -35,29 +61,217 @@ class _Location(tables.IsDescription):
     bortle_class = tables.Int8Col()
 
 
+class _HorizonPoint(tables.IsDescription):
+    location = tables.StringCol(128)
+    azimuth = tables.Float64Col()
+    altitude = tables.Float64Col()
+
+
 class MasterDatabase(object):
     """This is a class that keeps track of all the info in the organizer. The
-    data is stored in a h5 file"""
+    data is stored in a h5 file.
+    
+    A database is thread-safe: it can be used by several threads, but the
+    calls to the HDF5 library are serialized by storage.hdf5_lock, so the 
+    reads from the file are not faster with more threads. Only the catalogs
+    in memory (see in_memory) are read without holding the lock. The writes
+    go one thread at a time (see writing). Tours must not be shared among 
+    threads.
+    """
     
-    def __init__(self, database):
+    def __init__(self, database, query_cache_size = 128, in_memory = False,
+                 cache_dir = None, profile = None, migrate = False):
+        """
+        Parameters:
+        database: either the file name of the database or an open tables.File.
+                  A file opened read-only is used as it is: the database must
+                  have been migrated already (see read_only and migrate).
+        query_cache_size: how many results of filter_catalog are cached (see
+                          filter_catalog).
+        in_memory: if True each catalog is read once in memory and queries, 
+                   name lookups and body.Body reads are served from there. 
+                   Writes go both to memory and to the database. See 
+                   memory_usage.
+        cache_dir: only with in_memory, a directory where to keep uncompressed
+                   copies of the catalogs, memory-mapped instead of read.
+        profile: the name of the storage.StorageProfile used for new tables.
+                 If None, the profile the database was created with is used
+                 (archival for older databases). See storage.repack to change 
+                 the profile of the existing tables.
+        migrate: if True, a database created by an older version is upgraded
+                 (see migrate). If False, ValueError is raised for such a 
+                 database, which is left untouched.
+        """
+        self.in_memory = in_memory
+        self.cache_dir = cache_dir
+        self._columns = {}
+        self._bodies = weakref.WeakValueDictionary()
+        self._ephemerides = {}
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._write_serial = 0
+        self._query_lock = threading.Lock()
+        self._tombstones = {}
+        self._text_indexes = {}
+        self._text_unsaved = set()
+        
         if type(database) is str:
             if not database.endswith(".h5"):
                 database += ".h5"
-            filters = tables.Filters(complevel=9)
+            if profile is None and os.path.exists(database):
+                existing = tables.openFile(database, "r")
+                profile = getattr(existing.root._v_attrs, "storage_profile", 
+                                  None)
+                existing.close()
+            self.storage = storage.get_profile(profile or 
+                                               storage.DEFAULT_PROFILE)
             self.db = tables.openFile(database, "a", 
                                       title="AstroOrganizer Database",
-                                      filters=filters)
+                                      filters=self.storage.filters)
         
         elif type(database) is tables.File:
             self.db = database
+            if profile is None:
+                profile = getattr(database.root._v_attrs, "storage_profile", 
+                                  None)
+            self.storage = storage.get_profile(profile or 
+                                               storage.DEFAULT_PROFILE)
         
         else:
             raise ValueError("Wrong type for database: %s" % type(database))
         
-        self.populate_groups()
+        self._batch_depth = 0
+        self.__reset_batch()
+        
+        if self.needs_migration:
+            if self.read_only or not migrate:
+                filename = self.db.filename
+                if type(database) is str:
+                    self.db.close()
+                #an open tables.File is left to the caller
+                del self.db
+                raise ValueError("%s was created by an older version: open it "
+                                 "for writing with migrate=True to upgrade it"
+                                 % filename)
+            self.migrate()
+        if not self.read_only:
+            if "storage_profile" not in self.db.root._v_attrs:
+                self.db.root._v_attrs.storage_profile = self.storage.name
+            self.populate_groups()
+        
+        self.query_cache_size = query_cache_size
+        self._query_cache = collections.OrderedDict()
+        self.load_query_cache()
+        
+        if in_memory:
+            for table in self.db.root.catalogs:
+                self._columns_of(table)
 
     def __del__(self):
-        self.db.close()
+        #__init__ might have failed before opening the database, and 
+        #__getattr__ would look for a body named db. At exit the modules may
+        #be torn down already (storage.hdf5_lock is None): PyTables closes
+        #the files left open itself.
+        if "db" in self.__dict__ and getattr(storage, "hdf5_lock", None):
+            self.close()
+    
+    def close(self):
+        """Closes the database. The text indexes patched by the writes (see
+        _patch_text_index) are stored first."""
+        with storage.hdf5_lock:
+            if self.db.isopen:
+                self.__save_text_indexes()
+                self.db.close()
+    
+    def __save_text_indexes(self):
+        unsaved, self._text_unsaved = self._text_unsaved, set()
+        if self.read_only:
+            return
+        for catalog in unsaved:
+            index = self._text_indexes.get(catalog)
+            try:
+                current = text_index.signature(self, catalog)
+            except tables.NoSuchNodeError:
+                #the catalog has been removed
+                continue
+            if index is not None and index.signature == current:
+                index.save(self.db, self.storage.filters)
+    
+    @contextlib.contextmanager
+    def _prefetching(self, table, nrows, rows):
+        """Within the block, the body.Body reads of some rows of a table in
+        the current thread are served from a copy of the rows read at once,
+        rather than one cell at a time from the file.
+        
+        Parameters:
+        table: a catalog table
+        nrows: the row numbers, sorted
+        rows: the rows, a structured array
+        """
+        self._local.prefetched = (table, nrows, rows)
+        try:
+            yield
+        finally:
+            self._local.prefetched = None
+    
+    def _prefetched(self, table, nrow):
+        """Returns the row of a table prefetched in the current thread (see 
+        _prefetching), None if it wasn't."""
+        prefetched = getattr(self._local, "prefetched", None)
+        if prefetched is None or prefetched[0] is not table:
+            return None
+        nrows = prefetched[1]
+        i = np.searchsorted(nrows, nrow)
+        if i == len(nrows) or nrows[i] != nrow:
+            return None
+        return prefetched[2][i]
+    
+    @contextlib.contextmanager
+    def writing(self):
+        """A context manager to hold while writing to the database: only one 
+        thread at a time can write, and no other thread can use the HDF5 
+        library meanwhile. The read handles of the other threads are reopened
+        afterwards."""
+        with self._write_lock:
+            with storage.hdf5_lock:
+                try:
+                    yield self
+                finally:
+                    self._write_serial += 1
+    
+    @property
+    def read_only(self):
+        """True if the database file is opened read-only. The groups are not
+        created and the database can't be migrated (see migrate)."""
+        return self.db.mode == "r"
+    
+    @property
+    def needs_migration(self):
+        """True if some catalogs or tours were created by an older version
+        (see migrate)."""
+        with storage.hdf5_lock:
+            if "/catalogs" in self.db:
+                for table in self.db.root.catalogs:
+                    if "size_max_arcsec" not in table.colnames:
+                        return True
+            if "/tours" in self.db:
+                for table in self.db.root.tours:
+                    if "nrow" not in table.colnames:
+                        return True
+        return False
+    
+    def migrate(self):
+        """Upgrades the catalogs and the tours created by an older version 
+        (see upgrade_catalogs and migrate_tours). It is done only when asked
+        for, see the migrate parameter of the constructor."""
+        if self.read_only:
+            raise ValueError("Can't migrate %s, it is read-only" % 
+                             self.db.filename)
+        logging.info("Migrating %s", self.db.filename)
+        with self.writing():
+            self.populate_groups()
+            self.upgrade_catalogs()
+            self.migrate_tours()
     
     def populate_groups(self):
         """Create the groups usually stored in the database, if those are not
@@ -66,20 +280,93 @@ class MasterDatabase(object):
         if "/catalogs" not in self.db:
             self.db.createGroup("/", "catalogs")
         if "/locations" not in self.db:
-            self.db.createTable("/", "locations", _Location)        
+            self.db.createTable("/", "locations", _Location,
+                                **self.storage.table_options("locations"))
+        if "/horizons" not in self.db:
+            self.db.createTable("/", "horizons", _HorizonPoint,
+                                **self.storage.table_options("locations"))
         if "/notes" not in self.db:
             self.db.createGroup("/", "notes")                
         if "/tours" not in self.db:
             self.db.createGroup("/", "tours")            
+        if "/visibility" not in self.db:
+            self.db.createGroup("/", "visibility")
         
         self.db.flush()
         
-    def load_sac(self, catalog_name, sac_file_obj):
+    def upgrade_catalogs(self):
+        """Adds the numeric size and surface brightness columns to the 
+        catalogs created before they were introduced (see 
+        utils.upgrade_catalog), see migrate."""
+        with self.writing():
+            for table in list(self.db.root.catalogs):
+                if "size_max_arcsec" not in table.colnames:
+                    utils.upgrade_catalog(self, table)
+        
+    def load_sac(self, catalog_name, sac_file_obj, update = False, 
+                 batch_rows = 1024):
         """Loads a xephem edb database specified in edb_file_obj and stores it
         into catalog_name.
+        
+        Parameters:
+        catalog_name: the name of the catalog
+        sac_file_obj: either a file or a string, see 
+                      utils.create_catalog_from_sac
+        update: if True and the catalog exists, it is brought up to date with
+                the file (e.g. a new release of SAC) instead, touching only 
+                the rows that changed, so that the tours and the notes keep
+                pointing to the same objects. See 
+                catalog_update.update_catalog_from_sac.
+        batch_rows: with update, how many rows of the file are compared at
+                    once
+        
+        Returns:
+        None, or a catalog_update.UpdateReport with update
         """
-        utils.create_catalog_from_sac(catalog_name, self, sac_file_obj)    
+        if update and catalog_name in self.list_catalogs():
+            report = catalog_update.update_catalog_from_sac(self, catalog_name,
+                                                            sac_file_obj,
+                                                            batch_rows)
+            with self.writing():
+                self.update_visibility_calendars({catalog_name: 
+                                                  report.changed})
+            return report
+        with self.writing():
+            utils.create_catalog_from_sac(catalog_name, self, sac_file_obj)    
+            self._columns.pop(catalog_name, None)
+            self.invalidate_query_cache(catalog_name)
+            self.update_visibility_calendars()
+        
+    def build_ephemerides(self, start, end, catalog = "solar_system", 
+                          segment = 1.0, degree = 10, comets = ()):
+        """Creates (or replaces) a catalog of moving bodies: the planets, the
+        Moon and optionally comets, with their positions precomputed between
+        start and end. See ephemerides.build for the parameters.
         
+        Returns:
+        the ephemerides.Ephemeris of the catalog
+        """
+        with self.writing():
+            ephemeris = ephemerides.build(self, start, end, catalog, segment,
+                                          degree, comets)
+            self._ephemerides[catalog] = ephemeris
+            self._columns.pop(catalog, None)
+            self.invalidate_query_cache(catalog)
+            self.update_visibility_calendars()
+        return ephemeris
+    
+    def get_ephemeris(self, catalog):
+        """Returns the ephemerides.Ephemeris of a catalog of moving bodies, 
+        None if the catalog has fixed objects."""
+        try:
+            return self._ephemerides[catalog]
+        except KeyError:
+            pass
+        with storage.hdf5_lock:
+            ephemeris = ephemerides.load(self.get_catalog(catalog))
+        self._ephemerides[catalog] = ephemeris
+        return ephemeris
+    
     def add_location(self, name, latitude, longitude, height, 
                      bortle_class = 7):
         """Adds a location to the database.
@@ -91,21 +378,305 @@ class MasterDatabase(object):
         height = height in meters
         """
         
-        loc_table = self.db.root.locations
-        row = loc_table.row
-        row["name"] = name
-        row["latitude"] = latitude
-        row["longitude"] = longitude
-        row["height"] = height
-        row["bortle_class"] = bortle_class
-        row.append()
-        loc_table.flush()
+        with self.writing():
+            loc_table = self.db.root.locations
+            self._appending(loc_table)
+            row = loc_table.row
+            row["name"] = name
+            row["latitude"] = latitude
+            row["longitude"] = longitude
+            row["height"] = height
+            row["bortle_class"] = bortle_class
+            row.append()
+            self._written(loc_table)
+            if self.in_batch:
+                self._batch_locations_changed = True
+            else:
+                self.update_visibility_calendars()
+    
+    def set_horizon(self, location, points):
+        """Stores the local horizon of a location (trees, buildings...), 
+        replacing the previous one. The sessions of the location use it (see
+        create_session).
+        
+        Parameters:
+        location: a string describing the location
+        points: (azimuth, altitude) pairs in degrees, see 
+                horizon.HorizonProfile. None or an empty list removes the
+                horizon of the location.
+        """
+        name = self.__find_location(location)["name"]
+        profile = None
+        if points:
+            profile = horizon.HorizonProfile(points)
+        with self.writing():
+            horizons = self.db.root.horizons
+            for n in reversed(horizons.getWhereList("location == %r" % name)):
+                horizons.removeRows(n, n + 1)
+            if profile is not None:
+                rows = np.zeros(len(profile.points), horizons.dtype)
+                rows["location"] = name
+                rows["azimuth"] = [p[0] for p in profile.points]
+                rows["altitude"] = [p[1] for p in profile.points]
+                horizons.append(rows)
+            self._written(horizons)
+        return profile
+    
+    def get_horizon(self, location):
+        """Returns the horizon.HorizonProfile of a location, None if it has
+        none (see set_horizon)."""
+        name = self.__find_location(location)["name"]
+        if "/horizons" not in self.db:
+            return None
+        with storage.hdf5_lock:
+            points = [(r["azimuth"], r["altitude"]) for r in 
+                      self.db.root.horizons.where("location == %r" % name)]
+        if len(points) == 0:
+            return None
+        return horizon.HorizonProfile(points)
+    
+    @contextlib.contextmanager
+    def batch(self):
+        """A context manager that groups several writes in a single 
+        transaction: Body attribute changes, additional notes, add_location and
+        tours appends are buffered and flushed only once at the end of the 
+        block. If an exception is raised inside the block, all the writes are 
+        rolled back and the exception is propagated. Batches can be nested,
+        only the outermost one commits. The other threads can't use the 
+        database during a batch (see writing).
+        
+        Example:
+        with db.batch():
+            for b in bodies:
+                b.notes = "seen"
+        """
+        with self.writing():
+            self._batch_depth += 1
+            try:
+                yield self
+            except:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.__rollback()
+                raise
+            else:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.__commit()
+    
+    @property
+    def in_batch(self):
+        """True inside a batch (see batch)."""
+        return self._batch_depth > 0
+    
+    def __reset_batch(self):
+        self._batch_tables = {}
+        self._batch_lengths = {}
+        self._batch_contents = {}
+        self._batch_created = []
+        self._batch_undo = []
+        self._batch_tours = set()
+        self._batch_locations_changed = False
+    
+    def __batch_catalogs(self):
+        """The names of the catalogs written or appended to in the batch."""
+        touched = self._batch_tables.values() + [
+            t for t, _ in self._batch_lengths.itervalues()]
+        return set(t.name for t in touched 
+                   if t._v_parent._v_pathname == "/catalogs")
+    
+    def __commit(self):
+        for table in self._batch_tables.itervalues():
+            table.flush()
+        for catalog in self.__batch_catalogs():
+            self.invalidate_query_cache(catalog)
+        locations_changed = self._batch_locations_changed
+        self.__reset_batch()
+        if locations_changed:
+            self.update_visibility_calendars()
+    
+    def __rollback(self):
+        logging.info("Rolling back %d writes", len(self._batch_undo))
+        for table, colname, nrow, value in reversed(self._batch_undo):
+            columns = self._columns_of(table)
+            if colname is None:
+                #whole rows, see _set_rows
+                table.modifyCoordinates(nrow, value)
+                if columns is not None:
+                    columns.set_rows(nrow, value)
+                continue
+            getattr(table.cols, colname)[nrow] = value
+            if columns is not None:
+                columns.set(colname, nrow, value)
+        for table, nrows in self._batch_lengths.itervalues():
+            table.flush()
+            if table.nrows > nrows:
+                table.truncate(nrows)
+                self._columns.pop(table.name, None)
+        for table, rows in self._batch_contents.itervalues():
+            #rows removed in the batch, see _removing
+            table.truncate(0)
+            if len(rows) != 0:
+                table.append(rows)
+            table.flush()
+            self._columns.pop(table.name, None)
+        for table in self._batch_tables.itervalues():
+            body.touch_table(table)
+            table.flush()
+        for table, _ in (self._batch_lengths.values() + 
+                         self._batch_contents.values()):
+            body.touch_table(table)
+            if table._v_parent._v_pathname == "/notes":
+                #tells the text indexes that the notes changed
+                body.touch_table(table._v_parent)
+        for catalog in self.__batch_catalogs():
+            self.invalidate_query_cache(catalog)
+        for node in reversed(self._batch_created):
+            node._f_remove()
+        tours = self._batch_tours
+        self.__reset_batch()
+        for t in tours:
+            #tours created in the batch have just been removed
+            if t._table._v_isopen:
+                t._reload()
+    
+    def _set_cell(self, table, colname, nrow, value):
+        """Writes a single value, recording it in the current batch, if any."""
+        with self.writing():
+            col = getattr(table.cols, colname)
+            if self.in_batch:
+                self._batch_undo.append((table, colname, nrow, col[nrow]))
+            index = self._text_index_of(table)
+            old_rows = new_rows = None
+            if index is not None and colname in text_index.COLUMNS:
+                old_rows = table.readCoordinates([nrow])
+            col[nrow] = value
+            if old_rows is not None:
+                new_rows = table.readCoordinates([nrow])
+            columns = self._columns_of(table)
+            if columns is not None:
+                columns.set(colname, nrow, value)
+            self._written(table)
+            if index is not None:
+                self._patch_text_index(index, [nrow], old_rows, new_rows)
+    
+    def _set_rows(self, table, nrows, rows):
+        """Replaces whole rows of a catalog, recording them in the current 
+        batch, if any.
+        
+        Parameters:
+        table: the catalog table
+        nrows: an array of row numbers
+        rows: a structured array with the new rows
+        """
+        with self.writing():
+            index = self._text_index_of(table)
+            if self.in_batch or index is not None:
+                old_rows = table.readCoordinates(nrows)
+            if self.in_batch:
+                self._batch_undo.append((table, None, nrows, old_rows))
+            table.modifyCoordinates(nrows, rows)
+            columns = self._columns_of(table)
+            if columns is not None:
+                columns.set_rows(nrows, rows)
+            for n in nrows:
+                b = self._bodies.get((table.name, int(n)))
+                if b is not None:
+                    b._ephem_body = None
+            self._written(table)
+            if index is not None:
+                self._patch_text_index(index, nrows, old_rows, rows)
+    
+    def _text_index_of(self, table):
+        """Returns the text index of a catalog in memory (see 
+        get_text_index) if it is up to date, so that it can be patched after
+        a write with _patch_text_index, None otherwise."""
+        if table._v_parent._v_pathname != "/catalogs":
+            return None
+        index = self._text_indexes.get(table.name)
+        if (index is None or 
+            index.signature != text_index.signature(self, table.name)):
+            return None
+        return index
+    
+    def _patch_text_index(self, index, nrows, old_rows, new_rows):
+        """Brings a text index returned by _text_index_of before a write up
+        to date, instead of building it again: only the rows written are
+        indexed again, and only if their text changed.
+        
+        Parameters:
+        index: the text_index.TextIndex
+        nrows: the row numbers written
+        old_rows: the rows before (see text_index.TextIndex.replace), None 
+                  if they have just been appended
+        new_rows: the rows after, None if none of text_index.COLUMNS was 
+                  written
+        """
+        if new_rows is not None:
+            index.replace(nrows, old_rows, new_rows)
+        signature = text_index.signature(self, index.catalog)
+        notes = index.notes
+        if notes is not None and notes.signature[:-1] == index.signature:
+            notes.signature = signature + notes.signature[-1:]
+        index.signature = signature
+        #stored when the database is closed, or by the next writer
+        self._text_unsaved.add(index.catalog)
+    
+    def _appending(self, table):
+        """To be called before appending rows to a table, so that the batch 
+        can remove them on rollback."""
+        if self.in_batch:
+            self._batch_lengths.setdefault(table._v_pathname, 
+                                           (table, table.nrows))
+    
+    def _removing(self, table):
+        """To be called before removing rows from a table, so that the batch 
+        can put them back on rollback. Only its rows before the batch are 
+        kept, the ones appended in the batch are removed anyway (see 
+        _appending)."""
+        if self.in_batch and table._v_pathname not in self._batch_contents:
+            _, nrows = self._batch_lengths.get(table._v_pathname,
+                                               (table, table.nrows))
+            self._batch_contents[table._v_pathname] = (table, 
+                                                       table.read(0, nrows))
+    
+    def _written(self, table):
+        """To be called after writing to a table: the table is flushed, or at
+        the end of the current batch. Its generation is increased at every 
+        write, within a batch too, so that what was computed from it is
+        computed again."""
+        body.touch_table(table)
+        if not self.in_batch:
+            table.flush()
+        else:
+            self._batch_tables.setdefault(table._v_pathname, table)
+    
+    def _created(self, node):
+        """To be called after creating a node, so that the batch can remove it
+        on rollback."""
+        if self.in_batch:
+            self._batch_created.append(node)
+    
+    def _tour_modified(self, tour_obj):
+        """To be called when a tour.Tour is modified, so that the batch can 
+        reload it on rollback."""
+        if self.in_batch:
+            self._batch_tours.add(tour_obj)
 
     def get_catalog(self, name):
         """
         Finds a catalog from name.
         """
-        return self.db.getNode("/catalogs", name)
+        with storage.hdf5_lock:
+            return self.db.getNode("/catalogs", name)
+    
+    def _catalog_tables(self, catalog = None):
+        """Returns the table of a catalog in a list, all the catalog tables if
+        catalog is None."""
+        with storage.hdf5_lock:
+            if catalog is None:
+                return list(self.db.root.catalogs)
+            return [self.db.getNode("/catalogs", catalog)]
     
     def list_catalogs(self):
         """
@@ -113,38 +684,188 @@ class MasterDatabase(object):
         """
         return self.db.root.catalogs._v_children.keys()
     
+    def _columns_of(self, table):
+        """Returns the columnar.CatalogColumns of a catalog when the database is
+        in memory, None otherwise."""
+        if not self.in_memory:
+            return None
+        try:
+            return self._columns[table.name]
+        except KeyError:
+            pass
+        with storage.hdf5_lock:
+            if table._v_parent._v_pathname != "/catalogs":
+                return None
+            if table.name not in self._columns:
+                self._columns[table.name] = columnar.CatalogColumns(
+                    table, self.cache_dir)
+            return self._columns[table.name]
+    
+    def memory_usage(self):
+        """Returns the memory used by the catalogs loaded in memory (see the
+        in_memory parameter of the constructor).
+        
+        Returns:
+        a dictionary catalog name -> bytes, with the sum under "total". 
+        Memory-mapped catalogs are included, even if the operating system 
+        might not keep all of them in memory.
+        """
+        ret = dict((name, c.nbytes) for name, c in self._columns.iteritems())
+        ret["total"] = sum(ret.values())
+        return ret
+    
+    def _body(self, table, nrow):
+        """Returns the body.Body of a row. The same object is returned for
+        the same row as long as it is referenced somewhere."""
+        nrow = int(nrow)
+        key = (table.name, nrow)
+        b = self._bodies.get(key)
+        if b is None or b._table is not table:
+            b = body.Body(table, nrow, self)
+            self._bodies[key] = b
+        return b
+    
+    def get_bodies(self, catalog, nrows):
+        """Returns the bodies of some rows of a catalog.
+        
+        Parameters:
+        catalog: the name of the catalog
+        nrows: an iterable over row numbers
+        """
+        table = self.get_catalog(catalog)
+        return [self._get_body(table, n) for n in nrows]
+    
+    def iter_chunks(self, catalog = None, columns = None, chunk_rows = None):
+        """Reads the catalogs in blocks of rows, for the code that processes
+        many bodies at once (exports, statistics, cross matching...) and 
+        doesn't need body.Body instances. See columnar.RecordBlock.
+        
+        Parameters:
+        catalog: the name of a catalog, or None for all of them
+        columns: the names of the columns to read, None for all of them
+        chunk_rows: how many rows each block has at most. If None, the size of
+                    the PyTables read buffer is used.
+        
+        The blocks of a catalog in memory (see the in_memory parameter of the
+        constructor) are views on it, they must not be modified.
+        
+        Returns:
+        a generator of columnar.RecordBlock
+        """
+        tables_to_read = self._catalog_tables(catalog)
+        if columns is not None:
+            columns = list(columns)
+        
+        for table in tables_to_read:
+            size = chunk_rows or table.nrowsinbuf
+            in_memory = self._columns_of(table)
+            for start in xrange(0, table.nrows, size):
+                stop = min(start + size, table.nrows)
+                if in_memory is None:
+                    with storage.hdf5_lock:
+                        data = table.read(start, stop)
+                else:
+                    data = in_memory.data[start:stop]
+                yield columnar.RecordBlock(self, table.name, start, 
+                                           columnar.select_columns(data, 
+                                                                   columns))
+    
+    def _get_body(self, table, nrow):
+        if not 0 <= nrow < table.nrows:
+            raise IndexError("Row %d out of range for %s" % (nrow, table.name))
+        return self._body(table, nrow)
+    
+    def deleted_rows(self, catalog):
+        """Returns the row numbers of the objects removed from a catalog by an
+        update (see load_sac). Their rows are kept empty, with no name, so 
+        that the other rows don't move; they are skipped by the iteration and
+        by filter_catalog, and reused by the next update that adds objects.
+        """
+        table = self.get_catalog(catalog)
+        with storage.hdf5_lock:
+            generation = body.table_generation(table)
+        cached = self._tombstones.get(catalog)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        columns = self._columns_of(table)
+        if columns is not None:
+            nrows = columns.find_exact("")
+        else:
+            with storage.hdf5_lock:
+                nrows = table.getWhereList("name == ''")
+        self._tombstones[catalog] = (generation, nrows)
+        return nrows
+    
     def __iter__(self):
-        for table in self.db.root.catalogs:
-            for row in table.iterrows():
-                yield body.Body(row)
+        for table in self._catalog_tables():
+            for b in self.__iter_table(table):
+                yield b
+    
+    def __iter_table(self, table):
+        deleted = set(self.deleted_rows(table.name))
+        return (self._body(table, n) for n in xrange(table.nrows)
+                if n not in deleted)
     
     def __len__(self):
-        return sum(len(c) for c in self.db.root.catalogs)
+        return sum(t.nrows - len(self.deleted_rows(t.name)) 
+                   for t in self._catalog_tables())
         
 
+    def __find_in_columns(self, name, table, columns):
+        """Same as __find_in_table, vectorized on the catalog in memory."""
+        ret = set(self._body(table, n) for n in columns.find_exact(name))
+        if len(ret) == 1:
+            return ret
+        
+        newname = name.replace(" ", "").lower()
+        exact = columns.find_normalized(newname, ["name", "additional_names"])
+        if len(exact) != 0:
+            #found exactly the name
+            return set([self._body(table, exact[0])])
+        partial = columns.find_substring(newname, ["name", "additional_names",
+                                                   "notes"])
+        ret.update(self._body(table, n) for n in partial)
+        return ret
+    
     def __find_in_table(self, name, table):
         assert isinstance(table, tables.Table)        
         
+        columns = self._columns_of(table)
+        if columns is not None:
+            return self.__find_in_columns(name, table, columns)
+        
+        return self.__scan_table(name, table)
+    
+    def __scan_table(self, name, table):
+        """Same as __find_in_columns, on blocks of rows read one at a time
+        (see iter_chunks), so that large catalogs are scanned in bounded 
+        memory."""
         #looking for an exact match
-        ret = set(body.Body(row) for row in table.where("name=='%s'" % name))        
+        with storage.hdf5_lock:
+            ret = set(self._body(table, n) for n in 
+                      table.getWhereList(
+                          "name=='%s'" % name))
         #only returns a set if it has exactly one match
         if len(ret) == 1:
             return ret
         
         newname = name.replace(" ", "").lower()
-        
-        for row in table.iterrows():
-            if ( (newname == row["name"].replace(" ", "").lower()) or
-                 (newname == row["additional_names"].replace(" ", "").lower())
-                 ):
+        for block in self.iter_chunks(table.name, ["name", "additional_names",
+                                                   "notes"], 
+                                      columnar.SCAN_ROWS):
+            names = columnar.normalize(block["name"])
+            additional = columnar.normalize(block["additional_names"])
+            exact = np.nonzero((names == newname) | 
+                               (additional == newname))[0]
+            if len(exact) != 0:
                 #found exactly the name
-                return set([body.Body(row)])
-            elif ((newname in row["name"].replace(" ", "").lower()) or
-                  (newname in row["additional_names"].replace(" ", "").lower()) or
-                  (newname in row["notes"].replace(" ", "").lower())
-                 ):
-                ret.add(body.Body(row))
-                
+                return set([self._body(table, block.start + exact[0])])
+            partial = ((np.char.find(names, newname) >= 0) | 
+                       (np.char.find(additional, newname) >= 0) |
+                       (np.char.find(columnar.normalize(block["notes"]), 
+                                     newname) >= 0))
+            ret.update(self._body(table, block.start + n) 
+                       for n in np.nonzero(partial)[0])
         return ret
     
     def find_body(self, name, catalog = None):
@@ -157,11 +878,7 @@ class MasterDatabase(object):
         Returns the (possibly empty) set of Bodies whose name, additional names 
         or notes match the supplied name. 
         """
-        if catalog is None:
-            catalogs_to_search = self.db.root.catalogs
-        else:
-            catalogs_to_search = [self.db.getNode("/catalogs",
-                                                  catalog)]
+        catalogs_to_search = self._catalog_tables(catalog)
         ret = set()
         for t in catalogs_to_search:
             ret.update(self.__find_in_table(name, t))
@@ -191,15 +908,18 @@ class MasterDatabase(object):
         
         #first step: search for an exact name match
         ret = set()
-        if catalog is None:
-            catalogs_to_search = self.db.root.catalogs
-        else:
-            catalogs_to_search = [self.db.getNode("/catalogs",
-                                                  catalog)]        
+        catalogs_to_search = self._catalog_tables(catalog)
         
         where_conditions = " | ".join("(name=='%s')" % s for s in names)
         for t in catalogs_to_search:
-            ret.update(body.Body(row) for row in t.where(where_conditions))
+            columns = self._columns_of(t)
+            if columns is not None:
+                ret.update(self._body(t, n) 
+                           for n in columns.find_exact_any(names))
+                continue
+            with storage.hdf5_lock:
+                ret.update(self._body(t, row.nrow) for row in 
+                           t.where(where_conditions))
         
         if len(ret) == len(names):
             return ret
@@ -208,6 +928,125 @@ class MasterDatabase(object):
             ret.update(self.find_body(name))
         return ret
         
+    def resolve_names(self, names, catalog = None):
+        """Looks for many names at once, with the same rules as find_body but
+        scanning each catalog only once for all the names.
+        
+        Parameters:
+        names: an iterable over strings
+        catalog: if not None only this catalog is searched
+        
+        Returns:
+        a dictionary name -> (possibly empty) set of body.Body instances
+        """
+        names = list(set(names))
+        ret = dict((n, set()) for n in names)
+        if len(names) == 0:
+            return ret
+        catalogs_to_search = self._catalog_tables(catalog)
+        
+        for table in catalogs_to_search:
+            if self._columns_of(table) is not None:
+                #lookups in memory are vectorized already
+                for n in names:
+                    ret[n].update(self.__find_in_table(n, table))
+                continue
+            
+            with storage.hdf5_lock:
+                self.__resolve_in_table(names, table, 
+                                        table, ret)
+        return ret
+    
+    def __resolve_in_table(self, names, table, reader, ret):
+        """resolve_names on a single catalog in the database, read from 
+        reader."""
+        exact = dict((n, set()) for n in names)
+        where_conditions = " | ".join("(name=='%s')" % n for n in names)
+        for row in reader.where(where_conditions):
+            exact[row["name"]].add(self._body(table, row.nrow))
+        
+        pending = {}
+        for n in names:
+            if len(exact[n]) == 1:
+                ret[n].update(exact[n])
+            else:
+                pending.setdefault(n.replace(" ", "").lower(), []).append(n)
+        if len(pending) == 0:
+            return
+        
+        #a single scan for all the remaining names: exact matches of the
+        #normalized names are looked up, substrings are collected apart
+        normalized_match = {}
+        partial = dict((n, set()) for n in pending)
+        for row in reader.iterrows():
+            row_names = [row["name"].replace(" ", "").lower(),
+                         row["additional_names"].replace(" ", "").lower()]
+            for rn in row_names:
+                if rn in pending and rn not in normalized_match:
+                    normalized_match[rn] = self._body(table, row.nrow)
+            row_names.append(row["notes"].replace(" ", "").lower())
+            for n in pending:
+                if n not in normalized_match and any(n in rn 
+                                                     for rn in row_names):
+                    partial[n].add(self._body(table, row.nrow))
+        
+        for n, originals in pending.iteritems():
+            for o in originals:
+                if n in normalized_match:
+                    ret[o].add(normalized_match[n])
+                else:
+                    ret[o].update(exact[o])
+                    ret[o].update(partial[n])
+        
+    def get_text_index(self, catalog):
+        """Returns the text_index.TextIndex of a catalog. It is built the 
+        first time and stored in the database, then rebuilt only when the 
+        catalog changes. The small index of the additional notes is rebuilt 
+        in memory when they change."""
+        signature = text_index.notes_signature(self, catalog)
+        index = self._text_indexes.get(catalog)
+        if index is not None and index.notes.signature == signature:
+            return index
+        
+        if index is None or index.signature != signature[:-1]:
+            with storage.hdf5_lock:
+                index = text_index.load(self.db, catalog)
+            if index is None or index.signature != signature[:-1]:
+                index = text_index.build(self, catalog)
+                if not self.read_only:
+                    with self.writing():
+                        index.save(self.db, self.storage.filters)
+        index.notes = text_index.build_notes(self, catalog)
+        self._text_indexes[catalog] = index
+        return index
+    
+    def search_text(self, query, catalog = None, master_filter = None):
+        """Looks for words in the notes, the additional notes and the NGC
+        descriptions, decoded (e.g. "vB" is found by "very bright"), with 
+        the text index of the catalogs (see get_text_index).
+        
+        Parameters:
+        query: alternatives separated by OR, each a list of phrases 
+               separated by commas that must all be found, e.g. "very bright,
+               large, round OR planetary". See text_index.parse_query.
+        catalog: if not None only this catalog is searched
+        master_filter: if not None, only the bodies found that it accepts are
+                       returned. To combine a text query with other filters 
+                       in filter_catalog, see filters.text_match.
+        
+        Returns:
+        a list of body.Body instances, in catalog order
+        """
+        query = text_index.parse_query(query)
+        ret = []
+        for table in self._catalog_tables(catalog):
+            nrows = self.get_text_index(table.name).search(query)
+            bodies = [self._body(table, n) for n in nrows]
+            if master_filter is not None:
+                bodies = filter(master_filter, bodies)
+            ret.extend(bodies)
+        return ret
+    
     def filter_catalog(self, catalog, master_filter):
         """Apply a bank of filters to a catalog, returning only the remaining
         elements.
@@ -216,14 +1055,231 @@ class MasterDatabase(object):
         catalog: a string, the name of the catalog (see list_catalogs)
         master_filter: a callable that filters the elements in the catalog.
                       candidates are in filters.py
+        
+        If the filter has a specification (see filters.filter_spec) the 
+        result is cached, until the catalog is modified. For large catalogs,
+        see iter_filter and filter_page.
         """
         
         table = self.get_catalog(catalog)
         assert isinstance(table, tables.Table)
         assert callable(master_filter)
         
-        return filter(master_filter, 
-                      (body.Body(row) for row in table.iterrows()))
+        spec = filters.filter_spec(master_filter)
+        if spec is None:
+            return self.__filter_table(table, master_filter)
+        
+        key = (catalog, spec)
+        with storage.hdf5_lock:
+            generation = body.table_generation(table)
+        with self._query_lock:
+            entry = self._query_cache.pop(key, None)
+        if entry is not None and entry[0] == generation:
+            nrows = entry[1]
+            ret = [self._body(table, n) for n in nrows]
+        else:
+            ret = self.__filter_table(table, master_filter)
+            nrows = np.array([b._nrow for b in ret], dtype=np.int64)
+        
+        with self._query_lock:
+            self._query_cache[key] = (generation, nrows)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return ret
+    
+    def iter_filter(self, catalog, master_filter, start = 0, 
+                    chunk_rows = None):
+        """Same as filter_catalog, out of core for large catalogs: the 
+        catalog is read in chunks of rows, and the bodies accepted in a 
+        chunk are returned before the next chunk is read, so that the 
+        memory used doesn't depend on the size of the catalog nor on the 
+        number of results. No lock is held between two chunks. The results
+        are not cached.
+        
+        Parameters:
+        catalog: the name of the catalog
+        master_filter: a filter, see filter_catalog
+        start: the first row read
+        chunk_rows: how many rows are read at once, columnar.SCAN_ROWS if 
+                    None
+        
+        Returns:
+        a generator of body.Body instances, in catalog order
+        """
+        table = self.get_catalog(catalog)
+        if isinstance(master_filter, query.Expression):
+            for nrows in master_filter.plan().iter_execute(self, catalog, 
+                                                           start, chunk_rows):
+                for n in nrows:
+                    yield self._body(table, n)
+            return
+        
+        condition, exact = filters.filter_condition(master_filter)
+        columns = self._columns_of(table)
+        deleted = self.deleted_rows(catalog)
+        chunk_rows = chunk_rows or columnar.SCAN_ROWS
+        recording = isinstance(master_filter, filters.MultiFilter)
+        for first in xrange(start, table.nrows, chunk_rows):
+            stop = min(first + chunk_rows, table.nrows)
+            started = time.time()
+            if condition is None:
+                nrows = np.arange(first, stop)
+            elif columns is None:
+                with storage.hdf5_lock:
+                    nrows = table.getWhereList(
+                        condition, start=first, stop=stop)
+            else:
+                nrows = first + np.nonzero(columns.evaluate(condition, first,
+                                                            stop))[0]
+            if condition is not None and recording:
+                #the bank is not called for what the condition rejects
+                master_filter.record_condition(condition, stop - first,
+                                               len(nrows),
+                                               time.time() - started)
+            gone = deleted[np.searchsorted(deleted, first):
+                           np.searchsorted(deleted, stop)]
+            if len(gone) != 0:
+                nrows = np.setdiff1d(nrows, gone)
+            candidates = [self._body(table, n) for n in nrows]
+            if not exact and columns is None and len(nrows) != 0:
+                #the filter reads the bodies from a single read of the chunk
+                with storage.hdf5_lock:
+                    rows = table.readCoordinates(nrows)
+                with self._prefetching(table, nrows, rows):
+                    candidates = filter(master_filter, candidates)
+            elif not exact:
+                candidates = filter(master_filter, candidates)
+            for b in candidates:
+                yield b
+    
+    def filter_page(self, catalog, master_filter, page_size, cursor = 0):
+        """Returns a page of the results of a filter: the next page_size 
+        bodies it accepts from a row on. The pages are read one at a time, 
+        from the result cached by filter_catalog if there is one, otherwise 
+        with iter_filter, which reads only as many rows as the page needs. 
+        The rows of a catalog never move (see deleted_rows), so a cursor 
+        stays valid when the catalog is modified.
+        
+        Parameters:
+        catalog: the name of the catalog
+        master_filter: a filter, see filter_catalog
+        page_size: how many bodies a page has at most
+        cursor: the row the page starts from: 0 for the first page, then the
+                cursor returned with the previous page
+        
+        Returns:
+        a tuple (bodies, cursor): a list of body.Body instances and the 
+        cursor of the next page, None after the last page. The last page 
+        can be empty.
+        """
+        table = self.get_catalog(catalog)
+        spec = filters.filter_spec(master_filter)
+        entry = None
+        if spec is not None:
+            with storage.hdf5_lock:
+                generation = body.table_generation(table)
+            with self._query_lock:
+                entry = self._query_cache.get((catalog, spec))
+        
+        if entry is not None and entry[0] == generation:
+            first = np.searchsorted(entry[1], cursor)
+            nrows = entry[1][first:first + page_size]
+            bodies = [self._body(table, n) for n in nrows]
+        else:
+            bodies = list(itertools.islice(
+                self.iter_filter(catalog, master_filter, cursor), page_size))
+        if len(bodies) < page_size:
+            return bodies, None
+        return bodies, bodies[-1]._nrow + 1
+    
+    def __filter_table(self, table, master_filter):
+        """Applies a filter to all the bodies of a table, in chunks of rows
+        (see iter_filter). The part of the filter with an in-kernel condition
+        (see filters.filter_condition) is evaluated on the columns first, on
+        the catalog in memory if there is one, and only the bodies selected
+        are passed to the filter. If the condition is the whole filter, no 
+        body is filtered one by one. A query.Expression runs its own plan."""
+        return list(self.iter_filter(table.name, master_filter))
+    
+    def explain(self, catalog, expression):
+        """Runs a query expression on a catalog, bypassing the cache of 
+        filter_catalog, and describes how it ran: the stages of its plan, 
+        with the rows in and out of each one and its time (see query.Plan).
+        
+        Parameters:
+        catalog: the name of the catalog
+        expression: a query.Expression, e.g. 
+                    (query.mag < 9) & query.observable(session)
+        
+        Returns:
+        a string
+        """
+        plan = query.where(expression).plan()
+        plan.execute(self, catalog)
+        return plan.explain()
+    
+    def invalidate_query_cache(self, catalog = None):
+        """Forgets the cached results of filter_catalog. Modifications made
+        through body.Body are detected automatically, this is needed only when
+        a catalog table is modified directly.
+        
+        Parameters:
+        catalog: if not None only the results on this catalog are removed.
+        """
+        with self._query_lock:
+            for key in self._query_cache.keys():
+                if catalog is None or key[0] == catalog:
+                    del self._query_cache[key]
+    
+    def save_query_cache(self):
+        """Stores the cached results of filter_catalog in the database, so that
+        they are available the next time it is opened. Results whose catalog
+        has been modified in the meantime are discarded when loading. 
+        ValueError is raised if the database is read-only."""
+        if self.read_only:
+            raise ValueError("Can't save the query cache, %s is read-only" %
+                             self.db.filename)
+        with self._query_lock:
+            entries = self._query_cache.items()
+        with self.writing():
+            if "/query_cache" in self.db:
+                self.db.removeNode("/query_cache", recursive=True)
+            group = self.db.createGroup("/", "query_cache")
+            for i, ((catalog, spec), (generation, nrows)) in enumerate(
+                entries):
+                if len(nrows) == 0:
+                    #empty arrays can't be stored
+                    nrows = np.array([-1], dtype=np.int64)
+                array = self.db.createArray(group, "q%d" % i, nrows)
+                array._v_attrs.catalog = catalog
+                array._v_attrs.spec = spec
+                array._v_attrs.generation = generation
+            self.db.flush()
+    
+    def load_query_cache(self):
+        """Loads the results of filter_catalog saved with save_query_cache."""
+        if "/query_cache" not in self.db:
+            return
+        arrays = sorted(self.db.root.query_cache, 
+                        key=lambda a: int(a.name[1:]))
+        for array in arrays:
+            attrs = array._v_attrs
+            nrows = array.read()
+            if len(nrows) == 1 and nrows[0] == -1:
+                nrows = nrows[:0]
+            self._query_cache[(attrs.catalog, attrs.spec)] = (attrs.generation,
+                                                              nrows)
+        while len(self._query_cache) > self.query_cache_size:
+            self._query_cache.popitem(last=False)
+    
+    def __find_location(self, location):
+        """Returns the row of the first location whose name contains 
+        location (case insensitive), as a dictionary."""
+        locations = self.db.root.locations
+        for r in locations.iterrows():
+            if location.lower() in r["name"].lower():
+                return dict((c, r[c]) for c in locations.colnames)
+        raise ValueError("Location %s not in the database" % location)
     
     def create_observer(self, location, time = "now"):
         """Creates an Observer in a specified location and at a given time.
@@ -235,14 +1291,7 @@ class MasterDatabase(object):
               (now, sunrise, sunset)
         """
         
-        location_found = False
-        for r in self.db.root.locations.iterrows():
-            if location.lower() in r["name"].lower():
-                location_found = True
-                break
-        if not location_found:
-            raise ValueError("Location %s not in the database" % location)
-        
+        r = self.__find_location(location)
         latitude = r["latitude"]
         longitude = r["longitude"]
         height = r["height"]
@@ -260,6 +1309,72 @@ class MasterDatabase(object):
         observer.date = t
         return observer
     
+    def create_session(self, location, time = "now", start_time = None, 
+                       end_time = None, horizon = None, 
+                       step = 10 * ephem.minute, horizon_profile = None):
+        """Creates a session.ObservingSession, to share the observer, the time
+        window and what is derived from them among filters, planners and 
+        graphs.
+        
+        Parameters:
+        location: a string describing the location
+        time: the date of the observer (see create_observer)
+        start_time, end_time: the time window. If None, the dusk and the dawn
+                              of the night at time.
+        horizon: the minimum altitude (degrees), 0 if None
+        step: the time step of the grid (days)
+        horizon_profile: the local horizon, a horizon.HorizonProfile. If 
+                         None, the one of the location if it has one (see 
+                         set_horizon).
+        """
+        if horizon_profile is None:
+            horizon_profile = self.get_horizon(location)
+        return session.ObservingSession(self.create_observer(location, time),
+                                        start_time, end_time, horizon, step,
+                                        horizon_profile)
+    
+    def night_scorer(self, location, time = "now", **kwargs):
+        """Creates a scoring.NightScorer for the night at time (the dark time
+        containing it, or the following one during the day), with the sky
+        brightness of the Bortle class of the location.
+        
+        Parameters:
+        location: a string describing the location
+        time: any value accepted by utils.create_date
+        kwargs: the other parameters of scoring.NightScorer
+        
+        time can also be a session.ObservingSession (see create_session), 
+        whose night and horizon profile are used. Otherwise the horizon 
+        profile of the location is (see set_horizon).
+        
+        Example, the 20 best objects of tonight:
+        scorer = db.night_scorer("Grizzly")
+        scorer.best("sac", 20)
+        """
+        kwargs.setdefault("bortle_class", 
+                          int(self.__find_location(location)["bortle_class"]))
+        if not isinstance(time, session.ObservingSession):
+            kwargs.setdefault("horizon_profile", self.get_horizon(location))
+            time = self.create_observer(location, time)
+        return scoring.NightScorer(self, time, **kwargs)
+    
+    def visibility_tracker(self, catalog, night, master_filter = None):
+        """Creates a tracker.VisibilityTracker, keeping the objects of a 
+        catalog above the horizon up to date as the time goes by.
+        
+        Parameters:
+        catalog: the name of the catalog
+        night: a session.ObservingSession (see create_session)
+        master_filter: if not None, only the objects it accepts are tracked
+        
+        Example, a live display:
+        tracker = db.visibility_tracker("sac", db.create_session("Grizzly"),
+                                        query.mag <= 10)
+        tracker.subscribe(on_rise=show, on_set=hide)
+        tracker.advance() #every minute
+        """
+        return tracker.VisibilityTracker(self, catalog, night, master_filter)
+    
     def get_tour(self, tourname, description=""):
         """Returns a tour. If the tour doens't exist, it will create a new one.
         
@@ -272,9 +1387,118 @@ class MasterDatabase(object):
         """
         return tour.Tour(tourname, self, description)
     
+    def import_tour(self, filename, tour_name = None, **kwargs):
+        """Imports an observing list (e.g. the ones in catalogues/) into a
+        tour. See importers.import_list for the formats and the parameters.
+        
+        Returns:
+        an importers.ImportReport, with the entries that could not be 
+        resolved
+        """
+        return importers.import_list(self, filename, tour_name, **kwargs)
+    
     def list_tours(self):
         """
         Returns a list with all the tours.
         """
-        return self.db.root.tours._v_children.keys()        
-    
\ No newline at end of file
+        return self.db.root.tours._v_children.keys()
+    
+    def migrate_tours(self):
+        """Upgrades the tours created before the position of their bodies was
+        stored (see tour.upgrade_table), see migrate."""
+        with self.writing():
+            for table in list(self.db.root.tours):
+                if "nrow" not in table.colnames:
+                    tour.upgrade_table(self, table)
+
+    def build_visibility_calendar(self, location, year, horizon = 0):
+        """Precomputes when every object is observable from a location, for
+        every night of a year. See visibility.VisibilityCalendar.
+        
+        Parameters:
+        location: a string describing the location
+        year: an integer
+        horizon: the minimum altitude (degrees)
+        
+        Returns:
+        a visibility.VisibilityCalendar instance
+        """
+        return visibility.build_calendar(self, location, year, horizon)
+    
+    def get_visibility_calendar(self, location, year):
+        """Returns the calendar of a location and a year, or None if it has not
+        been built (see build_visibility_calendar).
+        """
+        observer = self.create_observer(location)
+        name = visibility.calendar_name(observer.name, year)
+        try:
+            group = self.db.getNode("/visibility", name)
+        except tables.NoSuchNodeError:
+            return None
+        return visibility.VisibilityCalendar(self, group)
+    
+    def list_visibility_calendars(self):
+        """
+        Returns a list with all the visibility calendars.
+        """
+        return self.db.root.visibility._v_children.keys()
+    
+    def update_visibility_calendars(self, changed_rows = None):
+        """Recomputes the parts of the visibility calendars invalidated by
+        changes to the catalogs or to the locations.
+        
+        Parameters:
+        changed_rows: if given, a dictionary catalog name -> row numbers of 
+                      the only rows of the catalog that changed. See 
+                      visibility.update_calendars.
+        """
+        visibility.update_calendars(self, changed_rows)
+    
+    def observable_tonight(self, location, time = "now", catalog = None,
+                           min_altitude = None, min_hours = 0):
+        """Returns the objects that are up during the dark time of a night, 
+        looking them up in the visibility calendar.
+        
+        Parameters:
+        location: a string describing the location
+        time: any value accepted by utils.create_date. The night containing 
+              it (or the following one, during the day) is used.
+        catalog: if not None only this catalog is searched
+        min_altitude: if not None, the minimum peak altitude (degrees)
+        min_hours: the minimum number of dark hours the object is up
+        
+        Returns:
+        a list of body.Body instances
+        """
+        t = utils.create_date(time)
+        calendar = self.get_visibility_calendar(location, t.tuple()[0])
+        if calendar is None:
+            raise ValueError("No visibility calendar for %s in %d" % (
+                location, t.tuple()[0]))
+        night = calendar.night_index(t)
+        
+        if catalog is None:
+            catalogs_to_search = calendar.catalogs
+        else:
+            catalogs_to_search = [catalog]
+        ret = []
+        for c in catalogs_to_search:
+            table = self.get_catalog(c)
+            ret.extend(self._get_body(table, n)
+                       for n in calendar.observable(night, c, min_altitude,
+                                                    min_hours))
+        return ret
+    
+    def best_nights(self, body_obj, location, year, count = 10):
+        """Returns the nights of a year when a body culminates highest in the
+        dark time, looking them up in the visibility calendar.
+        
+        Returns:
+        a list of (dusk, peak altitude, hours up) tuples, dusk is an ephem.Date
+        """
+        calendar = self.get_visibility_calendar(location, year)
+        if calendar is None:
+            raise ValueError("No visibility calendar for %s in %d" % (
+                location, year))
+        return calendar.best_nights(body_obj._table.name, body_obj._nrow,
+                                    count)
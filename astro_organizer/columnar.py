@@ -0,0 +1,179 @@
+import os
+import glob
+import zlib
+import logging
+import numpy as np
+import numexpr
+
+import body
+
+#how many rows the scans of large catalogs read at once (see
+#catalogs.MasterDatabase.iter_filter): a few megabytes, whatever the size of
+#the catalog
+SCAN_ROWS = 32768
+
+def normalize(col):
+    """Returns a string column without spaces and lower case."""
+    return np.char.lower(np.char.replace(col, " ", ""))
+
+class CatalogColumns(object):
+    """An in-memory copy of a catalog table, as a NumPy structured array. It is
+    used by catalogs.MasterDatabase when opened with in_memory=True.
+
+    If a cache directory is given the array is memory-mapped from an
+    uncompressed .npy file, written the first time and reused until the table
+    is modified (see body.table_generation). The name of the file tells the
+    databases sharing the directory apart, and the tables removed and 
+    created again with the same name (see body.table_token). The mapping is 
+    copy-on-write: writes never reach the cache file, only the array in 
+    memory and the table.
+    """
+
+    def __init__(self, table, cache_dir = None):
+        self.table = table
+        self.mapped = False
+        if cache_dir is None:
+            self.data = table.read()
+        else:
+            self.data = self.__load_cached(table, cache_dir)
+        self._normalized = {}
+
+    def __load_cached(self, table, cache_dir):
+        database = zlib.crc32(os.path.abspath(table._v_file.filename))
+        prefix = os.path.join(cache_dir, "%s.%08x" % (table.name,
+                                                      database & 0xffffffff))
+        path = "%s.%s.%d.npy" % (prefix, body.table_token(table),
+                                 body.table_generation(table))
+        if os.path.exists(path):
+            data = np.load(path, mmap_mode="c")
+            if len(data) == table.nrows and data.dtype == table.dtype:
+                self.mapped = True
+                return data
+
+        for old in glob.glob(prefix + ".*.npy"):
+            os.remove(old)
+        data = table.read()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        logging.info("Writing the cache of %s in %s", table.name, path)
+        np.save(path, data)
+        self.mapped = True
+        return np.load(path, mmap_mode="c")
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + sum(a.nbytes
+                                      for a in self._normalized.itervalues())
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, colname, nrow):
+        return self.data[colname][nrow]
+
+    def set(self, colname, nrow, value):
+        self.data[colname][nrow] = value
+        if colname in self._normalized:
+            self._normalized[colname][nrow] = value.replace(" ", "").lower()
+
+    def set_rows(self, nrows, rows):
+        """Replaces whole rows, given as a structured array."""
+        self.data[nrows] = rows
+        for colname, col in self._normalized.iteritems():
+            col[nrows] = normalize(rows[colname])
+
+    def evaluate(self, condition, start = 0, stop = None):
+        """Evaluates a PyTables condition (see tables.Table.where) on the
+        columns, or on the rows from start to stop, returning a boolean 
+        array."""
+        data = self.data[start:stop]
+        return numexpr.evaluate(condition, local_dict=dict(
+            (c, data[c]) for c in data.dtype.names))
+    
+    def normalized(self, colname):
+        """Returns a string column without spaces and lower case, computed
+        once."""
+        try:
+            return self._normalized[colname]
+        except KeyError:
+            pass
+        col = normalize(self.data[colname])
+        self._normalized[colname] = col
+        return col
+
+    def find_exact(self, name):
+        """Returns the rows whose name is exactly name."""
+        return np.nonzero(self.data["name"] == name)[0]
+
+    def find_exact_any(self, names):
+        """Returns the rows whose name is any of names."""
+        return np.nonzero(np.in1d(self.data["name"], list(names)))[0]
+
+    def find_normalized(self, newname, colnames):
+        """Returns the rows where any of the normalized columns is exactly
+        newname."""
+        mask = np.zeros(len(self.data), bool)
+        for c in colnames:
+            mask |= self.normalized(c) == newname
+        return np.nonzero(mask)[0]
+
+    def find_substring(self, newname, colnames):
+        """Returns the rows where any of the normalized columns contains
+        newname."""
+        mask = np.zeros(len(self.data), bool)
+        for c in colnames:
+            mask |= np.char.find(self.normalized(c), newname) >= 0
+        return np.nonzero(mask)[0]
+
+class RecordBlock(object):
+    """A block of consecutive rows of a catalog, as a NumPy structured array
+    (see catalogs.MasterDatabase.iter_chunks). No body.Body is created until
+    asked for with bodies.
+    
+    Attributes:
+    catalog: the name of the catalog
+    start: the row number of the first row of the block
+    data: the structured array, with only the columns asked for
+    """
+    
+    __slots__ = ("catalog", "start", "data", "_master_db")
+    
+    def __init__(self, master_db, catalog, start, data):
+        self._master_db = master_db
+        self.catalog = catalog
+        self.start = start
+        self.data = data
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __getitem__(self, colname):
+        return self.data[colname]
+    
+    @property
+    def nrows(self):
+        """The row numbers in the catalog of the rows of the block."""
+        return np.arange(self.start, self.start + len(self.data))
+    
+    def bodies(self, selection = None):
+        """Returns the body.Body instances of the block.
+        
+        Parameters:
+        selection: None for all the rows, a boolean mask or the indices (in 
+                   the block) of the rows wanted.
+        """
+        nrows = self.nrows
+        if selection is not None:
+            nrows = nrows[selection]
+        return self._master_db.get_bodies(self.catalog, nrows)
+
+def select_columns(data, colnames):
+    """Returns a compact copy of a structured array with only some of its
+    columns."""
+    if colnames is None:
+        return data
+    dtype = np.dtype([(c, data.dtype[c]) for c in colnames])
+    ret = np.empty(len(data), dtype=dtype)
+    for c in colnames:
+        ret[c] = data[c]
+    return ret
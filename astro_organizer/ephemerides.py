@@ -0,0 +1,216 @@
+import ephem
+import math
+import logging
+import numpy as np
+import numpy.polynomial.chebyshev as chebyshev
+import tables
+
+import body
+import catalogs
+import utils
+
+#the bodies of the solar_system catalog: (name, PyEphem class, body type)
+SOLAR_SYSTEM = [("Moon", ephem.Moon, "MOON"),
+                ("Mercury", ephem.Mercury, "PLNET"),
+                ("Venus", ephem.Venus, "PLNET"),
+                ("Mars", ephem.Mars, "PLNET"),
+                ("Jupiter", ephem.Jupiter, "PLNET"),
+                ("Saturn", ephem.Saturn, "PLNET"),
+                ("Uranus", ephem.Uranus, "PLNET"),
+                ("Neptune", ephem.Neptune, "PLNET")]
+
+
+class Ephemeris(object):
+    """The precomputed positions of the bodies of a moving catalog (planets,
+    the Moon, comets), stored in /ephemerides/<catalog> as Chebyshev
+    coefficients: the time range is split in segments of equal length and in
+    each one the geocentric astrometric (J2000) unit vector and the magnitude
+    of every body are polynomials of time.
+
+    Arrays:
+    position: (bodies x segments x 3 x degree + 1) coefficients of x, y, z
+    magnitude: (bodies x segments x degree + 1)
+    The rows of the arrays are the rows of the catalog table.
+    """
+
+    def __init__(self, group):
+        attrs = group._v_attrs
+        self.catalog = group._v_name
+        self.start = attrs.start
+        self.segment = attrs.segment
+        self.degree = attrs.degree
+        #a few MB at most, they are kept in memory
+        self._position = group.position[:]
+        self._magnitude = group.magnitude[:]
+
+    def __repr__(self):
+        return "Ephemeris: %s (%s - %s)" % (self.catalog,
+                                           ephem.Date(self.start),
+                                           ephem.Date(self.end))
+
+    @property
+    def end(self):
+        return self.start + self.segment * self._position.shape[1]
+
+    def __evaluate(self, coefficients, dates, nrows):
+        """Evaluates (bodies x segments x ... x degree + 1) coefficients at
+        dates, returning a (bodies x dates x ...) array, NaN outside of the
+        time range."""
+        dates = np.atleast_1d(np.asarray(dates, dtype=np.float64))
+        if nrows is not None:
+            coefficients = coefficients[np.asarray(nrows)]
+        t = (dates - self.start) / self.segment
+        nsegments = coefficients.shape[1]
+        valid = (t >= 0) & (t <= nsegments)
+        segment = np.clip(np.floor(t).astype(np.int64), 0, nsegments - 1)
+        x = 2 * (t - segment) - 1
+
+        #Chebyshev polynomials at x: (dates x degree + 1)
+        poly = np.empty((len(dates), coefficients.shape[-1]))
+        poly[:, 0] = 1
+        if poly.shape[1] > 1:
+            poly[:, 1] = x
+        for k in xrange(2, poly.shape[1]):
+            poly[:, k] = 2 * x * poly[:, k - 1] - poly[:, k - 2]
+
+        selected = coefficients[:, segment]
+        extra = selected.ndim - 3
+        shape = (1, len(dates)) + (1,) * extra + (poly.shape[1],)
+        values = (selected * poly.reshape(shape)).sum(axis=-1)
+        values[:, ~valid] = np.nan
+        return values
+
+    def positions(self, dates, nrows = None):
+        """Returns the J2000 geocentric positions of the bodies.
+
+        Parameters:
+        dates: a date or an array of ephem dates
+        nrows: the rows of the bodies, all of them if None
+
+        Returns:
+        a tuple of two (bodies x dates) arrays (ra, dec), in radians. They
+        are NaN outside of the time range of the ephemeris.
+        """
+        xyz = self.__evaluate(self._position, dates, nrows)
+        ra = np.mod(np.arctan2(xyz[..., 1], xyz[..., 0]), 2 * math.pi)
+        dec = np.arctan2(xyz[..., 2], np.hypot(xyz[..., 0], xyz[..., 1]))
+        return ra, dec
+
+    def magnitudes(self, dates, nrows = None):
+        """Returns the magnitudes of the bodies, a (bodies x dates) array.
+        See positions."""
+        return self.__evaluate(self._magnitude, dates, nrows)
+
+
+def load(table):
+    """Returns the Ephemeris of a catalog table, None if it is a catalog of
+    fixed objects."""
+    path = "/ephemerides/" + table.name
+    if path not in table._v_file:
+        return None
+    return Ephemeris(table._v_file.getNode(path))
+
+
+def _chebyshev_dates(start, segment, nsegments, degree):
+    """Returns the Chebyshev nodes in [-1, 1] and the corresponding dates in
+    every segment, a (segments x nodes) array."""
+    nodes = np.cos(math.pi * (np.arange(degree + 1) + 0.5) / (degree + 1))
+    first = start + segment * np.arange(nsegments)
+    return nodes, first[:, np.newaxis] + (nodes + 1) / 2 * segment
+
+
+def build(master_db, start, end, catalog = "solar_system", segment = 1.0,
+          degree = 10, comets = ()):
+    """Creates a catalog of moving bodies, precomputing their positions with
+    PyEphem. An existing catalog with the same name is replaced.
+
+    The default accuracy (daily segments of degree 10) is better than one arc
+    second for the Moon. The positions are geocentric: the parallax of the
+    Moon (up to one degree) is ignored.
+
+    Parameters:
+    master_db: a catalogs.MasterDatabase instance
+    start, end: the time range (anything accepted by utils.create_date)
+    catalog: the name of the catalog
+    segment: the length of each segment (days)
+    degree: the degree of the polynomials
+    comets: xephem database lines (see ephem.readdb) of other bodies to
+            add, e.g. bright comets
+
+    Returns:
+    the Ephemeris of the catalog
+    """
+    start = float(utils.create_date(start))
+    end = float(utils.create_date(end))
+    if end <= start:
+        raise ValueError("The time range is empty")
+    nsegments = int(math.ceil((end - start) / segment))
+    nodes, dates = _chebyshev_dates(start, segment, nsegments, degree)
+
+    bodies = [(name, cls(), body_type) for name, cls, body_type in
+              SOLAR_SYSTEM]
+    for line in comets:
+        comet = ephem.readdb(line)
+        bodies.append((comet.name, comet, "COMET"))
+
+    position = np.empty((len(bodies), nsegments, 3, degree + 1))
+    magnitude = np.empty((len(bodies), nsegments, degree + 1))
+    middle = (start + end) / 2
+    rows = []
+    for i, (name, body_obj, body_type) in enumerate(bodies):
+        logging.debug("Computing the ephemeris of %s", name)
+        xyz = np.empty(dates.shape + (3,))
+        mag = np.empty(dates.shape)
+        for index, date in np.ndenumerate(dates):
+            body_obj.compute(date, epoch=ephem.J2000)
+            ra, dec = float(body_obj.a_ra), float(body_obj.a_dec)
+            xyz[index] = (math.cos(dec) * math.cos(ra),
+                          math.cos(dec) * math.sin(ra),
+                          math.sin(dec))
+            mag[index] = body_obj.mag
+        #one fit for all the segments: the nodes are the same
+        fit = chebyshev.chebfit(nodes, xyz.transpose(1, 0, 2).reshape(
+            degree + 1, -1), degree)
+        position[i] = fit.reshape(degree + 1, nsegments, 3).transpose(1, 2, 0)
+        magnitude[i] = chebyshev.chebfit(nodes, mag.T, degree).T
+
+        body_obj.compute(middle, epoch=ephem.J2000)
+        rows.append((name, body_type, float(body_obj.a_ra),
+                     float(body_obj.a_dec), body_obj.mag,
+                     ephem.constellation(body_obj)[0].upper()))
+
+    with master_db.writing():
+        db = master_db.db
+        if "/ephemerides" not in db:
+            db.createGroup("/", "ephemerides")
+        for where in ("/catalogs", "/ephemerides"):
+            if catalog in db.getNode(where):
+                db.removeNode(where, catalog, recursive=True)
+
+        table = db.createTable("/catalogs", catalog, catalogs._TableBody,
+                               "Moving bodies",
+                               **master_db.storage.table_options("catalog"))
+        body.stamp_table(table)
+        row = table.row
+        for name, body_type, ra, dec, mag, constellation in rows:
+            row["name"] = name
+            row["body_type"] = body_type
+            row["ra"] = ra
+            row["dec"] = dec
+            row["mag"] = mag
+            row["constellation"] = constellation
+            row.append()
+        table.flush()
+
+        group = db.createGroup("/ephemerides", catalog)
+        attrs = group._v_attrs
+        attrs.start = start
+        attrs.segment = float(segment)
+        attrs.degree = degree
+        filters = master_db.storage.filters
+        db.createCArray(group, "position", tables.Float64Atom(),
+                        position.shape, filters=filters)[:] = position
+        db.createCArray(group, "magnitude", tables.Float64Atom(),
+                        magnitude.shape, filters=filters)[:] = magnitude
+        db.flush()
+    return load(table)
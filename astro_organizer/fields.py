@@ -0,0 +1,193 @@
+import math
+import collections
+import numpy as np
+
+import storage
+
+class FieldGroup(object):
+    """Objects close enough to be seen in the same eyepiece field: all of
+    them are within half the field of view of the lead object, on which the
+    field is centered (see group_positions).
+
+    Attributes:
+    lead: the body.Body the field is centered on
+    bodies: the body.Body instances of the group, in their original order
+    radius: the angular distance of the farthest one from the lead (arc
+            minutes)
+    """
+
+    def __init__(self, lead, bodies, radius):
+        self.lead = lead
+        self.bodies = bodies
+        self.radius = radius
+
+    def __repr__(self):
+        if len(self.bodies) == 1:
+            return "FieldGroup: %s" % self.lead.name
+        return "FieldGroup: %s and %d more within %.1f'" % (
+            self.lead.name, len(self.bodies) - 1, self.radius)
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def __iter__(self):
+        return iter(self.bodies)
+
+    @property
+    def others(self):
+        """The bodies of the group other than the lead."""
+        return [b for b in self.bodies if b is not self.lead]
+
+def _unit_vectors(ra, dec):
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra),
+                            np.sin(dec)))
+
+def neighbor_pairs(ra, dec, radius):
+    """Finds the pairs of objects closer than radius, hashing their positions
+    on a grid of cubes of side the chord of radius: the neighbors of an
+    object can only be in its cube or in the 26 around it, so only those
+    are compared, rather than all the pairs.
+
+    Parameters:
+    ra, dec: arrays of positions (radians)
+    radius: the angular distance (radians)
+
+    Returns:
+    two arrays i, j with the pairs (both ways, without i == j)
+    """
+    xyz = _unit_vectors(np.asarray(ra, float), np.asarray(dec, float))
+    valid = np.nonzero(~np.isnan(xyz).any(axis=1))[0]
+    xyz = xyz[valid]
+    if len(xyz) == 0:
+        return valid, valid
+    chord = 2 * math.sin(radius / 2)
+    cells = np.floor(xyz / chord).astype(np.int64)
+    #the cells as single integers, sorted; the cells around are numbered
+    #too, from 0
+    cells -= cells.min(axis=0) - 1
+    side = cells.max(axis=0) + 2
+    def key(c):
+        return (c[:, 0] * side[1] + c[:, 1]) * side[2] + c[:, 2]
+    order = np.argsort(key(cells), kind="mergesort")
+    sorted_keys = key(cells)[order]
+
+    pairs_i = []
+    pairs_j = []
+    for offset in np.ndindex(3, 3, 3):
+        neighbors = key(cells + (np.array(offset) - 1))
+        first = np.searchsorted(sorted_keys, neighbors, side="left")
+        last = np.searchsorted(sorted_keys, neighbors, side="right")
+        counts = last - first
+        i = np.repeat(np.arange(len(xyz)), counts)
+        #the positions in the cell of each candidate
+        starts = np.repeat(first - np.cumsum(counts) + counts, counts)
+        j = order[np.arange(len(i)) + starts]
+        close = ((((xyz[i] - xyz[j]) ** 2).sum(axis=1) <= chord ** 2) &
+                 (i != j))
+        pairs_i.append(i[close])
+        pairs_j.append(j[close])
+    return valid[np.concatenate(pairs_i)], valid[np.concatenate(pairs_j)]
+
+def group_positions(ra, dec, field_of_view):
+    """Groups objects into eyepiece fields. The objects with the most
+    neighbors within half the field of view lead a field first: each one
+    still without a group gets the neighbors still without a group, then the
+    next. Every object is in one group, alone if it has no neighbor, and
+    every group fits in a field centered on its lead.
+
+    Parameters:
+    ra, dec: arrays of positions (radians)
+    field_of_view: the diameter of the field (arc minutes)
+
+    Returns:
+    a tuple of arrays (labels, leads): the group of each object, the groups
+    numbered in the order of their first object, and the index of the lead
+    of each group
+    """
+    count = len(ra)
+    radius = math.radians(field_of_view / 120.0)
+    i, j = neighbor_pairs(ra, dec, radius)
+    #the neighbors of each object, contiguous
+    order = np.argsort(i, kind="mergesort")
+    neighbors = j[order]
+    ends = np.cumsum(np.bincount(i, minlength=count))
+    starts = ends - np.bincount(i, minlength=count)
+
+    labels = np.empty(count, np.int64)
+    labels.fill(-1)
+    leads = []
+    for lead in np.argsort(-(ends - starts), kind="mergesort"):
+        if labels[lead] >= 0:
+            continue
+        labels[lead] = len(leads)
+        near = neighbors[starts[lead]:ends[lead]]
+        labels[near[labels[near] < 0]] = len(leads)
+        leads.append(lead)
+
+    #numbered by first object
+    first = np.empty(len(leads), np.int64)
+    first.fill(count)
+    np.minimum.at(first, labels, np.arange(count))
+    renumber = np.empty(len(leads), np.int64)
+    renumber[np.argsort(first, kind="mergesort")] = np.arange(len(leads))
+    leads = np.array(leads, np.int64)[np.argsort(first, kind="mergesort")]
+    return renumber[labels], leads
+
+def _positions(bodies):
+    """Reads the positions of bodies, a single read per catalog."""
+    ra = np.empty(len(bodies))
+    dec = np.empty(len(bodies))
+    by_table = collections.defaultdict(list)
+    for n, b in enumerate(bodies):
+        if b.ephemeris is not None:
+            #the moving bodies stay alone
+            ra[n] = dec[n] = np.nan
+        else:
+            by_table[b._table].append(n)
+    for table, indices in by_table.iteritems():
+        nrows = [bodies[n]._nrow for n in indices]
+        master_db = bodies[indices[0]]._master_db
+        if master_db is not None:
+            columns = master_db._columns_of(table)
+            if columns is not None:
+                ra[indices] = columns.data["ra"][nrows]
+                dec[indices] = columns.data["dec"][nrows]
+                continue
+        with storage.hdf5_lock:
+            rows = table.readCoordinates(nrows)
+        ra[indices] = rows["ra"]
+        dec[indices] = rows["dec"]
+    return ra, dec
+
+def group_bodies(bodies, field_of_view):
+    """Groups body.Body instances into eyepiece fields, see group_positions.
+    The moving bodies are not grouped.
+
+    Parameters:
+    bodies: a list of body.Body instances, e.g. a tour or the result of
+            catalogs.MasterDatabase.filter_catalog
+    field_of_view: the diameter of the field (arc minutes)
+
+    Returns:
+    a list of FieldGroup, in the order of their first body
+    """
+    bodies = list(bodies)
+    if len(bodies) == 0:
+        return []
+    ra, dec = _positions(bodies)
+    labels, leads = group_positions(ra, dec, field_of_view)
+    members = [[] for _ in leads]
+    for n, label in enumerate(labels):
+        members[label].append(n)
+    xyz = _unit_vectors(ra, dec)
+    groups = []
+    for lead, indices in zip(leads, members):
+        radius = 0.0
+        if len(indices) > 1:
+            chord = math.sqrt(((xyz[indices] - xyz[lead]) ** 2).sum(
+                axis=1).max())
+            radius = math.degrees(2 * math.asin(chord / 2)) * 60
+        groups.append(FieldGroup(bodies[lead], [bodies[n] for n in indices],
+                                 radius))
+    return groups
@@ -1,25 +1,105 @@
 from body import Body
-import utils
+import session
+import text_index
 import ephem
+import time
+
+def _named(filter_fun, kind, *params):
+    """Gives a readable name to a filter function, used in the statistics of
+    MultiFilter, and a specification made of its kind and parameters (see
+    filter_spec)."""
+    filter_fun.__name__ = "%s(%s)" % (kind, ", ".join(str(p) for p in params))
+    if not hasattr(filter_fun, "spec"):
+        filter_fun.spec = (kind,) + params
+    return filter_fun
+
+def filter_spec(filter_fun):
+    """Returns a hashable specification of a filter: two filters with the same
+    specification select the same bodies. The specification is either the 
+    spec attribute of the filter or, if it is callable, what it returns.
+    
+    Returns:
+    a hashable object, or None if the filter has no specification (e.g. a 
+    plain lambda).
+    """
+    spec = getattr(filter_fun, "spec", None)
+    if callable(spec):
+        return spec()
+    return spec
+
+def _in_kernel(filter_fun, condition):
+    """Attaches to a filter an equivalent PyTables condition on the catalog
+    columns (see filter_condition)."""
+    filter_fun.condition = condition
+    return filter_fun
+
+def filter_condition(filter_fun):
+    """Returns the in-kernel condition of a filter: a PyTables condition 
+    (see tables.Table.where) on the catalog columns, selecting at least the
+    bodies the filter accepts.
+    
+    Returns:
+    a tuple (condition, exact): condition is None if the filter has none, 
+    exact is True if the condition selects exactly the bodies the filter 
+    accepts, i.e. the filter doesn't need to be called.
+    """
+    condition = getattr(filter_fun, "condition", None)
+    if callable(condition):
+        return condition()
+    return condition, condition is not None
 
 def messier_only():
     """Returns True if b is a Messier"""
-    return lambda b: 'M' in b.catalog
+    return _named(lambda b: 'M' in b.catalog, "messier_only")
 
 def limit_magnitude(mag):
     """Returns a function that evaluates to True if the body magnitude is less
     or equal than the specified one"""
-    return lambda b: b.mag <= mag
+    return _in_kernel(_named(lambda b: b.mag <= mag, "limit_magnitude", mag),
+                      "mag <= %r" % float(mag))
 
 def limit_surface_brightness(br):
     """Returns a function that evaluates to True if the body surface brightness 
-    is less or equal than the specified one"""
-    return lambda b: b.surface_brightness <= br
+    is less or equal than the specified one. Bodies without a surface 
+    brightness are rejected."""
+    return _in_kernel(_named(lambda b: b.surface_brightness_mag <= br,
+                             "limit_surface_brightness", br),
+                      "surface_brightness_mag <= %r" % float(br))
+
+def min_size(arcmin):
+    """Returns a function that evaluates to True if the largest size of the
+    body is at least the specified one, in arc minutes. Bodies without a size
+    are rejected."""
+    arcsec = arcmin * 60.0
+    return _in_kernel(_named(lambda b: b.size_max_arcsec >= arcsec,
+                             "min_size", arcmin),
+                      "size_max_arcsec >= %r" % arcsec)
+
+def max_size(arcmin):
+    """Returns a function that evaluates to True if the largest size of the
+    body is at most the specified one, in arc minutes. Bodies without a size
+    are rejected."""
+    arcsec = arcmin * 60.0
+    return _in_kernel(_named(lambda b: b.size_max_arcsec <= arcsec,
+                             "max_size", arcmin),
+                      "size_max_arcsec <= %r" % arcsec)
+
+def body_type(*types):
+    """Returns a function that evaluates to True if the body is of one of the
+    specified SAC types (e.g. GALXY, see string_conversions.sac_type_to_string)
+    """
+    types = tuple(sorted(types))
+    condition = " | ".join("(body_type == %r)" % t for t in types)
+    return _in_kernel(_named(lambda b: b.body_type in types,
+                             "body_type", *types),
+                      condition)
 
 def constellation(const):
     """Returns a function that evaluates to True if the body is in a specified
     constellation (abbreviated)"""
-    return lambda b: b.constellation == const
+    return _in_kernel(_named(lambda b: b.constellation == const, 
+                             "constellation", const),
+                      "constellation == %r" % const)
 
 def observable(observer, 
                start_time = None, 
@@ -29,81 +109,301 @@ def observable(observer,
     body at least once in a timespan, False otherwise.
     
     Parameters:
-    observer: an ephem.Observer instance
+    observer: an ephem.Observer instance, or a session.ObservingSession (the
+              other parameters are then ignored)
     start_time: an ephem.Date representing when an observation can start. If
                 None then the observer time is used.
     end_time: an ephem.Date representing when an observation can start. If
                 None then the observer time is used.
     horizon: if not None defines the observer's horizon, otherwise the one from
             the observer is used.
+    
+    The timespan is resolved once, when the filter is created, and the rising
+    and setting of each body are shared with the other users of the session
+    (see session.ObservingSession.is_up). Moving bodies (see 
+    body.Body.ephemeris) are checked every 10 minutes of the timespan.
     """
     
-    assert isinstance(observer, ephem.Observer)    
-    def can_observe(body):        
-        assert isinstance(body, Body)
-        body = body.ephem_body
-        
-        copy_observer = utils.copy_observer(observer)
-        
+    if isinstance(observer, session.ObservingSession):
+        night = observer
+    else:
+        assert isinstance(observer, ephem.Observer)
         if start_time is None:
-            st = observer.date
-        else:
-            st = utils.create_date(start_time)
+            start_time = observer.date
         if end_time is None:
-            et = observer.date
-        else:
-            et = utils.create_date(end_time)
-            
-        if horizon is None:
-            copy_observer.horizon = observer.horizon
+            end_time = observer.date
+        night = session.ObservingSession(observer, start_time, end_time,
+                                         horizon)
+    
+    def can_observe(body):        
+        assert isinstance(body, Body)
+        return night.is_up(body)
+    
+    can_observe.spec = ("observable",) + night.spec()[1:]
+    return _named(can_observe, "observable", night.observer.name, night.start,
+                  night.end, night.horizon)
+
+def min_visibility_score(scorer, score):
+    """Returns a function that evaluates to True if the visibility score of
+    the body is at least score.
+    
+    Parameters:
+    scorer: a scoring.NightScorer instance (see 
+            catalogs.MasterDatabase.night_scorer)
+    score: the threshold, between 0 and 1
+    
+    The scores of a whole catalog are computed at once the first time a body
+    of that catalog is filtered.
+    """
+    def good_enough(b):
+        return scorer.score(b) >= score
+    good_enough.spec = lambda: ("min_visibility_score", scorer.spec(), score)
+    return _named(good_enough, "min_visibility_score", scorer, score)
+
+def min_time_above_horizon(night, minutes):
+    """Returns a function that evaluates to True if the body is above the 
+    horizon and the horizon profile of a session for at least some minutes.
+    
+    Parameters:
+    night: a session.ObservingSession (see 
+           catalogs.MasterDatabase.create_session)
+    minutes: the minimum time
+    
+    The times of a whole catalog are computed at once the first time a body
+    of that catalog is filtered (see 
+    session.ObservingSession.catalog_time_above_horizon).
+    """
+    def long_enough(b):
+        if b._master_db is None:
+            time_up = night.body_time_above_horizon(b)
         else:
-            copy_observer.horizon = str(horizon)
-        
-        try:
-            setting = copy_observer.next_setting(body, use_center=True)
-            rising = copy_observer.next_rising(body, use_center=True)
-        except ephem.NeverUpError:
-            return False
-        except ephem.AlwaysUpError:
-            return True
-        
-        if rising > setting:
-            rising = copy_observer.previous_rising(body, use_center=True)
-        #====rise========set=======#
-        #========observe======stop=#
-        cond1 = rising < st < setting
-        
-        #===========rise========set=======#
-        #===observe========stop===========#    
-        cond2 = st < rising < et
-        
-        return cond1 or cond2    
+            time_up = night.catalog_time_above_horizon(
+                b._master_db, b._table.name)[b._nrow]
+        return time_up >= minutes * ephem.minute
+    long_enough.spec = (("min_time_above_horizon", minutes) + 
+                        night.spec()[1:])
+    return _named(long_enough, "min_time_above_horizon", 
+                  night.observer.name, minutes)
+
+def text_match(master_db, query):
+    """Returns a function that evaluates to True if the notes, the additional
+    notes or the NGC description of the body match a text query (see 
+    catalogs.MasterDatabase.search_text).
+    
+    Parameters:
+    master_db: the catalogs.MasterDatabase of the bodies
+    query: see text_index.parse_query
+    
+    The query is answered once per catalog with its text index, then again
+    only if the database has been written to.
+    """
+    parsed = text_index.parse_query(query)
+    found = {}
+    def matches(b):
+        catalog = b._table.name
+        cached = found.get(catalog)
+        if cached is None or cached[0] != master_db._write_serial:
+            nrows = master_db.get_text_index(catalog).search(parsed)
+            cached = found[catalog] = (master_db._write_serial, 
+                                       set(nrows.tolist()))
+        return b._nrow in cached[1]
+    matches.spec = lambda: ("text_match", parsed, 
+                            text_index.notes_generation(master_db.db))
+    return _named(matches, "text_match", query)
+
+class _FilterStats(object):
+    """Running statistics of a filter inside a MultiFilter."""
     
-    return can_observe
+    def __init__(self, filter_fun, position, reorder):
+        self.filter_fun = filter_fun
+        self.position = position
+        self.reorder = reorder
+        self.calls = 0
+        self.rejections = 0
+        self.total_time = 0.0
+    
+    @property
+    def mean_time(self):
+        if self.calls == 0:
+            return 0.0
+        return self.total_time / self.calls
+    
+    @property
+    def rejection_rate(self):
+        if self.calls == 0:
+            return 0.0
+        return float(self.rejections) / self.calls
+    
+    def rank(self):
+        """Expected cost of the filter per rejected body. Evaluating the 
+        filters by increasing rank minimizes the expected cost of the chain.
+        The rejection rate is smoothed so that filters that never rejected 
+        anything yet still get a finite rank."""
+        rate = (self.rejections + 1.0) / (self.calls + 2.0)
+        return self.mean_time / rate
 
 class MultiFilter(object):
     """This class represents a bank of filter, i.e. a list of boolean function.
     example filters are defined in this file.
     
-    Note: since the filters are evaluated in the order they are appendend, put
-    the faster filters first and the slower last.
+    The filters are evaluated until the first one rejects the body. While 
+    running, the time spent in each filter and how often it rejects a body are
+    recorded, and every reorder_every bodies the filters are reordered so that
+    the cheap and selective ones run first. A body is accepted only if all the
+    filters accept it, therefore the order does not change the result.
+    
+    Filters that must run after the ones before them (e.g. because they rely 
+    on their side effects) can be appended with reorder=False: filters are 
+    never moved across them.
+    
+    catalogs.MasterDatabase.filter_catalog evaluates the in-kernel condition 
+    of the bank (see condition) on the catalog columns first, and calls the 
+    bank only on the bodies it selects, or not at all if it is exact. The 
+    filters with a condition are then evaluated together by the condition: 
+    it is recorded as a stage of its own in the statistics, and the filters 
+    themselves see no body or only bodies they accept, so they are moved 
+    last by the reordering.
     """
     
-    def __init__(self):
+    def __init__(self, adaptive = True, reorder_every = 64):
+        """
+        Parameters:
+        adaptive: if False the filters are always evaluated in the order they
+                  are appended.
+        reorder_every: how many bodies are filtered between two reorderings.
+        """
+        self.adaptive = adaptive
+        self.reorder_every = reorder_every
         self._filters = []
+        self._ncalls = 0
+        self._condition = None
     
-    def append(self, filter_fun):
-        """Add a filter function to the filters set."""
+    def append(self, filter_fun, reorder = True):
+        """Add a filter function to the filters set.
+        
+        Parameters:
+        filter_fun: a callable accepting a body.Body instance
+        reorder: if False the filter and the ones appended before and after
+                 it are never swapped.
+        """
         assert callable(filter_fun)
-        self._filters.append(filter_fun)
+        self._filters.append(_FilterStats(filter_fun, len(self._filters),
+                                          reorder))
         
     def __call__(self, body):
         """True if all the filters report True for the particular body."""        
+        self._ncalls += 1
+        if self.adaptive and self._ncalls % self.reorder_every == 0:
+            self.reorder()
+        
         for f in self._filters:
-            if not f(body):
+            start = time.time()
+            accepted = f.filter_fun(body)
+            f.total_time += time.time() - start
+            f.calls += 1
+            if not accepted:
+                f.rejections += 1
                 return False
         return True
     
+    def reorder(self):
+        """Sorts the filters by increasing expected cost, without moving any of
+        them across a filter appended with reorder=False."""
+        ordered = []
+        segment = []
+        for f in self._filters:
+            if f.reorder:
+                segment.append(f)
+            else:
+                ordered.extend(sorted(segment, key=_FilterStats.rank))
+                ordered.append(f)
+                segment = []
+        ordered.extend(sorted(segment, key=_FilterStats.rank))
+        self._filters = ordered
+    
+    @property
+    def filters(self):
+        """The filter functions, in their current evaluation order."""
+        return [f.filter_fun for f in self._filters]
+    
+    def statistics(self):
+        """Returns the statistics collected for each filter, the most
+        expensive first.
+        
+        Returns:
+        a list of dictionaries with the keys: name, position (the order of
+        append), calls, rejections, rejection_rate, mean_time and total_time 
+        (in seconds).
+        """
+        stats = [dict(name=getattr(f.filter_fun, "__name__", repr(f.filter_fun)),
+                      position=f.position,
+                      calls=f.calls,
+                      rejections=f.rejections,
+                      rejection_rate=f.rejection_rate,
+                      mean_time=f.mean_time,
+                      total_time=f.total_time)
+                 for f in self._filters]
+        if self._condition is not None:
+            f = self._condition
+            stats.append(dict(name=f.filter_fun, position=None, calls=f.calls,
+                              rejections=f.rejections,
+                              rejection_rate=f.rejection_rate,
+                              mean_time=f.mean_time,
+                              total_time=f.total_time))
+        return sorted(stats, key=lambda s: s["total_time"], reverse=True)
+    
+    def record_condition(self, condition, rows, selected, elapsed):
+        """Records an evaluation of the in-kernel condition of the bank (see
+        condition) in the statistics, as a stage named condition(...) with 
+        no position. Its calls and rejections are counted in rows.
+        
+        Parameters:
+        condition: the condition evaluated
+        rows: how many rows it was evaluated on
+        selected: how many of them it selected
+        elapsed: the time it took (seconds)
+        """
+        name = "condition(%s)" % condition
+        if self._condition is None or self._condition.filter_fun != name:
+            self._condition = _FilterStats(name, None, False)
+        self._condition.calls += rows
+        self._condition.rejections += rows - selected
+        self._condition.total_time += elapsed
+    
+    def spec(self):
+        """The specification of the bank (see filter_spec), None if any of the
+        filters has none. The order of the filters does not matter."""
+        specs = [filter_spec(f.filter_fun) for f in self._filters]
+        if None in specs:
+            return None
+        return ("MultiFilter", frozenset(specs))
+    
+    def condition(self):
+        """The in-kernel condition of the bank (see filter_condition): the 
+        conditions of the filters that have one, joined. It is exact if all
+        the filters have an exact one."""
+        conditions = []
+        exact = True
+        for f in self._filters:
+            condition, filter_exact = filter_condition(f.filter_fun)
+            if condition is None:
+                exact = False
+            else:
+                conditions.append("(%s)" % condition)
+                exact = exact and filter_exact
+        if len(conditions) == 0:
+            return None, False
+        return " & ".join(conditions), exact
+    
+    def reset_statistics(self):
+        """Forgets the statistics collected so far. The current order is 
+        kept."""
+        for f in self._filters:
+            f.calls = 0
+            f.rejections = 0
+            f.total_time = 0.0
+        self._condition = None
+    
     def filter(self, bodies):
         """Returns a list of bodies filtered according to this class."""
         return filter(self.__call__, bodies)
@@ -0,0 +1,67 @@
+import math
+import numpy as np
+
+#the azimuth step of the lookup table of the profiles (degrees)
+RESOLUTION = 0.1
+
+class HorizonProfile(object):
+    """The local horizon of a site: the altitude below which the sky is
+    hidden (by trees, buildings, hills...) as a function of the azimuth.
+
+    It is given by points (azimuth, altitude) in degrees, the azimuth from
+    the north through the east, linearly interpolated between them (across
+    the north too). The interpolation is computed once into a lookup table,
+    one value every RESOLUTION degrees, so that the altitudes of whole
+    catalogs over a grid of times are found with a single indexing (see
+    altitudes). The profiles of the locations are stored in the database,
+    see catalogs.MasterDatabase.set_horizon.
+
+    Attributes:
+    points: the (azimuth, altitude) points, sorted by azimuth
+    table: the minimum altitude at each step of the lookup table (radians)
+    """
+
+    def __init__(self, points, resolution = RESOLUTION):
+        """
+        Parameters:
+        points: an iterable of (azimuth, altitude) pairs, degrees. A single
+                point is a flat horizon.
+        resolution: the azimuth step of the lookup table (degrees)
+        """
+        points = sorted((float(az) % 360, float(alt)) for az, alt in points)
+        if len(points) == 0:
+            raise ValueError("A horizon profile needs at least one point")
+        self.points = tuple(points)
+        self.resolution = resolution
+        azimuths = np.array([p[0] for p in points])
+        altitudes = np.array([p[1] for p in points])
+        grid = np.arange(0, 360, resolution)
+        self.table = np.radians(np.interp(grid, azimuths, altitudes,
+                                          period=360))
+
+    def __repr__(self):
+        return "HorizonProfile: %d points, %.1f to %.1f degrees" % (
+            len(self.points), math.degrees(self.table.min()),
+            math.degrees(self.table.max()))
+
+    def spec(self):
+        """A hashable specification of the profile."""
+        return ("HorizonProfile", self.points, self.resolution)
+
+    def altitudes(self, azimuths):
+        """Returns the altitude of the horizon at some azimuths.
+
+        Parameters:
+        azimuths: an array of any shape, in radians
+
+        Returns:
+        an array of the same shape, in radians
+        """
+        with np.errstate(invalid="ignore"):
+            i = np.rint(np.nan_to_num(azimuths) *
+                        (180 / math.pi / self.resolution)).astype(int)
+        return self.table[i % len(self.table)]
+
+def flat(altitude):
+    """Returns a flat HorizonProfile, at altitude (degrees)."""
+    return HorizonProfile([(0, altitude)])
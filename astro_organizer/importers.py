@@ -0,0 +1,374 @@
+import os
+import re
+import sys
+import csv
+import time
+import logging
+import argparse
+import collections
+import weakref
+import numpy as np
+
+import body
+import catalogs
+
+#long catalog prefixes and the ones used in the SAC names
+_PREFIX_ALIASES = {"messier": "m",
+                   "melotte": "mel",
+                   "collinder": "cr",
+                   "col": "cr",
+                   "trumpler": "tr",
+                   "win": "winnecke",
+                   "berkeley": "berk",
+                   "barnard": "b"}
+
+#maximum length of a tour note
+_NOTE_LENGTH = 512
+
+_SEPARATORS = re.compile(r"[\s\-]+")
+_PREFIX = re.compile(r"([a-z]+)(\d.*)$")
+
+def _alias(key):
+    """Replaces the catalog prefix of a key without separators."""
+    match = _PREFIX.match(key)
+    if match is not None:
+        prefix, rest = match.groups()
+        if prefix in _PREFIX_ALIASES:
+            return _PREFIX_ALIASES[prefix] + rest
+    return key
+
+def normalize_designation(designation):
+    """Returns the form of a designation used by DesignationIndex: lower
+    case, without spaces and dashes, with the catalog prefix in the SAC
+    abbreviation (e.g. "Melotte 25" -> "mel25", "NGC  188" -> "ngc188")."""
+    return _alias(_SEPARATORS.sub("", designation.lower()))
+
+def normalize_column(column):
+    """normalize_designation on a column of strings."""
+    keys = np.char.replace(np.char.replace(np.char.lower(column), " ", ""),
+                           "-", "")
+    return [_alias(k) for k in keys.tolist()]
+
+#an entry of an observing list: its line number, the designations to try in
+#order and the note for the tour
+Entry = collections.namedtuple("Entry", "line designations note")
+
+class DesignationIndex(object):
+    """The bodies of the catalogs by normalized designation (see
+    normalize_designation), built with a single read of the name and
+    additional_names columns. The name of a body takes precedence over the
+    additional names of the others."""
+
+    def __init__(self, master_db, catalog = None):
+        """
+        Parameters:
+        master_db: a catalogs.MasterDatabase instance
+        catalog: if not None only this catalog is indexed
+        """
+        self._master_db = master_db
+        self.signature = _signature(master_db, catalog)
+        self._names = collections.defaultdict(list)
+        self._additional_names = collections.defaultdict(list)
+        for block in master_db.iter_chunks(catalog,
+                                           ["name", "additional_names"]):
+            for column, index in ((block["name"], self._names),
+                                  (block["additional_names"],
+                                   self._additional_names)):
+                for i, key in enumerate(normalize_column(column)):
+                    if key != "":
+                        index[key].append((block.catalog, block.start + i))
+
+    def __len__(self):
+        return len(self._names)
+
+    def replace(self, catalog, nrows, old_rows, new_rows):
+        """Updates the index after some rows of a catalog have been replaced,
+        instead of building it again. The signature is not changed.
+
+        Parameters:
+        catalog: the name of the catalog
+        nrows: the row numbers
+        old_rows: a structured array with the name and additional_names of
+                  the rows before, None if they have just been appended
+        new_rows: the same, after
+        """
+        for column, index in (("name", self._names),
+                              ("additional_names", self._additional_names)):
+            if old_rows is not None:
+                for nrow, key in zip(nrows,
+                                     normalize_column(old_rows[column])):
+                    refs = index.get(key)
+                    if refs is not None and (catalog, nrow) in refs:
+                        refs.remove((catalog, nrow))
+                        if len(refs) == 0:
+                            del index[key]
+            for nrow, key in zip(nrows, normalize_column(new_rows[column])):
+                if key != "":
+                    index[key].append((catalog, int(nrow)))
+
+    def lookup(self, designation):
+        """Returns the bodies matching a designation: those named so if any,
+        otherwise those with it as additional name.
+
+        Returns:
+        a list of body.Body instances
+        """
+        key = normalize_designation(designation)
+        refs = self._names.get(key) or self._additional_names.get(key, [])
+        return [self._master_db._body(self._master_db.get_catalog(c), n)
+                for c, n in refs]
+
+def _signature(master_db, catalog):
+    """Changes when the catalogs indexed by a DesignationIndex change."""
+    return tuple((t.name, body.table_token(t), t.nrows,
+                  body.table_generation(t))
+                 for t in master_db._catalog_tables(catalog))
+
+#the last DesignationIndex of each database, see get_index
+_indexes = weakref.WeakKeyDictionary()
+
+def get_index(master_db):
+    """Returns a DesignationIndex of all the catalogs of a database, reused
+    until any of them changes."""
+    index = _indexes.get(master_db)
+    if index is None or index.signature != _signature(master_db, None):
+        index = _indexes[master_db] = DesignationIndex(master_db)
+    return index
+
+def current_index(master_db):
+    """Returns the DesignationIndex of a database kept by get_index if it is
+    up to date, None otherwise."""
+    index = _indexes.get(master_db)
+    if index is None or index.signature != _signature(master_db, None):
+        return None
+    return index
+
+class ImportReport(object):
+    """The outcome of import_list.
+
+    Attributes:
+    tour: the tour.Tour the bodies were added to
+    added: the bodies added, in list order
+    unresolved: the entries no body matches
+    ambiguous: a list of (entry, bodies) for the entries that match more
+               than one body
+    seconds: how long the import took
+    """
+
+    def __init__(self, tour_obj):
+        self.tour = tour_obj
+        self.added = []
+        self.unresolved = []
+        self.ambiguous = []
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return "ImportReport: %s, %d added, %d unresolved, %d ambiguous" % (
+            self.tour.name, len(self.added), len(self.unresolved),
+            len(self.ambiguous))
+
+    @property
+    def complete(self):
+        """True if every entry has been added."""
+        return len(self.unresolved) == 0 and len(self.ambiguous) == 0
+
+    def summary(self):
+        """Returns a human readable report of the entries not added."""
+        lines = [repr(self)]
+        for e in self.unresolved:
+            lines.append("line %d: %s not found" % (e.line,
+                                                   " / ".join(e.designations)))
+        for e, bodies in self.ambiguous:
+            lines.append("line %d: %s matches %s" % (
+                e.line, " / ".join(e.designations),
+                ", ".join(b.name for b in bodies)))
+        return "\n".join(lines)
+
+def _join_note(*parts):
+    return "; ".join(p.strip() for p in parts if p and p.strip())
+
+def parse_caldwell(lines):
+    """Parses the Caldwell list, lines like "  6 = NGC 6543, the Cat's Eye
+    Neb.". Entries with only a common name (e.g. "Coalsack Dark Nebula") are
+    tried with their shorter prefixes too."""
+    for i, line in enumerate(lines, 1):
+        if "=" not in line:
+            continue
+        number, _, rest = line.partition("=")
+        designation, _, comment = rest.strip().partition(",")
+        designation = designation.strip()
+        designations = [designation]
+        if not re.search(r"\d", designation):
+            words = designation.split()
+            designations.extend(" ".join(words[:n])
+                                for n in xrange(len(words) - 1, 0, -1))
+        yield Entry(i, tuple(designations),
+                    _join_note("Caldwell %s" % number.strip(), comment))
+
+_BINOCULAR_LINE = re.compile(r"^(?P<name>\S.*?)\s+\d\d \d\d\.\d\s+[+-]\d\d \d\d"
+                             r"\s+\S+\s+(?P<type>\S+)\s+\S+\s+\S+\s+\d+\s+\d+"
+                             r"\s*(?P<note>.*)$")
+
+def parse_binocular_club(lines):
+    """Parses the list of the Astronomical League binocular club, a fixed
+    layout table: designation, position, magnitude, type, size,
+    constellation, chart numbers and an optional description."""
+    for i, line in enumerate(lines, 1):
+        match = _BINOCULAR_LINE.match(line.rstrip())
+        if match is None:
+            continue
+        yield Entry(i, (match.group("name"),), match.group("note"))
+
+def parse_sac_110(lines):
+    """Parses the SAC list of the 110 best NGC objects, a table: number, NGC
+    number, constellation, type, position (4 fields), magnitude, size and
+    notes."""
+    for i, line in enumerate(lines, 1):
+        fields = line.split(None, 10)
+        if len(fields) < 10 or not fields[0].isdigit():
+            continue
+        note = fields[10] if len(fields) > 10 else ""
+        yield Entry(i, ("NGC %s" % fields[1],),
+                    _join_note("SAC best %s" % fields[0], note))
+
+def parse_observing_list(lines):
+    """Parses an observing list exported as CSV with fields quoted by "|":
+    sequence, Messier number, difficulty, designation (an NGC number, or
+    "6530 / 6523", "IC 4725"...), name, ... and the notes last. The Messier
+    number is tried first. The sequence can be empty."""
+    reader = csv.reader(lines, quotechar="|")
+    for i, row in enumerate(reader, 1):
+        if len(row) < 5 or not (row[0].isdigit() or row[0] == ""):
+            continue
+        designations = []
+        if row[1].strip().isdigit():
+            designations.append("M %s" % row[1].strip())
+        for d in row[3].split("/"):
+            d = d.strip()
+            if d.isdigit():
+                designations.append("NGC %s" % d)
+            elif d not in ("", "-"):
+                designations.append(d)
+        if len(designations) == 0:
+            continue
+        yield Entry(i, tuple(designations), _join_note(row[4], row[-1]))
+
+#format name -> (parser, basename prefix or extension used to recognize it)
+FORMATS = {"caldwell": (parse_caldwell, "caldwell"),
+           "binocular_club": (parse_binocular_club, "al_binocular"),
+           "sac_110": (parse_sac_110, "sac_110"),
+           "observing_list": (parse_observing_list, ".csv")}
+
+def detect_format(filename):
+    """Returns the name of the format of an observing list from its file
+    name (see FORMATS)."""
+    basename = os.path.basename(filename).lower()
+    for name, (_, pattern) in FORMATS.iteritems():
+        if basename.startswith(pattern) or basename.endswith(pattern):
+            return name
+    raise ValueError("Unknown format of %s, choose one of %s" % (
+        filename, ", ".join(sorted(FORMATS))))
+
+def resolve_entries(entries, index):
+    """Resolves parsed entries with a DesignationIndex. For each entry the
+    designations are tried in order until one matches exactly one body.
+
+    Returns:
+    a tuple (resolved, unresolved, ambiguous): a list of (entry, body), a
+    list of entries and a list of (entry, bodies)
+    """
+    resolved = []
+    unresolved = []
+    ambiguous = []
+    for entry in entries:
+        candidates = None
+        for d in entry.designations:
+            found = index.lookup(d)
+            if len(found) == 1:
+                resolved.append((entry, found[0]))
+                break
+            if len(found) > 1 and candidates is None:
+                candidates = found
+        else:
+            if candidates is None:
+                unresolved.append(entry)
+            else:
+                ambiguous.append((entry, candidates))
+    return resolved, unresolved, ambiguous
+
+def import_list(master_db, filename, tour_name = None, title = "",
+                fmt = None, index = None, strict = False):
+    """Imports an observing list into a tour, in a single batch (see
+    catalogs.MasterDatabase.batch). The bodies are appended to the tour if
+    it exists already.
+
+    Parameters:
+    master_db: a catalogs.MasterDatabase instance
+    filename: the file of the list
+    tour_name: the name of the tour, the file name without extension if None
+    title: the title of a new tour
+    fmt: the name of the format (see FORMATS), guessed from the file name if
+         None
+    index: the DesignationIndex to use. If None the one of the database is
+           used (see get_index).
+    strict: if True nothing is imported unless all the entries are resolved,
+            ValueError is raised instead.
+
+    Returns:
+    an ImportReport
+    """
+    start = time.time()
+    if fmt is None:
+        fmt = detect_format(filename)
+    try:
+        parser = FORMATS[fmt][0]
+    except KeyError:
+        raise ValueError("Unknown format %s, choose one of %s" % (
+            fmt, ", ".join(sorted(FORMATS))))
+    if tour_name is None:
+        tour_name = os.path.splitext(os.path.basename(filename))[0]
+
+    with open(filename, "rU") as f:
+        entries = list(parser(f))
+    if index is None:
+        index = get_index(master_db)
+    resolved, unresolved, ambiguous = resolve_entries(entries, index)
+
+    if strict and (unresolved or ambiguous):
+        raise ValueError("%d entries of %s not resolved" % (
+            len(unresolved) + len(ambiguous), filename))
+
+    with master_db.batch():
+        tour_obj = master_db.get_tour(tour_name, title)
+        tour_obj.extend([b for _, b in resolved],
+                        [e.note[:_NOTE_LENGTH] for e, _ in resolved])
+
+    report = ImportReport(tour_obj)
+    report.added = [b for _, b in resolved]
+    report.unresolved = unresolved
+    report.ambiguous = ambiguous
+    report.seconds = time.time() - start
+    for line in report.summary().splitlines()[1:]:
+        logging.warn("%s: %s", filename, line)
+    return report
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m astro_organizer.importers",
+        description="Imports observing lists into tours, see import_list.")
+    parser.add_argument("database")
+    parser.add_argument("lists", nargs="+")
+    parser.add_argument("--format", choices=sorted(FORMATS), default=None,
+                        help="the format of the lists, guessed if missing")
+    parser.add_argument("--migrate", action="store_true",
+                        help="upgrade a database created by an older version")
+    args = parser.parse_args(argv)
+
+    db = catalogs.MasterDatabase(args.database, migrate=args.migrate)
+    for filename in args.lists:
+        print import_list(db, filename, fmt=args.format).summary()
+    db.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,30 +10,23 @@ from matplotlib.figure import Figure
 
 from .. import utils
 from .. import body
+from .. import session
 
 
 def plot_daily_altitude(element, observer):
     
     assert isinstance(element, body.Body)
     assert isinstance(observer, ephem.Observer)
-    observer = utils.copy_observer(observer)
     
     date_tuple = observer.date.tuple()
     start_time = utils.create_date("%d/%d/%d 0:00" % date_tuple[:3])
     #one day later
     end_time = ephem.Date(start_time+1)
-
-    ephem_body = element.ephem_body    
-    isinstance(ephem_body, ephem.Body)
     
-    altitudes = []
-    dtimes = []
-    all_times = np.linspace(start_time, end_time, 100)
-    for t in all_times:
-        observer.date = t
-        ephem_body.compute(observer)
-        altitudes.append(ephem_body.alt)
-        dtimes.append(ephem.localtime(ephem.Date(t)))
+    day = session.ObservingSession(observer, start_time, end_time,
+                                   step=1 / 99.0)
+    altitudes = day.body_altitudes(element)
+    dtimes = [ephem.localtime(ephem.Date(t)) for t in day.dates]
     
     altitudes = np.rad2deg(altitudes)
     fig = pylab.figure()
@@ -42,7 +35,7 @@ def plot_daily_altitude(element, observer):
     ax.plot_date(dtimes, altitudes, '-')    
     
     #sunrise and sunset
-    sunrise = ephem.localtime(utils.sunrise(observer))
+    sunset, sunrise = [ephem.localtime(t) for t in day.twilight]
     print "Sunrise: ", sunrise
     l = matplotlib.lines.Line2D([sunrise, sunrise],
                                 [-90, 90],
@@ -52,7 +45,6 @@ def plot_daily_altitude(element, observer):
                                 )
     ax.add_line(l)    
     
-    sunset = ephem.localtime(utils.sunset(observer))
     print "Sunset: ", sunset
     l = matplotlib.lines.Line2D([sunset, sunset],
                                 [-90, 90],
@@ -77,25 +69,16 @@ def plot_daily_altitude(element, observer):
 def plot_yearly_altitude(element, observer, hour=20):
     assert isinstance(element, body.Body)
     assert isinstance(observer, ephem.Observer)    
-    observer = utils.copy_observer(observer)
     
     date_tuple = observer.date.tuple()
     start_time = utils.create_date("%d/1/1 %d:00" % (date_tuple[0], hour))
     
     #one year later
-    end_time = ephem.Date(start_time+365)
-    
-    ephem_body = element.ephem_body    
-    isinstance(ephem_body, ephem.Body)
+    end_time = ephem.Date(start_time+364)
     
-    altitudes = []
-    dtimes = []
-    all_times = np.arange(start_time, end_time, 1)
-    for t in all_times:
-        observer.date = t
-        ephem_body.compute(observer)
-        altitudes.append(ephem_body.alt)
-        dtimes.append(ephem.localtime(ephem.Date(t)))
+    year = session.ObservingSession(observer, start_time, end_time, step=1)
+    altitudes = year.body_altitudes(element)
+    dtimes = [ephem.localtime(ephem.Date(t)) for t in year.dates]
     
     altitudes = np.rad2deg(altitudes)
     fig = pylab.figure()
@@ -0,0 +1,563 @@
+import time
+import ephem
+import numpy as np
+import numexpr
+
+import body
+import filters
+import columnar
+import storage
+import ephemerides
+import text_index
+
+#the kinds of predicates, by increasing cost: conditions on the columns,
+#evaluated by PyTables; predicates computed on arrays of rows; callables
+#called on each body.Body
+COLUMN, VECTORIZED, PER_BODY = range(3)
+
+_STAGE_NAMES = {COLUMN: "where", VECTORIZED: "vectorized",
+                PER_BODY: "per body"}
+
+#rows read at once by the vectorized predicates
+_BLOCK_ROWS = 4096
+
+
+class _Context(object):
+    """Where the predicates of a query read the rows of a catalog from: the
+    catalog in memory if there is one, the table otherwise. master_db is None
+    for a body.Body created without one: the rows are read from its table."""
+
+    def __init__(self, master_db, table):
+        self.master_db = master_db
+        self.table = table
+        self.catalog = table.name
+        if master_db is None:
+            self.columns = None
+        else:
+            self.columns = master_db._columns_of(table)
+        self._last = (None, None)
+
+    def read(self, nrows):
+        """Returns some rows, a structured array. The last rows read are
+        kept for the next predicate."""
+        if self._last[0] is nrows:
+            return self._last[1]
+        if self.columns is not None:
+            data = self.columns.data[nrows]
+        else:
+            with storage.hdf5_lock:
+                data = self.table.readCoordinates(nrows)
+        self._last = (nrows, data)
+        return data
+
+    def where(self, condition, start, stop):
+        """Returns the rows from start to stop matching a condition."""
+        if self.columns is not None:
+            return start + np.nonzero(self.columns.evaluate(condition, start,
+                                                            stop))[0]
+        with storage.hdf5_lock:
+            return self.table.getWhereList(condition, start=start, stop=stop)
+
+    def bodies(self, nrows):
+        if self.master_db is None:
+            return [body.Body(self.table, n) for n in nrows]
+        return [self.master_db._body(self.table, n) for n in nrows]
+
+    def ephemeris(self):
+        """The ephemerides.Ephemeris of the catalog, None for fixed 
+        objects."""
+        if self.master_db is None:
+            with storage.hdf5_lock:
+                return ephemerides.load(self.table)
+        return self.master_db.get_ephemeris(self.catalog)
+
+
+class Expression(object):
+    """A query expression, e.g. (mag < 9) & (body_type == "GALXY") &
+    observable(session). Expressions are combined with & (and), | (or) and
+    ~ (not), and so are plain filter functions (see filters) with them.
+
+    Each expression is of one of three kinds:
+    COLUMN: a condition on the columns of the catalog (see Column), run by
+            PyTables, in-kernel
+    VECTORIZED: computed at once on an array of rows, e.g. observable
+    PER_BODY: a callable called on each body.Body
+    An expression combining others is of the costliest kind among them.
+
+    A query runs as a Plan (see plan). An expression is also a filter: it can
+    be called on a body.Body, it has a specification and an in-kernel
+    condition (see filters.filter_spec and filters.filter_condition), so
+    that catalogs.MasterDatabase.filter_catalog runs its plan and caches the
+    result.
+    """
+
+    kind = PER_BODY
+    #the order of the vectorized predicates, the cheapest first
+    cost = 0
+
+    def __and__(self, other):
+        return And([self, _expression(other)])
+
+    def __rand__(self, other):
+        return And([_expression(other), self])
+
+    def __or__(self, other):
+        return Or([self, _expression(other)])
+
+    def __ror__(self, other):
+        return Or([_expression(other), self])
+
+    def __invert__(self):
+        return Not(self)
+
+    def __nonzero__(self):
+        raise TypeError("Query expressions are combined with &, | and ~, not "
+                        "with and, or, not or chained comparisons")
+
+    def mask(self, context, nrows):
+        """Returns a boolean array, True for the rows of nrows accepted. 
+        Abstract, every expression implements it.
+
+        Parameters:
+        context: a _Context on the catalog
+        nrows: an array of row numbers, not empty
+        """
+        raise NotImplementedError()
+
+    def spec(self):
+        """A hashable specification of the expression, None if any part of it
+        has none (see filters.filter_spec)."""
+        return None
+
+    def condition(self):
+        """The in-kernel condition of the expression, see
+        filters.filter_condition."""
+        if self.kind == COLUMN:
+            return self.expr, True
+        return None, False
+
+    def plan(self):
+        """Returns the Plan of the expression, compiled once."""
+        plan = self.__dict__.get("_plan")
+        if plan is None:
+            plan = self._plan = Plan(self)
+        return plan
+
+    def __call__(self, body_obj):
+        """True if the expression accepts a body.Body, like a filter."""
+        context = _Context(body_obj._master_db, body_obj._table)
+        return bool(self.mask(context, np.array([body_obj._nrow]))[0])
+
+
+class ColumnPredicate(Expression):
+    """A condition on the columns of a catalog, in the syntax of PyTables
+    (see tables.Table.where)."""
+
+    kind = COLUMN
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def __repr__(self):
+        return self.expr
+
+    def spec(self):
+        return ("where", self.expr)
+
+    def mask(self, context, nrows):
+        data = context.read(nrows)
+        return numexpr.evaluate(self.expr, local_dict=dict(
+            (c, data[c]) for c in data.dtype.names))
+
+
+class Column(object):
+    """A column of the catalogs in a query expression: comparing it with a
+    value or another column gives a ColumnPredicate."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+    def __compare(self, operator, other):
+        if isinstance(other, Column):
+            value = other.name
+        elif isinstance(other, basestring):
+            value = repr(str(other))
+        else:
+            value = repr(float(other))
+        return ColumnPredicate("%s %s %s" % (self.name, operator, value))
+
+    def __lt__(self, other):
+        return self.__compare("<", other)
+
+    def __le__(self, other):
+        return self.__compare("<=", other)
+
+    def __gt__(self, other):
+        return self.__compare(">", other)
+
+    def __ge__(self, other):
+        return self.__compare(">=", other)
+
+    def __eq__(self, other):
+        return self.__compare("==", other)
+
+    def __ne__(self, other):
+        return self.__compare("!=", other)
+
+    def isin(self, *values):
+        """The column is equal to any of the values."""
+        return Or([self == v for v in values])
+
+name = Column("name")
+additional_names = Column("additional_names")
+body_type = Column("body_type")
+constellation = Column("constellation")
+ra = Column("ra")
+dec = Column("dec")
+mag = Column("mag")
+central_star_mag = Column("central_star_mag")
+size_max_arcsec = Column("size_max_arcsec")
+size_min_arcsec = Column("size_min_arcsec")
+surface_brightness_mag = Column("surface_brightness_mag")
+
+
+class _Combination(Expression):
+
+    def __init__(self, children):
+        self.children = []
+        for c in children:
+            if type(c) is type(self):
+                self.children.extend(c.children)
+            else:
+                self.children.append(c)
+        self.kind = max(c.kind for c in self.children)
+        self.cost = max(c.cost for c in self.children)
+
+    def __repr__(self):
+        return "(%s)" % self.operator.join(repr(c) for c in self.children)
+
+    @property
+    def expr(self):
+        return self.operator.join("(%s)" % c.expr for c in self.children)
+
+    def spec(self):
+        specs = [filters.filter_spec(c) for c in self.children]
+        if None in specs:
+            return None
+        return (self.__class__.__name__, frozenset(specs))
+
+
+class And(_Combination):
+    """All the expressions. They are evaluated in turn, each on the rows
+    accepted by the ones before."""
+
+    operator = " & "
+
+    def condition(self):
+        conditions = ["(%s)" % c.expr for c in self.children
+                      if c.kind == COLUMN]
+        if len(conditions) == 0:
+            return None, False
+        return " & ".join(conditions), self.kind == COLUMN
+
+    def mask(self, context, nrows):
+        accepted = np.ones(len(nrows), bool)
+        for c in self.children:
+            if not accepted.any():
+                break
+            accepted[accepted] = c.mask(context, nrows[accepted])
+        return accepted
+
+
+class Or(_Combination):
+    """Any of the expressions. Each one is evaluated on the rows not
+    accepted yet."""
+
+    operator = " | "
+
+    def mask(self, context, nrows):
+        accepted = np.zeros(len(nrows), bool)
+        for c in self.children:
+            rest = ~accepted
+            if not rest.any():
+                break
+            accepted[rest] = c.mask(context, nrows[rest])
+        return accepted
+
+
+class Not(Expression):
+    """The negation of an expression."""
+
+    def __init__(self, child):
+        self.child = child
+        self.kind = child.kind
+        self.cost = child.cost
+
+    def __repr__(self):
+        return "~%r" % (self.child,)
+
+    @property
+    def expr(self):
+        return "~(%s)" % self.child.expr
+
+    def spec(self):
+        spec = filters.filter_spec(self.child)
+        if spec is None:
+            return None
+        return ("Not", spec)
+
+    def mask(self, context, nrows):
+        return ~self.child.mask(context, nrows)
+
+
+class _Callable(Expression):
+    """A filter function called on each body.Body."""
+
+    def __init__(self, filter_fun):
+        self.filter_fun = filter_fun
+
+    def __repr__(self):
+        return getattr(self.filter_fun, "__name__", repr(self.filter_fun))
+
+    def spec(self):
+        return filters.filter_spec(self.filter_fun)
+
+    def mask(self, context, nrows):
+        bodies = context.bodies(nrows)
+        if context.columns is not None or context.master_db is None:
+            return np.array([bool(self.filter_fun(b)) for b in bodies], bool)
+        #the bodies are read from a single read of the rows
+        with context.master_db._prefetching(context.table, nrows,
+                                            context.read(nrows)):
+            return np.array([bool(self.filter_fun(b)) for b in bodies], bool)
+
+
+def _expression(obj):
+    """Turns a filter function into an Expression. If it has an in-kernel
+    condition (see filters.filter_condition), the condition is evaluated
+    first, and the function only if the condition is not exact."""
+    if isinstance(obj, Expression):
+        return obj
+    if not callable(obj):
+        raise TypeError("%r is not a query expression nor a filter" % (obj,))
+    condition, exact = filters.filter_condition(obj)
+    if condition is None:
+        return _Callable(obj)
+    if exact:
+        return ColumnPredicate(condition)
+    return And([ColumnPredicate(condition), _Callable(obj)])
+
+def where(filter_fun):
+    """Returns the Expression of a filter function (see filters), e.g.
+    where(filters.messier_only()) & (mag < 6)."""
+    return _expression(filter_fun)
+
+
+class _Text(Expression):
+
+    kind = VECTORIZED
+    cost = 0
+
+    def __init__(self, master_db, query):
+        self.master_db = master_db
+        self.query = query
+        self.parsed = text_index.parse_query(query)
+
+    def __repr__(self):
+        return "text(%r)" % self.query
+
+    def spec(self):
+        return ("text_match", self.parsed,
+                text_index.notes_generation(self.master_db.db))
+
+    def mask(self, context, nrows):
+        #the index of the database the expression was created for
+        found = self.master_db.get_text_index(context.catalog).search(
+            self.parsed)
+        return np.in1d(nrows, found)
+
+def text(master_db, query):
+    """The notes, the additional notes or the NGC description match a text
+    query (see catalogs.MasterDatabase.search_text)."""
+    return _Text(master_db, query)
+
+
+class _MinScore(Expression):
+
+    kind = VECTORIZED
+    cost = 1
+
+    def __init__(self, scorer, score):
+        self.scorer = scorer
+        self.score = score
+
+    def __repr__(self):
+        return "min_score(%s, %s)" % (self.scorer, self.score)
+
+    def spec(self):
+        return ("min_visibility_score", self.scorer.spec(), self.score)
+
+    def mask(self, context, nrows):
+        return self.scorer.scores(context.catalog)[nrows] >= self.score
+
+def min_score(scorer, score):
+    """The visibility score of a scoring.NightScorer is at least score, see
+    filters.min_visibility_score."""
+    return _MinScore(scorer, score)
+
+
+class _TimeAboveHorizon(Expression):
+
+    kind = VECTORIZED
+    cost = 2
+
+    def __init__(self, night, minutes):
+        self.session = night
+        self.minutes = minutes
+
+    def __repr__(self):
+        if self.minutes == 0:
+            return "observable(%s)" % self.session
+        return "time_above_horizon(%s, %s)" % (self.session, self.minutes)
+
+    def spec(self):
+        return ("time_above_horizon", self.minutes) + self.session.spec()[1:]
+
+    def mask(self, context, nrows):
+        night = self.session
+        ephemeris = context.ephemeris()
+        data = context.read(nrows)
+        times = np.empty(len(nrows))
+        for first in xrange(0, len(nrows), _BLOCK_ROWS):
+            last = min(first + _BLOCK_ROWS, len(nrows))
+            ra, dec = night.positions(data["ra"][first:last],
+                                      data["dec"][first:last], ephemeris,
+                                      nrows[first:last])
+            times[first:last] = night.time_above_horizon(ra, dec)
+        if self.minutes == 0:
+            return times > 0
+        return times >= self.minutes * ephem.minute
+
+def observable(night):
+    """The body is above the horizon (and the horizon profile) of a
+    session.ObservingSession at one of its time steps at least. Unlike
+    filters.observable, all the rows are computed at once; a body up for less
+    than a step between two steps can be missed."""
+    return _TimeAboveHorizon(night, 0)
+
+def time_above_horizon(night, minutes):
+    """The body is above the horizon and the horizon profile of a
+    session.ObservingSession for at least some minutes of its time window,
+    see session.ObservingSession.time_above_horizon."""
+    return _TimeAboveHorizon(night, minutes)
+
+
+class Plan(object):
+    """How a query expression runs on a catalog. The conditions on the
+    columns of the top level conjunction are joined and run by PyTables
+    (in-kernel, or on the catalog in memory), then the vectorized predicates,
+    the cheapest first, on the rows left, then the callables on each body
+    left. An expression that is not a conjunction is a single stage of its
+    kind.
+
+    The plan runs on a chunk of rows at a time (see iter_execute). The row
+    counts and the time of each stage of the last run are kept for explain. 
+    A plan must not be run by several threads at once.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        if isinstance(expression, And):
+            conjuncts = expression.children
+        else:
+            conjuncts = [expression]
+        columns = [c for c in conjuncts if c.kind == COLUMN]
+        if len(columns) == 0:
+            self.where = None
+        else:
+            self.where = " & ".join("(%s)" % c.expr for c in columns)
+        self.stages = sorted([c for c in conjuncts if c.kind == VECTORIZED],
+                             key=lambda c: c.cost)
+        self.stages.extend(c for c in conjuncts if c.kind == PER_BODY)
+        self.catalog = None
+        self.statistics = []
+
+    def execute(self, master_db, catalog):
+        """Runs the plan on a catalog.
+
+        Returns:
+        an array of the row numbers accepted, sorted
+        """
+        chunks = list(self.iter_execute(master_db, catalog))
+        if len(chunks) == 0:
+            return np.zeros(0, np.int64)
+        return np.concatenate(chunks)
+
+    def iter_execute(self, master_db, catalog, start = 0, chunk_rows = None):
+        """Runs the plan on a catalog out of core: all the stages run on a
+        chunk of rows before the next chunk is read, so that the memory used
+        depends on the size of the chunks rather than on the size of the
+        catalog. The statistics add up over the chunks.
+
+        Parameters:
+        master_db: a catalogs.MasterDatabase
+        catalog: the name of the catalog
+        start: the first row
+        chunk_rows: how many rows are read at once, columnar.SCAN_ROWS if None
+
+        Returns:
+        a generator of arrays of the row numbers accepted in each chunk, 
+        sorted
+        """
+        table = master_db.get_catalog(catalog)
+        context = _Context(master_db, table)
+        chunk_rows = chunk_rows or columnar.SCAN_ROWS
+        deleted = master_db.deleted_rows(catalog)
+        self.catalog = catalog
+        self.statistics = statistics = [[0, 0, 0.0]
+                                        for _ in xrange(len(self.stages) + 1)]
+
+        for first in xrange(start, table.nrows, chunk_rows):
+            stop = min(first + chunk_rows, table.nrows)
+            begin = time.time()
+            if self.where is None:
+                nrows = np.arange(first, stop)
+            else:
+                nrows = context.where(self.where, first, stop)
+            gone = deleted[np.searchsorted(deleted, first):
+                           np.searchsorted(deleted, stop)]
+            if len(gone) != 0:
+                nrows = np.setdiff1d(nrows, gone)
+            statistics[0][0] += stop - first
+            statistics[0][1] += len(nrows)
+            statistics[0][2] += time.time() - begin
+
+            for stage, stage_statistics in zip(self.stages, statistics[1:]):
+                begin = time.time()
+                stage_statistics[0] += len(nrows)
+                if len(nrows) != 0:
+                    nrows = nrows[stage.mask(context, nrows)]
+                stage_statistics[1] += len(nrows)
+                stage_statistics[2] += time.time() - begin
+            yield nrows
+
+    def explain(self):
+        """Returns a description of the stages of the plan, with the rows in
+        and out of each one and its time in the last run."""
+        if self.catalog is None:
+            lines = ["Plan (not run yet)"]
+        else:
+            lines = ["Plan on %s" % self.catalog]
+        stages = [("where", self.where or "all rows")]
+        stages.extend((_STAGE_NAMES[s.kind], repr(s)) for s in self.stages)
+        for i, (kind, description) in enumerate(stages):
+            line = "%d. %-10s %s" % (i + 1, kind, description)
+            if i < len(self.statistics):
+                rows_in, rows_out, seconds = self.statistics[i]
+                line += ": %d -> %d rows, %.2f ms" % (rows_in, rows_out,
+                                                     seconds * 1000)
+            lines.append(line)
+        return "\n".join(lines)
@@ -0,0 +1,310 @@
+import ephem
+import math
+import logging
+import threading
+import numpy as np
+
+import body
+import fields
+import session
+
+#zenith brightness of the night sky (V mag/arcsec^2) in each Bortle class
+BORTLE_SKY = {1: 21.9, 2: 21.7, 3: 21.4, 4: 20.8, 5: 20.2, 6: 19.6, 7: 19.0,
+              8: 18.5, 9: 18.0}
+
+#V band extinction (magnitudes per airmass)
+EXTINCTION = 0.2
+
+#SAC surface brightnesses are per square arc minute
+_ARCMIN2 = 2.5 * math.log10(3600)
+
+#larger magnitudes are missing values in SAC (99.9, 79.9 for dark nebulae)
+_MISSING_MAG = 50
+
+#number of catalog rows scored at once
+_BLOCK_ROWS = 4096
+
+_COLUMNS = ["ra", "dec", "mag", "surface_brightness_mag", "size_max_arcsec",
+            "size_min_arcsec"]
+
+
+def airmass(alt):
+    """Returns the relative airmass at some altitudes (radians), with
+    Rozenberg's formula, which stays finite (40) at the horizon."""
+    s = np.sin(np.maximum(alt, 0))
+    return 1 / (s + 0.025 * np.exp(-11 * s))
+
+
+def _to_nanolamberts(sky):
+    return 34.08 * np.exp(20.7233 - 0.92104 * sky)
+
+
+def _to_magnitudes(brightness):
+    return (20.7233 - np.log(brightness / 34.08)) / 0.92104
+
+
+def sky_brightness(zenith_sky, alt, moon_alt, moon_phase, separation,
+                   extinction = EXTINCTION):
+    """Computes the brightness of the sky with the model of Krisciunas and
+    Schaefer (1991): the dark sky brightens towards the horizon and the Moon,
+    when it is up, adds the light scattered by the atmosphere.
+
+    Parameters:
+    zenith_sky: the brightness of the dark sky at the zenith (V mag/arcsec^2)
+    alt: the altitudes of the points of the sky (radians)
+    moon_alt: the altitude of the Moon (radians)
+    moon_phase: the illuminated fraction of the Moon (0 to 1)
+    separation: the angular distances of the points from the Moon (radians)
+    extinction: in magnitudes per airmass
+
+    The array arguments are broadcast together.
+
+    Returns:
+    the brightness of the sky at the points, in V mag/arcsec^2
+    """
+    x = airmass(alt)
+    dark = (_to_nanolamberts(zenith_sky) * x *
+            10 ** (-0.4 * extinction * (x - 1)))
+
+    alpha = np.degrees(np.arccos(np.clip(2 * np.asarray(moon_phase) - 1,
+                                         -1, 1)))
+    moon_light = 10 ** (-0.4 * (3.84 + 0.026 * alpha + 4e-9 * alpha ** 4))
+    scattering = (10 ** 5.36 * (1.06 + np.cos(separation) ** 2) +
+                  10 ** (6.15 - np.degrees(separation) / 40))
+    moon = (scattering * moon_light *
+            10 ** (-0.4 * extinction * airmass(moon_alt)) *
+            (1 - 10 ** (-0.4 * extinction * x)))
+    moon = np.where(np.asarray(moon_alt) > 0, moon, 0)
+    return _to_magnitudes(dark + moon)
+
+
+def limiting_magnitude_loss(sky, dark_sky = BORTLE_SKY[1]):
+    """Returns how many magnitudes of point sources are lost under a sky of
+    a given brightness (V mag/arcsec^2) compared to dark_sky, with
+    Schaefer's relation between the sky brightness and the naked eye
+    limiting magnitude."""
+    def nelm(b):
+        return 7.93 - 5 * np.log10(10 ** (4.316 - b / 5.0) + 1)
+    return nelm(dark_sky) - nelm(sky)
+
+
+class NightScorer(object):
+    """Scores how well the objects of the catalogs can be seen during a night
+    from a location, between 0 (invisible) and 1 (easy).
+
+    The night is sampled at regular time steps. The position and phase of the
+    Moon and the sidereal time at each step come from the
+    session.ObservingSession of the night, then for all the objects of a
+    catalog at once: the altitude and airmass, the
+    brightness of the sky around the object (the location's dark sky, see
+    BORTLE_SKY, plus the moonlight, see sky_brightness) and how far the
+    object, dimmed by the extinction, is above the visibility threshold:
+    - objects with a surface brightness, or with a size and a magnitude, are
+      extended: they must be less than contrast magnitudes per arcsec^2
+      fainter than the sky. Large objects are easier to detect: above one
+      arc minute the threshold grows by one magnitude for every factor of 10
+      in size.
+    - the others are point sources: they must be brighter than
+      limiting_mag, which is lowered on brighter skies (see
+      limiting_magnitude_loss).
+    The margin (in magnitudes) is mapped to the score with a logistic
+    function of width softness, and the score of the night is the best one of
+    the steps when the object is above the horizon and the horizon profile of
+    the session (see session.ObservingSession.minimum_altitudes). Objects
+    without a magnitude (e.g. dark nebulae) score 0.
+
+    The scores of a catalog are computed the first time they are needed and
+    kept until the catalog changes. score is meant to be used as a sort key
+    and filters.min_visibility_score as a filter.
+    """
+
+    def __init__(self, master_db, observer, start_time = None,
+                 end_time = None, bortle_class = 7, step = 15 * ephem.minute,
+                 limiting_mag = 13.0, contrast = 2.5, softness = 0.5,
+                 horizon = 10, extinction = EXTINCTION,
+                 horizon_profile = None):
+        """
+        Parameters:
+        master_db: a catalogs.MasterDatabase instance
+        observer: an ephem.Observer instance, or a session.ObservingSession
+                  whose time window and grid are used (start_time, end_time
+                  and step are then ignored)
+        start_time, end_time: the time window. If None, the dusk and the dawn
+                              of the night at the observer's date (see
+                              visibility.dark_window).
+        bortle_class: the Bortle class of the sky at the location (1 to 9)
+        step: the time step (days)
+        limiting_mag: the faintest point source visible on the darkest sky,
+                      13 is about the reach of a 20 cm telescope.
+        contrast: how much fainter than the sky (mag/arcsec^2) an extended
+                  object can be
+        softness: the width of the transition of the score (magnitudes)
+        horizon: the minimum altitude (degrees)
+        extinction: in magnitudes per airmass
+        horizon_profile: the local horizon, a horizon.HorizonProfile, or None.
+                         Ignored if observer is a session.ObservingSession,
+                         whose profile is used.
+        """
+        if bortle_class not in BORTLE_SKY:
+            raise ValueError("Wrong Bortle class %s" % bortle_class)
+        if not isinstance(observer, session.ObservingSession):
+            observer = session.ObservingSession(
+                observer, start_time, end_time, step=step,
+                horizon_profile=horizon_profile)
+        self._master_db = master_db
+        self.session = observer
+        self.bortle_class = bortle_class
+        self.zenith_sky = BORTLE_SKY[bortle_class]
+        self.limiting_mag = limiting_mag
+        self.contrast = contrast
+        self.softness = softness
+        self.horizon = horizon
+        self.extinction = extinction
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "NightScorer: %s %s - %s" % (self.session.observer.name,
+                                            self.session.start,
+                                            self.session.end)
+
+    def spec(self):
+        """A hashable specification of the scorer: two scorers with the same
+        specification give the same scores."""
+        return ("NightScorer", self.session.spec(), self.zenith_sky,
+                self.limiting_mag, self.contrast, self.softness, self.horizon,
+                self.extinction)
+
+    def scores(self, catalog):
+        """Returns the scores of all the objects of a catalog, an array
+        indexed by row number."""
+        return self.__catalog_scores(catalog)[0]
+
+    def best_times(self, catalog):
+        """Returns when each object of a catalog has its best score, an array
+        of ephem dates indexed by row number (NaN if the score is 0)."""
+        return self.__catalog_scores(catalog)[1]
+
+    def score(self, body_obj):
+        """Returns the score of a body.Body."""
+        return float(self.scores(body_obj._table.name)[body_obj._nrow])
+
+    def best(self, catalog, count = None, min_score = 0):
+        """Returns the bodies of a catalog sorted by decreasing score.
+
+        Parameters:
+        catalog: the name of the catalog
+        count: if not None, how many bodies at most
+        min_score: the bodies scoring less are left out. The invisible ones
+                   (score 0) are always left out, like the objects deleted
+                   by an update (see catalogs.MasterDatabase.deleted_rows).
+        """
+        scores = self.scores(catalog)
+        selected = (scores >= min_score) & (scores > 0)
+        selected[self._master_db.deleted_rows(catalog)] = False
+        nrows = np.nonzero(selected)[0]
+        nrows = nrows[np.argsort(-scores[nrows], kind="mergesort")]
+        if count is not None:
+            nrows = nrows[:count]
+        return self._master_db.get_bodies(catalog, nrows)
+
+    def best_fields(self, catalog, field_of_view, count = None,
+                    min_score = 0):
+        """Same as best, with the bodies in the same eyepiece field grouped
+        (see fields.group_bodies), so that each group is a single stop.
+
+        Parameters:
+        catalog: the name of the catalog
+        field_of_view: the diameter of the field (arc minutes)
+        count: if not None, how many groups at most
+        min_score: the bodies scoring less are left out, see best
+
+        Returns:
+        a list of fields.FieldGroup sorted by the decreasing score of their
+        best body, their bodies sorted by decreasing score too
+        """
+        groups = fields.group_bodies(self.best(catalog, min_score=min_score),
+                                     field_of_view)
+        #the bodies and thus the groups are in order of score already
+        if count is not None:
+            groups = groups[:count]
+        return groups
+
+    def __catalog_scores(self, catalog):
+        table = self._master_db.get_catalog(catalog)
+        generation = body.table_generation(table)
+        with self._lock:
+            cached = self._scores.get(catalog)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        logging.debug("Scoring %s for %s", catalog, self)
+        ephemeris = self._master_db.get_ephemeris(catalog)
+        scores = np.zeros(table.nrows)
+        best_times = np.empty(table.nrows)
+        best_times.fill(np.nan)
+        for block in self._master_db.iter_chunks(catalog, _COLUMNS,
+                                                 _BLOCK_ROWS):
+            first, last = block.start, block.start + len(block)
+            scores[first:last], best_times[first:last] = self.__score_block(
+                block, ephemeris)
+
+        with self._lock:
+            self._scores[catalog] = (generation, (scores, best_times))
+        return scores, best_times
+
+    def __score_block(self, block, ephemeris):
+        """Scores a columnar.RecordBlock, in a (objects x steps) pass."""
+        night = self.session
+        dates = night.dates
+        if ephemeris is None:
+            ra, dec = night.apparent_positions(block["ra"], block["dec"])
+            ra, dec = ra[:, np.newaxis], dec[:, np.newaxis]
+            mag = block["mag"][:, np.newaxis]
+        else:
+            ra, dec = ephemeris.positions(dates, block.nrows)
+            shape = ra.shape
+            ra, dec = night.apparent_positions(ra.ravel(), dec.ravel())
+            ra, dec = ra.reshape(shape), dec.reshape(shape)
+            mag = ephemeris.magnitudes(dates, block.nrows)
+        mag = np.where(mag < _MISSING_MAG, mag, np.nan)
+
+        #surface brightness in mag/arcsec^2, from the size if needed
+        size_max = block["size_max_arcsec"]
+        size_min = np.where(np.isnan(block["size_min_arcsec"]), size_max,
+                            block["size_min_arcsec"])
+        catalog_mag = np.where(block["mag"] < _MISSING_MAG, block["mag"],
+                               np.nan)
+        sb = block["surface_brightness_mag"] + _ARCMIN2
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sb = np.where(np.isnan(sb), catalog_mag + 2.5 * np.log10(
+                math.pi / 4 * size_max * size_min), sb)[:, np.newaxis]
+        extended = ~np.isnan(sb)
+        with np.errstate(invalid="ignore"):
+            threshold = self.contrast + np.log10(
+                np.fmax(size_max / 60.0, 1))[:, np.newaxis]
+
+        moon = night.moon
+        alt, az = night.alt_az(ra, dec)
+        separation = np.arccos(np.clip(
+            np.sin(dec) * np.sin(moon.dec) +
+            np.cos(dec) * np.cos(moon.dec) * np.cos(ra - moon.ra), -1, 1))
+        sky = sky_brightness(self.zenith_sky, alt, moon.alt, moon.phase,
+                             separation, self.extinction)
+        dimming = self.extinction * airmass(alt)
+
+        with np.errstate(invalid="ignore"):
+            margin = np.where(
+                extended,
+                sky + threshold - (sb + dimming),
+                self.limiting_mag - limiting_magnitude_loss(sky) -
+                (mag + dimming))
+            score = 1 / (1 + np.exp(-margin / self.softness))
+            up = alt > night.minimum_altitudes(az, self.horizon)
+            score = np.where(up & ~np.isnan(score), score, 0)
+
+        best = np.argmax(score, axis=1)
+        rows = np.arange(len(score))
+        night_score = score[rows, best]
+        best_times = np.where(night_score > 0, dates[best], np.nan)
+        return night_score, best_times
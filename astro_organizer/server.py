@@ -0,0 +1,317 @@
+import sys
+import json
+import math
+import Queue
+import urlparse
+import argparse
+import logging
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
+import numpy as np
+import tables
+
+import catalogs
+import filters
+import utils
+
+#name -> (filter factory, type of its parameters), see parse_filter
+FILTERS = {"messier_only": (filters.messier_only, None),
+           "limit_magnitude": (filters.limit_magnitude, float),
+           "limit_surface_brightness": (filters.limit_surface_brightness,
+                                        float),
+           "min_size": (filters.min_size, float),
+           "max_size": (filters.max_size, float),
+           "body_type": (filters.body_type, str),
+           "constellation": (filters.constellation, str)}
+
+def parse_filter(text):
+    """Creates a filter from its textual form, the name of a function in
+    FILTERS followed by its parameters separated by commas, e.g.
+    "limit_magnitude:8" or "body_type:GALXY,GLOCL"."""
+    name, _, params = text.partition(":")
+    try:
+        factory, param_type = FILTERS[name]
+    except KeyError:
+        raise ValueError("Unknown filter %s, choose one of %s" % (
+            name, ", ".join(sorted(FILTERS))))
+    if param_type is None:
+        return factory()
+    return factory(*[param_type(p) for p in params.split(",") if p != ""])
+
+def body_to_dict(body_obj):
+    """Returns the fields of a body as a dictionary that can be converted to
+    JSON, with its position in the database under "table" (the name of the 
+    catalog table) and "nrow". Missing numeric values (NaN) become None."""
+    ret = {"table": body_obj._table.name, "nrow": body_obj._nrow}
+    for name in body_obj.field_names:
+        value = getattr(body_obj, name)
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float) and math.isnan(value):
+            value = None
+        ret[name] = value
+    return ret
+
+def prepare_database(database):
+    """Opens a database for writing once, so that the catalogs and tours 
+    created by an older version are upgraded (see 
+    catalogs.MasterDatabase.migrate) before it is served read-only."""
+    db = catalogs.MasterDatabase(database, migrate=True)
+    db.close()
+
+class ResponseCache(object):
+    """A thread-safe LRU cache of the responses, by request path."""
+
+    def __init__(self, size = 1024):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.size == 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+class NotFound(Exception):
+    pass
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the GET requests of QueryServer. Each handler method receives 
+    the MasterDatabase and the query parameters (a dictionary name -> list of
+    values) and returns (content type, body)."""
+
+    protocol_version = "HTTP/1.1"
+    #each response is written at once, without waiting for the client ACK
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        route = self.server.routes.get(url.path)
+        if route is None:
+            return self.__send(404, {"error": "Unknown path %s" % url.path})
+
+        cached = self.server.cache.get(self.path)
+        if cached is not None:
+            return self.__send_raw(200, *cached)
+
+        params = urlparse.parse_qs(url.query)
+        try:
+            content_type, body = getattr(self, route)(self.server.db, params)
+        except (NotFound, tables.NoSuchNodeError) as e:
+            return self.__send(404, {"error": str(e)})
+        except (ValueError, TypeError, KeyError) as e:
+            return self.__send(400, {"error": str(e)})
+        except Exception as e:
+            logging.exception("Error serving %s", self.path)
+            return self.__send(500, {"error": str(e)})
+
+        self.server.cache.put(self.path, (content_type, body))
+        self.__send_raw(200, content_type, body)
+
+    def __send(self, code, obj):
+        self.__send_raw(code, "application/json", json.dumps(obj))
+
+    def __send_raw(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    @staticmethod
+    def __single(params, name, default = None):
+        values = params.get(name)
+        if not values:
+            if default is None:
+                raise ValueError("Missing parameter %s" % name)
+            return default
+        return values[0]
+
+    def catalogs(self, db, params):
+        return "application/json", json.dumps(sorted(db.list_catalogs()))
+
+    def find(self, db, params):
+        """name: the name to look for, catalog: optional"""
+        name = self.__single(params, "name")
+        catalog = params.get("catalog", [None])[0]
+        found = sorted(db.find_body(name, catalog),
+                       key=lambda b: (b._table.name, b._nrow))
+        return "application/json", json.dumps([body_to_dict(b)
+                                               for b in found])
+
+    def query(self, db, params):
+        """catalog: the catalog to filter, filter: any number of filters (see
+        parse_filter), offset and limit: optional, to return only a part of
+        the result."""
+        catalog = self.__single(params, "catalog")
+        master_filter = filters.MultiFilter()
+        for text in params.get("filter", []):
+            master_filter.append(parse_filter(text))
+        found = db.filter_catalog(catalog, master_filter)
+        offset = int(self.__single(params, "offset", 0))
+        limit = int(self.__single(params, "limit", len(found)))
+        return "application/json", json.dumps(
+            {"total": len(found),
+             "bodies": [body_to_dict(b) for b in found[offset:offset + limit]]
+             })
+
+    def tours(self, db, params):
+        return "application/json", json.dumps(sorted(db.list_tours()))
+
+    def __get_tour(self, db, params):
+        name = self.__single(params, "name")
+        if name not in db.list_tours():
+            raise NotFound("No tour %s" % name)
+        return db.get_tour(name)
+
+    def tour(self, db, params):
+        """name: the name of the tour"""
+        tour_obj = self.__get_tour(db, params)
+        entries = []
+        for b, note in tour_obj.iteritems():
+            entry = body_to_dict(b)
+            entry["tour_note"] = note
+            entries.append(entry)
+        return "application/json", json.dumps({"name": tour_obj.name,
+                                               "title": tour_obj.title,
+                                               "bodies": entries})
+
+    def skysafari(self, db, params):
+        """Either name, the name of a tour, or body, any number of body names
+        (each must match exactly one body)."""
+        if "name" in params:
+            return "text/plain", self.__get_tour(db, params).sky_safari_entry()
+        found = db.resolve_names(params.get("body", []))
+        bodies = []
+        for name in params.get("body", []):
+            if len(found[name]) != 1:
+                raise NotFound("%d bodies found with name %s" % (
+                    len(found[name]), name))
+            bodies.extend(found[name])
+        return "text/plain", utils.create_sky_safari_list(bodies)
+
+class _ThreadPoolMixIn(SocketServer.ThreadingMixIn):
+    """Serves the connections with a fixed number of threads."""
+    
+    def start_workers(self, workers):
+        self._connections = Queue.Queue()
+        for _ in xrange(workers):
+            t = threading.Thread(target=self.__work)
+            t.daemon = True
+            t.start()
+    
+    def __work(self):
+        while True:
+            request, client_address = self._connections.get()
+            self.process_request_thread(request, client_address)
+    
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+class QueryServer(_ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
+    """A read-only HTTP/JSON service on a database, for several clients at
+    once. The database is opened read-only with the catalogs in memory (see 
+    the in_memory parameter of catalogs.MasterDatabase), the connections are
+    served by a pool of threads (the reads from the file are serialized, 
+    see storage.hdf5_lock), and 
+    the responses are cached (the database is not expected to change while 
+    it is served).
+
+    Paths (GET, parameters in the query string):
+    /catalogs: the names of the catalogs
+    /find?name=M31[&catalog=sac]: the bodies matching a name
+    /query?catalog=sac&filter=min_size:5&filter=body_type:GALXY[&offset=0]
+        [&limit=50]: filtered bodies, see parse_filter
+    /tours: the names of the tours
+    /tour?name=TOUR: the bodies of a tour with their notes
+    /skysafari?name=TOUR or /skysafari?body=M31&body=M42: a SkySafari list
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    routes = {"/catalogs": "catalogs",
+              "/find": "find",
+              "/query": "query",
+              "/tours": "tours",
+              "/tour": "tour",
+              "/skysafari": "skysafari"}
+
+    def __init__(self, address, database, workers = 8, cache_size = 1024,
+                 migrate = False):
+        """
+        Parameters:
+        address: a (host, port) tuple. Port 0 picks a free port, see
+                 server_address.
+        database: the file name of the database
+        workers: how many threads serve the connections
+        cache_size: how many responses are cached
+        migrate: if True, the database is upgraded first if it was created 
+                 by an older version (see prepare_database). Otherwise such
+                 a database raises ValueError.
+        """
+        if migrate:
+            prepare_database(database)
+        self.db = catalogs.MasterDatabase(tables.openFile(database, "r"),
+                                          in_memory=True)
+        self.cache = ResponseCache(cache_size)
+        BaseHTTPServer.HTTPServer.__init__(self, address, _RequestHandler)
+        self.start_workers(workers)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.db.close()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m astro_organizer.server",
+        description="Serves a database over HTTP/JSON, see QueryServer.")
+    parser.add_argument("database")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=8,
+                        help="how many threads serve the connections")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="how many responses are cached")
+    parser.add_argument("--migrate", action="store_true",
+                        help="upgrade a database created by an older "
+                        "version before serving it")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    server = QueryServer((args.host, args.port), args.database, args.workers,
+                         args.cache_size, args.migrate)
+    logging.info("Serving %s on http://%s:%d/", args.database,
+                 *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+import ephem
+import math
+import collections
+import numpy as np
+from scipy import optimize
+
+import body
+import utils
+import visibility
+
+def _memoized(method):
+    """Turns a method without parameters of ObservingSession into a read-only
+    property, computed the first time it is read."""
+    name = method.__name__
+    def getter(self):
+        try:
+            return self._memo[name]
+        except KeyError:
+            pass
+        self.computed[name] += 1
+        value = self._memo[name] = method(self)
+        return value
+    getter.__doc__ = method.__doc__
+    return property(getter)
+
+def _memoized_per_body(method):
+    """Like _memoized, for a method of ObservingSession whose only parameter
+    is a body.Body."""
+    name = method.__name__
+    def wrapper(self, body_obj):
+        key = (name, body_obj)
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        self.computed[name] += 1
+        value = self._memo[key] = method(self, body_obj)
+        return value
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+MoonTrack = collections.namedtuple("MoonTrack", "ra dec alt phase")
+
+class ObservingSession(object):
+    """An observer and a time window, with everything derived from them
+    computed once and shared by the filters (see filters.observable), the
+    planners (see scoring.NightScorer), the graphs and the exports: the dates
+    are parsed once, the observer is copied once, and the twilight, the grid
+    of times with its sidereal times, the track of the Moon and, for each
+    body, its altitudes, rising and setting are computed the first time they
+    are needed.
+
+    computed counts how many times each quantity has been computed (once
+    per session, once per body for the per-body ones).
+
+    A session must not be shared among threads.
+    """
+
+    def __init__(self, observer, start_time = None, end_time = None,
+                 horizon = None, step = 10 * ephem.minute,
+                 horizon_profile = None):
+        """
+        Parameters:
+        observer: an ephem.Observer instance, e.g. from
+                  catalogs.MasterDatabase.create_observer
+        start_time, end_time: the time window, values that
+                              utils.create_date accepts. If None, the dusk and
+                              the dawn of the night at the observer's date
+                              (see visibility.dark_window).
+        horizon: the minimum altitude (degrees). If None, the one of the
+                 observer.
+        step: the time step of the grid (days)
+        horizon_profile: if not None, a horizon.HorizonProfile: the local
+                         horizon (trees, buildings...), above horizon. The
+                         bodies are then up when they are above both, on
+                         the grid of times (see time_above_horizon).
+        """
+        assert isinstance(observer, ephem.Observer)
+        self.computed = collections.Counter()
+        self._memo = {}
+        self.observer = utils.copy_observer(observer)
+        self._date = observer.date
+        if horizon is not None:
+            self.observer.horizon = str(horizon)
+        #radians, like the altitudes
+        self.horizon = float(self.observer.horizon)
+        self.horizon_profile = horizon_profile
+
+        if start_time is None:
+            start_time = self.twilight[0]
+        if end_time is None:
+            end_time = self.twilight[1]
+        self.start = utils.create_date(start_time)
+        self.end = utils.create_date(end_time)
+        if self.end < self.start:
+            raise ValueError("The time window is empty")
+        self.step = step
+        self.observer.date = self.start
+
+    def __repr__(self):
+        return "ObservingSession: %s %s - %s" % (self.observer.name,
+                                                 self.start, self.end)
+
+    def spec(self):
+        """A hashable specification of the session: two sessions with the
+        same specification compute the same quantities. The dates are rounded
+        to the minute, so that the specifications of close time windows
+        match."""
+        return ("ObservingSession", float(self.observer.lat),
+                float(self.observer.lon), self.observer.elev, self.horizon,
+                int(round(self.start / ephem.minute)),
+                int(round(self.end / ephem.minute)), self.step,
+                self.horizon_profile and self.horizon_profile.spec())
+
+    @_memoized
+    def twilight(self):
+        """The astronomical dusk and dawn of the night at the observer's
+        date, see visibility.dark_window."""
+        self.observer.date = self._date
+        return visibility.dark_window(self.observer)
+
+    @_memoized
+    def dates(self):
+        """The grid of times: the time window in steps, ephem dates."""
+        nsteps = int(math.ceil((self.end - self.start) / self.step)) + 1
+        return np.linspace(self.start, self.end, nsteps)
+
+    @_memoized
+    def sidereal_times(self):
+        """The local sidereal time at each time of the grid (radians)."""
+        self.observer.date = self.start
+        return (float(self.observer.sidereal_time()) +
+                (self.dates - self.start) * visibility._SIDEREAL_RATE)
+
+    @_memoized
+    def moon(self):
+        """The Moon at each time of the grid, a MoonTrack of arrays: the
+        apparent geocentric position (radians), the altitude (radians) and the
+        illuminated fraction."""
+        moon = ephem.Moon()
+        track = MoonTrack(*[np.empty(len(self.dates)) for _ in xrange(4)])
+        for i, date in enumerate(self.dates):
+            self.observer.date = date
+            moon.compute(self.observer)
+            track.ra[i] = moon.g_ra
+            track.dec[i] = moon.g_dec
+            track.alt[i] = moon.alt
+            track.phase[i] = moon.moon_phase
+        return track
+
+    def apparent_positions(self, ra, dec):
+        """Precesses J2000 positions to the middle of the time window, see
+        visibility.apparent_positions."""
+        return visibility.apparent_positions(ra, dec,
+                                             (self.start + self.end) / 2)
+
+    def altitudes(self, ra, dec):
+        """Computes the altitudes of apparent positions at each time of the
+        grid, without refraction.
+
+        Parameters:
+        ra, dec: arrays of apparent positions (radians), or (objects x times)
+                 arrays for the objects that move
+
+        Returns:
+        an (objects x times) array, in radians
+        """
+        ra = np.asarray(ra)
+        dec = np.asarray(dec)
+        if ra.ndim == 1:
+            ra = ra[:, np.newaxis]
+            dec = dec[:, np.newaxis]
+        lat = float(self.observer.lat)
+        return np.arcsin(np.clip(
+            math.sin(lat) * np.sin(dec) +
+            math.cos(lat) * np.cos(dec) * np.cos(self.sidereal_times - ra),
+            -1, 1))
+
+    def alt_az(self, ra, dec):
+        """Same as altitudes, with the azimuths too (radians, from the north
+        through the east).
+
+        Returns:
+        a tuple of (objects x times) arrays (altitudes, azimuths)
+        """
+        ra = np.asarray(ra)
+        dec = np.asarray(dec)
+        if ra.ndim == 1:
+            ra = ra[:, np.newaxis]
+            dec = dec[:, np.newaxis]
+        lat = float(self.observer.lat)
+        hour_angle = self.sidereal_times - ra
+        alt = np.arcsin(np.clip(
+            math.sin(lat) * np.sin(dec) +
+            math.cos(lat) * np.cos(dec) * np.cos(hour_angle), -1, 1))
+        az = np.arctan2(-np.cos(dec) * np.sin(hour_angle),
+                        np.sin(dec) * math.cos(lat) -
+                        np.cos(dec) * np.cos(hour_angle) * math.sin(lat))
+        return alt, az % (2 * math.pi)
+
+    def minimum_altitudes(self, az, horizon = None):
+        """Returns the altitude a body must be above to be up, at some
+        azimuths: the horizon and the horizon profile, the highest, lowered
+        by the refraction (the altitudes computed here don't include it).
+
+        Parameters:
+        az: an array of azimuths (radians)
+        horizon: the horizon (degrees), the one of the session if None
+        """
+        if horizon is None:
+            minimum = self.horizon
+        else:
+            minimum = math.radians(horizon)
+        if self.horizon_profile is not None:
+            minimum = np.maximum(minimum, self.horizon_profile.altitudes(az))
+        return minimum - visibility._REFRACTION
+
+    def time_above_horizon(self, ra, dec):
+        """Returns how long objects are above the horizon and the horizon
+        profile in the time window, sampled on the grid of times.
+
+        Parameters:
+        ra, dec: apparent positions, see altitudes
+
+        Returns:
+        an array of durations, one per object (days)
+        """
+        alt, az = self.alt_az(ra, dec)
+        with np.errstate(invalid="ignore"):
+            up = alt > self.minimum_altitudes(az)
+        #each time of the grid counts for a step, the only one of a time
+        #window without duration too
+        if len(self.dates) < 2:
+            return up.sum(axis=1) * self.step
+        return up.sum(axis=1) * (self.dates[1] - self.dates[0])
+
+    def catalog_time_above_horizon(self, master_db, catalog):
+        """Same as time_above_horizon for all the objects of a catalog, an
+        array indexed by row number. It is computed in blocks of rows once,
+        and again when the catalog changes."""
+        table = master_db.get_catalog(catalog)
+        key = ("catalog_time_above_horizon", catalog)
+        cached = self._memo.get(key)
+        generation = body.table_generation(table)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        self.computed["catalog_time_above_horizon"] += 1
+        ephemeris = master_db.get_ephemeris(catalog)
+        times = np.zeros(table.nrows)
+        for block in master_db.iter_chunks(catalog, ["ra", "dec"]):
+            ra, dec = self.positions(block["ra"], block["dec"], ephemeris,
+                                     block.nrows)
+            times[block.start:block.start + len(block)] = \
+                self.time_above_horizon(ra, dec)
+        self._memo[key] = (generation, times)
+        return times
+
+    def positions(self, ra, dec, ephemeris = None, nrows = None):
+        """Returns the apparent positions of objects (see
+        apparent_positions): of fixed objects from their J2000 positions, of
+        moving objects at each time of the grid from their ephemeris.
+
+        Parameters:
+        ra, dec: the J2000 positions (radians), used if ephemeris is None
+        ephemeris: an ephemerides.Ephemeris, or None
+        nrows: with ephemeris, the row numbers of the objects
+
+        Returns:
+        arrays of positions, (objects x times) arrays for moving objects
+        """
+        if ephemeris is None:
+            return self.apparent_positions(ra, dec)
+        ra, dec = ephemeris.positions(self.dates, nrows)
+        shape = ra.shape
+        ra, dec = self.apparent_positions(ra.ravel(), dec.ravel())
+        return ra.reshape(shape), dec.reshape(shape)
+
+    def __body_positions(self, body_obj):
+        return self.positions([body_obj.ra], [body_obj.dec],
+                              body_obj.ephemeris, [body_obj._nrow])
+
+    @_memoized_per_body
+    def body_altitudes(self, body_obj):
+        """The altitudes of a body.Body at each time of the grid (radians)."""
+        return self.altitudes(*self.__body_positions(body_obj))[0]
+
+    @_memoized_per_body
+    def body_time_above_horizon(self, body_obj):
+        """How long a body.Body is above the horizon and the horizon profile
+        in the time window (days), see time_above_horizon."""
+        return float(self.time_above_horizon(
+            *self.__body_positions(body_obj))[0])
+
+    @_memoized_per_body
+    def rise_set(self, body_obj):
+        """The rising and setting of a fixed body.Body around the start of the
+        time window: a tuple (rising, setting) of ephem dates, (None, None) if
+        the body never rises, (True, True) if it never sets. The rising is
+        after the setting if the body is down at the start."""
+        ephem_body = body_obj.ephem_body
+        self.observer.date = self.start
+        try:
+            setting = self.observer.next_setting(ephem_body, use_center=True)
+            rising = self.observer.next_rising(ephem_body, use_center=True)
+        except ephem.NeverUpError:
+            return None, None
+        except ephem.AlwaysUpError:
+            return True, True
+        if rising > setting:
+            rising = self.observer.previous_rising(ephem_body,
+                                                   use_center=True)
+        return rising, setting
+
+    def is_up(self, body_obj):
+        """Returns True if a body.Body is above the horizon at least once in
+        the time window. Moving bodies (see body.Body.ephemeris) are checked
+        every 10 minutes. With a horizon profile, the bodies are checked at
+        the times of the grid (see body_time_above_horizon)."""
+        if self.horizon_profile is not None:
+            return self.body_time_above_horizon(body_obj) > 0
+        ephemeris = body_obj.ephemeris
+        if ephemeris is not None:
+            return visibility.moving_body_up(ephemeris, body_obj._nrow,
+                                             self.observer, self.start,
+                                             self.end, self.horizon)
+        rising, setting = self.rise_set(body_obj)
+        if rising is None:
+            return False
+        if rising is True:
+            return True
+        #====rise========set=======#
+        #========observe======stop=#
+        cond1 = rising < self.start < setting
+
+        #===========rise========set=======#
+        #===observe========stop===========#
+        cond2 = self.start < rising < self.end
+
+        return cond1 or cond2
+
+    @_memoized_per_body
+    def best_time(self, body_obj):
+        """Returns when a body.Body is highest in the time window, an
+        ephem.Date. The best time of the grid is refined with PyEphem (at
+        the position of the grid time for the moving bodies)."""
+        altitudes = self.body_altitudes(body_obj)
+        i = int(np.argmax(altitudes))
+        if self.end == self.start:
+            return ephem.Date(self.start)
+
+        ephem_body = body_obj.ephem_body_at(self.dates[i])
+        def neg_altitude(time):
+            self.observer.date = time[0]
+            ephem_body.compute(self.observer)
+            return -ephem_body.alt
+
+        bounds = (max(self.start, self.dates[i] - self.step),
+                  min(self.end, self.dates[i] + self.step))
+        best_time = optimize.fmin_l_bfgs_b(neg_altitude, [self.dates[i]],
+                                           bounds=[bounds],
+                                           approx_grad=True,
+                                           epsilon=ephem.minute
+                                           )
+        return ephem.Date(best_time[0][0])
@@ -1,5 +1,7 @@
 import socket
+import select
 import logging
+import collections
 import datetime
 import time
 
@@ -10,17 +12,46 @@ import utils
 
 
 class SkyChartClient(object):
-    
-    def __init__(self, 
+    """A client of the SkyChart (Cartes du Ciel) TCP server. The server
+    answers each command with one line, in the order of the commands: the
+    commands are sent without waiting and kept in a queue until their answer
+    arrives (see send and poll), so that many commands can be sent back to
+    back. search and setdate wait for the answer unless block is False.
+
+    The date last sent to SkyChart is remembered and setdate does not send
+    it again. If the date is changed in SkyChart itself, use force.
+
+    A client must not be shared among threads.
+
+    Attributes:
+    pending: the commands still waiting for their answer, a deque of
+             (command, callback) tuples
+    date: the date string last set, None if unknown
+    """
+
+    def __init__(self,
                  server_address = "localhost",
-                 server_port = 3292):
-        
+                 server_port = 3292,
+                 timeout = 10.0):
+        """
+        Parameters:
+        server_address, server_port: where SkyChart listens
+        timeout: how long to wait for an answer (seconds), see wait
+        """
+
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((server_address, server_port))
-        data = self.socket.recv(1024)
-        logging.info("Connection successfull, server replies " + data)
-        
         self.escape_char = "\r\n"
+        self.timeout = timeout
+        self.pending = collections.deque()
+        self.date = None
+        self._buffer = ""
+
+        data = self.__read_line(timeout)
+        logging.info("Connection successfull, server replies %s", data)
+
+    def close(self):
+        self.socket.close()
 
     def __fix_response(self, msg):
         ret = msg.replace(".", "")
@@ -28,39 +59,248 @@ class SkyChartClient(object):
     def __is_ok_message(self, msg):
         return "OK" in self.__fix_response(msg)
     def __not_found_message(self, msg):
-        return "Not found" in self.__fix_response(msg)    
-    
-    def __send_and_check(self, msg):
-        #print ("Command: " + msg)
+        return "Not found" in self.__fix_response(msg)
+
+    def __receive(self, timeout):
+        """Reads what the server sent, waiting for it up to timeout seconds.
+        Returns False if nothing came."""
+        ready = select.select([self.socket], [], [], max(timeout, 0))[0]
+        if not ready:
+            return False
+        data = self.socket.recv(4096)
+        if data == "":
+            raise socket.error("Connection closed by SkyChart")
+        self._buffer += data
+        return True
+
+    def __next_line(self):
+        """Removes a complete line from the buffer, None if there is none."""
+        end = self._buffer.find("\n")
+        if end < 0:
+            return None
+        line = self._buffer[:end].rstrip("\r")
+        self._buffer = self._buffer[end + 1:]
+        return line
+
+    def __read_line(self, timeout):
+        deadline = time.time() + timeout
+        line = self.__next_line()
+        while line is None:
+            if not self.__receive(deadline - time.time()):
+                raise socket.timeout("No answer from SkyChart")
+            line = self.__next_line()
+        return line
+
+    def send(self, msg, callback = None):
+        """Sends a command without waiting for the answer, which is handled
+        by poll or wait.
+
+        Parameters:
+        msg: the command
+        callback: if not None, it is called with True if the answer is OK
+                  and with the answer
+        """
         self.socket.sendall(msg + self.escape_char)
-        time.sleep(1.0)
-        res = self.socket.recv(1024)
-        
-        if self.__is_ok_message(res):
-            logging.info("Command ok")
-            return True
-        else:
-            logging.warn("Problem with message: " + self.__fix_response(res))
-            return False        
-    
-    def search(self, body_obj):
-        
+        self.pending.append((msg, callback))
+        self.poll()
+
+    def poll(self, timeout = 0):
+        """Handles the answers that arrived, waiting up to timeout seconds for
+        the first one.
+
+        Returns:
+        the number of answers handled
+        """
+        handled = 0
+        received = self.__receive(timeout)
+        while received:
+            received = self.__receive(0)
+        line = self.__next_line()
+        while line is not None:
+            if len(self.pending) == 0:
+                logging.warn("Unexpected message: " + line)
+            else:
+                msg, callback = self.pending.popleft()
+                ok = self.__is_ok_message(line)
+                if ok:
+                    logging.info("Command ok")
+                else:
+                    logging.warn("Problem with message %s: %s", msg,
+                                 self.__fix_response(line))
+                if callback is not None:
+                    callback(ok, line)
+                handled += 1
+            line = self.__next_line()
+        return handled
+
+    def wait(self, timeout = None):
+        """Waits for the answers of all the commands sent.
+
+        Parameters:
+        timeout: in seconds, the timeout of the client if None
+
+        Returns:
+        True if all the answers arrived
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        while len(self.pending) > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.warn("%d commands without answer",
+                             len(self.pending))
+                return False
+            self.poll(remaining)
+        return True
+
+    def __send_and_check(self, msg, block = True, callback = None):
+        #print ("Command: " + msg)
+        if not block:
+            self.send(msg, callback)
+            return None
+
+        result = []
+        def check(ok, res):
+            result.append(ok)
+            if callback is not None:
+                callback(ok, res)
+        self.send(msg, check)
+        self.wait()
+        return len(result) == 1 and result[0]
+
+    def search(self, body_obj, block = True, callback = None):
+        """Centers SkyChart on a body.Body or a name.
+
+        Returns:
+        True if SkyChart found it, None if block is False (see send for
+        callback)
+        """
+
         if type(body_obj) is body.Body:
             body_obj = body_obj.name
-        
+
         body_obj = body_obj.replace(" ", "")
         cmd = "SEARCH " + body_obj
-        
-        return self.__send_and_check(cmd)
-        
-    
-    def setdate(self, date):
+
+        return self.__send_and_check(cmd, block, callback)
+
+
+    def setdate(self, date, block = True, callback = None, force = False):
+        """Sets the date of SkyChart, unless it is the date already set and
+        force is False.
+
+        Returns:
+        True if the date is set, None if block is False (see send for
+        callback)
+        """
         date = ephem.localtime(utils.create_date(date))
         #yyyy-mm-dd hh:mm:ss
         date_str = "\"%d-%d-%d %d:%d:%d\"" %(date.year, date.month, date.day,
                                          date.hour, date.minute, date.second)
+        if date_str == self.date and not force:
+            if block:
+                return True
+            if callback is not None:
+                callback(True, "")
+            return None
+
+        def check(ok, res):
+            if not ok and self.date == date_str:
+                self.date = None
+            if callback is not None:
+                callback(ok, res)
+        self.date = date_str
         cmd = "SETDATE " +  date_str
-        return self.__send_and_check(cmd)
-        
-        
-            
\ No newline at end of file
+        return self.__send_and_check(cmd, block, check)
+
+
+class TourPlayback(object):
+    """Shows the objects of a tour.Tour in SkyChart one after the other, each
+    at its best time in a session.ObservingSession.
+
+    The best times are computed once, when the playback is created, and
+    rounded to time_step minutes so that the objects close in time share a
+    date: SETDATE is sent only when the date changes. The commands are sent
+    without waiting for the answers, which are handled during the dwell
+    times.
+
+    Attributes:
+    stops: a list of (body.Body, ephem.Date), in tour order
+    results: after play, a list of [body.Body, ephem.Date, ok], ok None
+             while SkyChart has not answered
+    """
+
+    def __init__(self, client, tour, night, time_step = 10,
+                 field_of_view = None):
+        """
+        Parameters:
+        client: a SkyChartClient
+        tour: a tour.Tour
+        night: a session.ObservingSession
+        time_step: the best times are rounded to it (minutes), not rounded
+                   if None
+        field_of_view: if not None, the objects of the tour in the same
+                       eyepiece field (see tour.Tour.field_groups) are a
+                       single stop, at the object the field is centered on
+        """
+        self.client = client
+        self.session = night
+        if field_of_view is None:
+            bodies = tour.ordered_bodies
+        else:
+            bodies = [g.lead for g in tour.field_groups(field_of_view)]
+        self.stops = [(b, self.__rounded(night.best_time(b), time_step))
+                      for b in bodies]
+        self.results = []
+
+    def __repr__(self):
+        return "TourPlayback: %d stops, %d dates" % (
+            len(self.stops), len(set(d for _, d in self.stops)))
+
+    @staticmethod
+    def __rounded(date, time_step):
+        if time_step is None:
+            return ephem.Date(date)
+        step = time_step * ephem.minute
+        return ephem.Date(round(date / step) * step)
+
+    def __dwell(self, seconds):
+        """Handles the answers for seconds."""
+        deadline = time.time() + seconds
+        remaining = seconds
+        while remaining > 0:
+            self.client.poll(remaining)
+            remaining = deadline - time.time()
+
+    def play(self, dwell = 0, on_stop = None, wait = True):
+        """Sends the stops to SkyChart.
+
+        Parameters:
+        dwell: how long each stop is shown (seconds), or a function of the
+               body.Body returning it
+        on_stop: if not None, it is called with the body.Body and the date
+                 of each stop, when it is sent
+        wait: if True, waits for the last answers (see SkyChartClient.wait)
+
+        Returns:
+        the results, see results
+        """
+        self.results = []
+        for body_obj, date in self.stops:
+            result = [body_obj, date, None]
+            self.results.append(result)
+            def date_set(ok, res, result = result):
+                if not ok:
+                    result[2] = False
+            def found(ok, res, result = result):
+                if result[2] is None:
+                    result[2] = ok
+            self.client.setdate(date, block=False, callback=date_set)
+            self.client.search(body_obj, block=False, callback=found)
+            if on_stop is not None:
+                on_stop(body_obj, date)
+            self.__dwell(dwell(body_obj) if callable(dwell) else dwell)
+        if wait:
+            self.client.wait()
+        return self.results
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import tempfile
+import threading
+import tables
+
+#the HDF5 library is usually built without thread safety: only one thread at
+#a time can call it, whatever the file handle. Every access to a database
+#that can happen outside of the thread that opened it holds this lock.
+hdf5_lock = threading.RLock()
+
+class StorageProfile(object):
+    """A storage profile: the compressor and the chunk sizes (in rows) for each
+    kind of table: catalog, tour, notes and locations. A chunk size of None 
+    lets PyTables choose.
+    
+    The profile is chosen when a database is created (see 
+    catalogs.MasterDatabase) and an existing database can be rewritten in 
+    another profile with repack."""
+
+    def __init__(self, name, complib, complevel, shuffle = True,
+                 chunk_rows = None):
+        self.name = name
+        self.complib = complib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        if chunk_rows is None:
+            chunk_rows = {}
+        self.chunk_rows = chunk_rows
+
+    def __repr__(self):
+        return "StorageProfile: %s (%s %d)" % (self.name, self.complib,
+                                               self.complevel)
+
+    @property
+    def filters(self):
+        complib = self.complib
+        if self.complevel > 0 and tables.whichLibVersion(complib) is None:
+            logging.warn("%s is not available, using zlib", complib)
+            complib = "zlib"
+        return tables.Filters(complevel=self.complevel, complib=complib,
+                              shuffle=self.shuffle)
+
+    def chunkshape(self, kind):
+        """Returns the chunkshape for a kind of table, None for the PyTables
+        default."""
+        rows = self.chunk_rows.get(kind)
+        if rows is None:
+            return None
+        return (rows,)
+
+    def table_options(self, kind):
+        """Returns the keyword arguments to pass to createTable for a kind of
+        table."""
+        return dict(filters=self.filters, chunkshape=self.chunkshape(kind))
+
+#fast: light compression and large chunks for catalogs, which are mostly read
+#sequentially or with where(). Tours and notes are small, a single chunk each.
+#archival: the original settings, maximum zlib compression.
+PROFILES = {"fast": StorageProfile("fast", "blosc", 1,
+                                   chunk_rows={"catalog": 2048,
+                                               "tour": 128,
+                                               "notes": 16,
+                                               "locations": 32}),
+            "balanced": StorageProfile("balanced", "zlib", 5,
+                                       chunk_rows={"catalog": 512,
+                                                   "tour": 128,
+                                                   "notes": 16,
+                                                   "locations": 32}),
+            "archival": StorageProfile("archival", "zlib", 9)
+            }
+
+DEFAULT_PROFILE = "archival"
+
+def get_profile(profile):
+    """Returns a StorageProfile from its name (or the profile itself)."""
+    if isinstance(profile, StorageProfile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown storage profile %s, choose one of %s" % (
+            profile, ", ".join(sorted(PROFILES))))
+
+def table_kind(path):
+    """Returns the kind of table stored at path, None if it is not one of the
+    tables with a profile."""
+    if path in ("/locations", "/horizons"):
+        #the horizon profiles are stored like the locations they belong to
+        return "locations"
+    for kind, group in (("catalog", "/catalogs/"), ("tour", "/tours/"),
+                        ("notes", "/notes/")):
+        if path.startswith(group):
+            return kind
+    return None
+
+def repack(source, destination, profile):
+    """Rewrites a database with a different storage profile, like ptrepack.
+
+    Parameters:
+    source: the file name of the database to read
+    destination: the file name of the new database. It must not exist.
+    profile: the name of a profile, or a StorageProfile
+    """
+    profile = get_profile(profile)
+    if os.path.exists(destination):
+        raise ValueError("%s exists already" % destination)
+
+    src = tables.openFile(source, "r")
+    try:
+        dst = tables.openFile(destination, "w", title=src.title,
+                              filters=profile.filters)
+        try:
+            src.root._v_attrs._f_copy(dst.root)
+            dst.root._v_attrs.storage_profile = profile.name
+            for node in src.walkNodes("/"):
+                if node is src.root:
+                    continue
+                parent = dst.getNode(node._v_parent._v_pathname)
+                if isinstance(node, tables.Group):
+                    node._f_copy(parent, node._v_name)
+                    continue
+
+                options = dict(filters=profile.filters)
+                kind = table_kind(node._v_pathname)
+                if kind is not None:
+                    options["chunkshape"] = profile.chunkshape(kind)
+                elif node.chunkshape is not None:
+                    options["chunkshape"] = node.chunkshape
+                if isinstance(node, tables.Array) and node.chunkshape is None:
+                    #plain arrays are not chunked, they can't be compressed
+                    del options["filters"]
+                    options.pop("chunkshape", None)
+                node._f_copy(parent, node._v_name, **options)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+def benchmark(database, profiles = None, catalog = "sac", nreads = 1000,
+              nwrites = 200):
+    """Measures the read and write speed of a database in each storage
+    profile. A copy of the database is repacked in a temporary directory for
+    each profile.
+
+    Parameters:
+    database: the file name of the database
+    profiles: the names of the profiles to measure, all if None
+    catalog: the catalog used for the measures
+    nreads: how many random rows are read
+    nwrites: how many values are written, each one flushed
+
+    Returns:
+    a dictionary profile name -> dictionary with the size of the file (bytes)
+    and the seconds taken by: a full scan of the catalog, the random reads of
+    single rows, a where() query, loading all the tours and the writes.
+    """
+    import catalogs
+
+    if profiles is None:
+        profiles = sorted(PROFILES)
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name in profiles:
+            path = os.path.join(tmpdir, name + ".h5")
+            repack(database, path, name)
+            result = {"size": os.path.getsize(path)}
+
+            db = catalogs.MasterDatabase(path, migrate=True)
+            try:
+                table = db.get_catalog(catalog)
+                rows = [random.randrange(table.nrows) for _ in xrange(nreads)]
+
+                start = time.time()
+                table.read()
+                result["scan"] = time.time() - start
+
+                start = time.time()
+                for n in rows:
+                    table[n]
+                result["random_reads"] = time.time() - start
+
+                start = time.time()
+                table.readWhere("(mag < 10) & (dec > 0)")
+                result["where"] = time.time() - start
+
+                start = time.time()
+                for t in db.list_tours():
+                    db.get_tour(t)
+                result["tours"] = time.time() - start
+
+                start = time.time()
+                for n in rows[:nwrites]:
+                    table.cols.mag[n] = table.cols.mag[n]
+                    table.flush()
+                result["writes"] = time.time() - start
+            finally:
+                db.close()
+            results[name] = result
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    usage = ("Rewrites a database with another storage profile, or measures "
+             "the speed of each profile.\n"
+             "Usage:\n"
+             "  python -m astro_organizer.storage repack SOURCE DESTINATION "
+             "PROFILE\n"
+             "  python -m astro_organizer.storage benchmark DATABASE "
+             "[PROFILE...]\n"
+             "Profiles: " + ", ".join(sorted(PROFILES)))
+    if len(argv) == 4 and argv[0] == "repack":
+        repack(argv[1], argv[2], argv[3])
+    elif len(argv) >= 2 and argv[0] == "benchmark":
+        results = benchmark(argv[1], argv[2:] or None)
+        columns = ["size", "scan", "random_reads", "where", "tours", "writes"]
+        print "%-10s" % "profile" + "".join("%14s" % c for c in columns)
+        for name in sorted(results):
+            r = results[name]
+            print "%-10s" % name + "%14d" % r["size"] + "".join(
+                "%14.4f" % r[c] for c in columns[1:])
+    else:
+        print usage
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -80,6 +80,31 @@ def sac_type(s):
     except KeyError:
         return s
 
+#arcseconds per unit of the sizes in the SAC
+size_units = {'s': 1.0, 'm': 60.0, 'd': 3600.0}
+
+def size_to_arcsec(s):
+    """Converts a SAC size (e.g. "1.5 m") to arcseconds, NaN if it is 
+    empty."""
+    s = s.strip()
+    if len(s) == 0:
+        return float("nan")
+    try:
+        return float(s[:-1]) * size_units[s[-1]]
+    except KeyError:
+        raise ValueError("Unkwnown format for size: " + s)
+
+def surface_brightness_to_float(s):
+    """Converts a SAC surface brightness to a float, NaN if it is missing 
+    (empty or 99.9)."""
+    try:
+        value = float(s)
+    except ValueError:
+        return float("nan")
+    if value >= 99.9:
+        return float("nan")
+    return value
+
 sac_constellation_to_str = [('AND', 'ANDROMEDA'),
                             ('LAC', 'LACERTA'),
                             ('ANT', 'ANTLIA'),
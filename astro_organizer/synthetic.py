@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import numpy as np
+
+import body
+import catalogs
+import columnar
+import filters
+import query
+
+#the body types and the NGC descriptions the synthetic objects are drawn
+#from, the most common in SAC
+_BODY_TYPES = ("GALXY", "GALXY", "GALXY", "GALXY", "OPNCL", "PLNNB", "BRTNB",
+               "DRKNB", "GLOCL", "ASTER", "GALCL")
+_NGC_DESCRIPTIONS = ("eF;vS", "vF;S;R", "F;S;R;bM", "pB;pL;E", "eF;pS;lE",
+                     "vF;vS;stellar", "F;L;iR;vglbM", "B;S;R;psbM", "")
+
+def generate_rows(dtype, nrows, seed = 0, chunk_rows = None):
+    """Generates a synthetic catalog: objects named "SYN <n>", spread
+    uniformly on the sky, with realistic magnitudes (most of them faint),
+    sizes, body types and NGC descriptions. The other columns are empty.
+
+    Parameters:
+    dtype: the dtype of the catalog tables
+    nrows: how many objects
+    seed: the seed of the random numbers, the same seed gives the same
+          catalog
+    chunk_rows: how many rows each block has, columnar.SCAN_ROWS if None
+
+    Returns:
+    a generator of structured arrays of dtype
+    """
+    rng = np.random.RandomState(seed)
+    chunk_rows = chunk_rows or columnar.SCAN_ROWS
+    for start in xrange(0, nrows, chunk_rows):
+        count = min(chunk_rows, nrows - start)
+        rows = np.zeros(count, dtype)
+        rows["name"] = ["SYN %d" % n for n in xrange(start + 1,
+                                                     start + count + 1)]
+        rows["catalog"] = "SYN"
+        rows["body_type"] = np.array(_BODY_TYPES)[
+            rng.randint(len(_BODY_TYPES), size=count)]
+        rows["ngc_descr"] = np.array(_NGC_DESCRIPTIONS)[
+            rng.randint(len(_NGC_DESCRIPTIONS), size=count)]
+        rows["ra"] = rng.uniform(0, 2 * np.pi, count)
+        rows["dec"] = np.arcsin(rng.uniform(-1, 1, count))
+        rows["mag"] = np.round(np.clip(rng.normal(15, 2.5, count), 3, 25), 1)
+        size_max = np.round(rng.lognormal(3.5, 1, count), 1)
+        rows["size_max_arcsec"] = size_max
+        rows["size_min_arcsec"] = np.round(
+            size_max * rng.uniform(0.2, 1, count), 1)
+        #magnitude per square arcminute
+        area = np.pi * rows["size_max_arcsec"] * rows["size_min_arcsec"] / 14400
+        rows["surface_brightness_mag"] = np.round(
+            rows["mag"] + 2.5 * np.log10(area), 1)
+        rows["central_star_mag"] = 99.9
+        yield rows
+
+def create_synthetic_catalog(master_db, name, nrows, seed = 0,
+                             chunk_rows = None):
+    """Creates a synthetic catalog (see generate_rows) in a
+    catalogs.MasterDatabase, to try the code on catalogs of any size. It is
+    written one block at a time, in bounded memory. No visibility calendar
+    is built for it.
+
+    Returns:
+    the tables.Table of the catalog
+    """
+    with master_db.writing():
+        table = master_db.db.createTable(
+            "/catalogs", name, catalogs._TableBody, "Synthetic catalog",
+            expectedrows=nrows, **master_db.storage.table_options("catalog"))
+        body.stamp_table(table)
+        for rows in generate_rows(table.dtype, nrows, seed, chunk_rows):
+            table.append(rows)
+        table.flush()
+    return table
+
+def _peak_memory():
+    """The peak resident memory of the process, in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def benchmark(sizes, profile = "fast", seed = 0):
+    """Measures how the out-of-core paths of catalogs.MasterDatabase scale
+    with the size of a catalog: a synthetic catalog of each size is created
+    in a temporary database, then read.
+
+    Parameters:
+    sizes: the numbers of rows, best in increasing order: the peak memory of
+           the process only grows, it stays flat if the larger catalogs
+           don't need more memory
+    profile: the storage.StorageProfile of the databases
+
+    Returns:
+    a list with a dictionary for each size, with the number of rows, the
+    seconds taken by: creating the catalog, len, a query expression
+    (query.Plan), a filter with a per-body callable, the first page of a
+    query, a name not found (a full scan of the names and notes); and the
+    peak memory (MB) after them.
+    """
+    expression = (query.mag <= 9) & (query.dec > 0)
+    messier = filters.messier_only()
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for nrows in sizes:
+            path = os.path.join(tmpdir, "synthetic_%d.h5" % nrows)
+            db = catalogs.MasterDatabase(path, profile=profile)
+            result = {"rows": nrows}
+
+            start = time.time()
+            create_synthetic_catalog(db, "synthetic", nrows, seed)
+            result["create"] = time.time() - start
+
+            start = time.time()
+            len(db)
+            result["len"] = time.time() - start
+
+            start = time.time()
+            for _ in db.iter_filter("synthetic", expression):
+                pass
+            result["query"] = time.time() - start
+
+            start = time.time()
+            for _ in db.iter_filter("synthetic", messier):
+                pass
+            result["filter"] = time.time() - start
+
+            start = time.time()
+            db.filter_page("synthetic", expression, 100)
+            result["page"] = time.time() - start
+
+            start = time.time()
+            db.find_body("no such object", "synthetic")
+            result["find"] = time.time() - start
+
+            result["memory"] = _peak_memory()
+            db.close()
+            os.remove(path)
+            results.append(result)
+            logging.info("%s", result)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m astro_organizer.synthetic",
+        description="Measures the queries on synthetic catalogs of "
+                    "increasing size, see benchmark.")
+    parser.add_argument("sizes", nargs="*", type=int,
+                        default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7])
+    parser.add_argument("--profile", default="fast")
+    args = parser.parse_args(argv)
+
+    columns = ["create", "len", "query", "filter", "page", "find"]
+    print "%10s" % "rows" + "".join("%10s" % c for c in columns) + \
+        "%12s" % "memory (MB)"
+    for r in benchmark(args.sizes, args.profile):
+        print "%10d" % r["rows"] + "".join("%10.3f" % r[c]
+                                           for c in columns) + \
+            "%12.0f" % r["memory"]
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
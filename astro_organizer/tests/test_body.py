@@ -0,0 +1,56 @@
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+
+from astro_organizer import catalogs
+from astro_organizer import body
+from astro_organizer import filters
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestBodyIdentity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_same_row_same_body(self):
+        m31 = list(self.db.find_body("M31", "sac"))[0]
+        table = self.db.get_catalog("sac")
+        self.assertIs(self.db.get_bodies("sac", [m31._nrow])[0], m31)
+        self.assertIn(m31, self.db.filter_catalog(
+            "sac", filters.limit_magnitude(5)))
+
+        #a new instance of the same row, not shared
+        copy = body.Body(table, m31._nrow)
+        self.assertIsNot(copy, m31)
+        self.assertEqual(copy, m31)
+        self.assertFalse(copy != m31)
+        self.assertEqual(hash(copy), hash(m31))
+        self.assertEqual(len(set([m31, copy])), 1)
+        self.assertNotEqual(m31, body.Body(table, m31._nrow + 1))
+        self.assertNotEqual(m31, "M31")
+
+    def test_refetch_after_release(self):
+        nrow = list(self.db.find_body("M31", "sac"))[0]._nrow
+        key = hash(self.db.get_bodies("sac", [nrow])[0])
+        gc.collect()
+        self.assertNotIn(("sac", nrow), self.db._bodies)
+        again = self.db.get_bodies("sac", [nrow])[0]
+        self.assertEqual(hash(again), key)
+        self.assertEqual(dict([(again, 1)])[body.Body(
+            self.db.get_catalog("sac"), nrow)], 1)
+
+if __name__ == "__main__":
+    unittest.main()
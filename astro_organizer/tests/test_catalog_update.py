@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from astro_organizer import catalogs
+from astro_organizer import filters
+from astro_organizer import text_index
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+SAC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                   "catalogues", "SAC_DeepSky_ver81",
+                   "SAC_DeepSky_Ver81_QCQ.TXT")
+
+class TestCatalogUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(self.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        self.db = catalogs.MasterDatabase(database, migrate=True)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write_release(self, lines):
+        filename = os.path.join(self.tmpdir, "sac.txt")
+        with open(filename, "w") as f:
+            f.writelines(lines)
+        return filename
+
+    def test_same_release_changes_nothing(self):
+        table = self.db.get_catalog("sac")
+        report = self.db.load_sac("sac", SAC, update=True)
+        self.assertEqual(report.unchanged, table.nrows)
+        self.assertEqual(len(report.changed), 0)
+
+    def test_update_keeps_rows_in_place(self):
+        with open(SAC) as f:
+            lines = f.readlines()
+        table = self.db.get_catalog("sac")
+        nrows = table.nrows
+        m31 = list(self.db.find_body("M31", "sac"))[0]
+        position = m31._nrow
+        self.db.get_tour("update").append(m31)
+
+        #NGC 7831 gets brighter, NGC 5 goes, a new object comes last
+        lines[1] = lines[1].replace('"12.8"', '"11.8"', 1)
+        deleted = lines.pop(2)
+        lines.append(deleted.replace("NGC    5", "NGC 99999"))
+        report = self.db.load_sac("sac", self.write_release(lines),
+                                  update=True)
+
+        self.assertEqual(list(report.updated), [0])
+        self.assertEqual(list(report.deleted), [1])
+        #the new object takes the row of the deleted one
+        self.assertEqual(list(report.inserted), [1])
+        self.assertEqual(table.nrows, nrows)
+        self.assertEqual(table[0]["mag"], 11.8)
+        self.assertEqual(list(self.db.find_body("NGC 99999", "sac"))[0]._nrow,
+                         1)
+        self.assertEqual(list(self.db.find_body("M31", "sac"))[0]._nrow,
+                         position)
+        self.assertEqual(self.db.get_tour("update").repair(), [])
+        self.assertEqual(list(self.db.get_tour("update")), [m31])
+
+        #the original release without NGC 7831: NGC 5 comes back in the first
+        #free row
+        with open(SAC) as f:
+            lines = f.readlines()
+        del lines[1]
+        report = self.db.load_sac("sac", self.write_release(lines),
+                                  update=True)
+        self.assertEqual(list(report.deleted), [0, 1])
+        self.assertEqual(list(report.inserted), [0])
+        self.assertEqual(list(self.db.deleted_rows("sac")), [1])
+        self.assertEqual(len(self.db.find_body("NGC 7831", "sac")), 0)
+        found = self.db.filter_catalog("sac", filters.limit_magnitude(100))
+        self.assertNotIn(1, [b._nrow for b in found])
+        self.assertEqual(len(found), nrows - 1)
+
+    def test_text_index_patched(self):
+        def same(index, built):
+            self.assertEqual(index.terms.tolist(), built.terms.tolist())
+            self.assertEqual(index.offsets.tolist(), built.offsets.tolist())
+            self.assertEqual(index.postings.tolist(), built.postings.tolist())
+
+        with open(SAC) as f:
+            lines = f.readlines()
+        self.assertEqual(self.db.search_text("zodiacal patch", "sac"), [])
+        index = self.db.get_text_index("sac")
+
+        #new notes for NGC 7831, NGC 5 goes, a new object comes last
+        lines[1] = lines[1].rsplit(',"', 1)[0] + ',"Zodiacal patch"\n'
+        deleted = lines.pop(2)
+        lines.append(deleted.replace("NGC    5", "NGC 99999").replace(
+            "compact", "zodiacal glow"))
+        self.db.load_sac("sac", self.write_release(lines), update=True)
+
+        self.assertIs(self.db.get_text_index("sac"), index)
+        same(index, text_index.build(self.db, "sac"))
+        self.assertEqual([b._nrow for b in self.db.search_text(
+            "zodiacal patch", "sac")], [0])
+        found = self.db.search_text("zodiacal", "sac")
+        self.assertEqual(sorted(b.name for b in found),
+                         ["NGC 7831", "NGC 99999"])
+
+        #the stored index is up to date too
+        stored = text_index.load(self.db.db, "sac")
+        self.assertEqual(stored.signature, text_index.signature(self.db,
+                                                                "sac"))
+        same(stored, index)
+
+if __name__ == "__main__":
+    unittest.main()
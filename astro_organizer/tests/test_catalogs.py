@@ -0,0 +1,229 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import tables
+
+from astro_organizer import catalogs
+from astro_organizer import filters
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "database.h5")
+        shutil.copy(DATABASE, self.database)
+        self.db = catalogs.MasterDatabase(self.database, migrate=True)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_body_change_invalidates(self):
+        bright = self.db.filter_catalog("sac", filters.limit_magnitude(9))
+        self.assertEqual(len(self.db._query_cache), 1)
+        faint = [b for b in self.db.filter_catalog(
+            "sac", filters.limit_magnitude(12)) if b.mag > 9][0]
+        faint.mag = 8.5
+        again = self.db.filter_catalog("sac", filters.limit_magnitude(9))
+        self.assertEqual(len(again), len(bright) + 1)
+        self.assertIn(faint, again)
+
+        self.db.invalidate_query_cache("sac")
+        self.assertEqual(len(self.db._query_cache), 0)
+
+    def test_in_kernel_statistics(self):
+        nrows = self.db.get_catalog("sac").nrows
+        master_filter = filters.MultiFilter()
+        master_filter.append(filters.limit_magnitude(9))
+        master_filter.append(filters.constellation("AND"))
+        found = self.db.filter_catalog("sac", master_filter)
+        #exact, the bank is never called
+        stats = dict((s["name"], s) for s in master_filter.statistics())
+        condition = stats.pop("condition((mag <= 9.0) & "
+                              "(constellation == 'AND'))")
+        self.assertEqual(condition["calls"], nrows)
+        self.assertEqual(condition["rejections"], nrows - len(found))
+        self.assertEqual([s["calls"] for s in stats.values()], [0, 0])
+
+        master_filter.reset_statistics()
+        master_filter.append(filters.messier_only())
+        messier = self.db.filter_catalog("sac", master_filter)
+        stats = dict((s["name"], s) for s in master_filter.statistics())
+        self.assertEqual(stats["messier_only()"]["calls"], len(found))
+        self.assertEqual(stats["messier_only()"]["rejections"],
+                         len(found) - len(messier))
+        self.assertEqual(stats["limit_magnitude(9)"]["rejections"], 0)
+
+    def test_save_and_load(self):
+        bright = [b._nrow for b in self.db.filter_catalog(
+            "sac", filters.limit_magnitude(9))]
+        self.db.save_query_cache()
+        self.db.close()
+
+        self.db = catalogs.MasterDatabase(self.database, migrate=True)
+        self.assertEqual(len(self.db._query_cache), 1)
+        self.assertEqual([b._nrow for b in self.db.filter_catalog(
+            "sac", filters.limit_magnitude(9))], bright)
+        self.db.close()
+
+        self.db = catalogs.MasterDatabase(tables.openFile(self.database,
+                                                          "r"))
+        self.assertEqual(len(self.db._query_cache), 1)
+        self.assertRaises(ValueError, self.db.save_query_cache)
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(self.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        self.db = catalogs.MasterDatabase(database, migrate=True)
+        self.bright = filters.limit_magnitude(9)
+        self.count = len(self.db.filter_catalog("sac", self.bright))
+        self.faint = [b for b in self.db.filter_catalog(
+            "sac", filters.limit_magnitude(12)) if b.mag > 9][:2]
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_query_within_batch(self):
+        with self.db.batch():
+            self.faint[0].mag = 8.5
+            self.assertEqual(len(self.db.filter_catalog("sac", self.bright)),
+                             self.count + 1)
+            #a second write to the same table
+            self.faint[1].mag = 8.5
+            self.assertEqual(len(self.db.filter_catalog("sac", self.bright)),
+                             self.count + 2)
+        self.assertEqual(len(self.db.filter_catalog("sac", self.bright)),
+                         self.count + 2)
+
+    def test_rollback(self):
+        def fail():
+            with self.db.batch():
+                self.faint[0].mag = 8.5
+                self.assertEqual(len(self.db.filter_catalog(
+                    "sac", self.bright)), self.count + 1)
+                raise RuntimeError("rolled back")
+        self.assertRaises(RuntimeError, fail)
+        self.assertTrue(self.faint[0].mag > 9)
+        found = self.db.filter_catalog("sac", self.bright)
+        self.assertEqual(len(found), self.count)
+        self.assertNotIn(self.faint[0], found)
+
+    def test_rollback_notes(self):
+        m31 = list(self.db.find_body("M31", "sac"))[0]
+        m31.additional_notes = "Zodiacal glow all over the field"
+        m31.additional_notes = "Quokka shaped halo"
+        self.assertEqual(self.db.search_text("quokka shaped"), [m31])
+        notes = m31.additional_notes
+        def fail():
+            with self.db.batch():
+                del m31.additional_notes
+                m31.additional_notes = "Wombat trail"
+                while len(m31.additional_notes) != 0:
+                    del m31.additional_notes
+                self.assertEqual(self.db.search_text("quokka shaped"), [])
+                raise RuntimeError("rolled back")
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(m31.additional_notes, notes)
+        self.assertEqual(self.db.search_text("quokka shaped"), [m31])
+        self.assertEqual(self.db.search_text("wombat trail"), [])
+
+        #removed outside of a batch
+        del m31.additional_notes
+        self.assertEqual(m31.additional_notes, notes[:-1])
+        self.assertEqual(self.db.search_text("quokka shaped"), [])
+
+class TestThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "database.h5")
+        shutil.copy(DATABASE, self.database)
+        self.db = catalogs.MasterDatabase(self.database, migrate=True)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_threads(self, targets):
+        errors = []
+        def run(target):
+            try:
+                target()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(t,)) for t in targets]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_readers_while_writing(self):
+        bright = filters.limit_magnitude(9)
+        expected = [b._nrow for b in self.db.filter_catalog("sac", bright)]
+        m31 = [b._nrow for b in self.db.find_body("M31", "sac")]
+        faint = [b for b in self.db.filter_catalog(
+            "sac", filters.limit_magnitude(14)) if b.mag > 12][0]
+        mag = faint.mag
+        writing = threading.Event()
+        results = []
+
+        def write():
+            writing.set()
+            for i in xrange(20):
+                #every write invalidates the cached result of the readers
+                faint.mag = mag + (i % 2) * 0.5
+        def read():
+            writing.wait()
+            for _ in xrange(5):
+                results.append(([b._nrow for b in self.db.filter_catalog(
+                    "sac", bright)], [b._nrow for b in self.db.find_body(
+                    "M31", "sac")]))
+
+        self.run_threads([write] + [read] * 4)
+        self.assertEqual(len(results), 20)
+        for found in results:
+            self.assertEqual(found, (expected, m31))
+
+    def test_read_only_readers(self):
+        self.db.close()
+        #no query cache, every thread reads from the file
+        self.db = catalogs.MasterDatabase(tables.openFile(self.database,
+                                                          "r"),
+                                          query_cache_size=0)
+        expected = len(self.db.filter_catalog("sac",
+                                              filters.limit_magnitude(9)))
+        counts = []
+        def read():
+            counts.append(len(self.db.filter_catalog(
+                "sac", filters.limit_magnitude(9))))
+        self.run_threads([read] * 3)
+        self.assertEqual(counts, [expected] * 3)
+
+    def test_open_at_exit(self):
+        #a database referenced from a module is collected after the
+        #modules are torn down
+        self.db.close()
+        script = ("from astro_organizer import catalogs\n"
+                  "catalogs.leak = catalogs.MasterDatabase(%r)\n" %
+                  self.database)
+        process = subprocess.Popen([sys.executable, "-c", script],
+                                   stderr=subprocess.PIPE)
+        _, errors = process.communicate()
+        self.assertEqual(process.returncode, 0)
+        self.assertNotIn("ignored", errors)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from astro_organizer import catalogs
+from astro_organizer import synthetic
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestCatalogColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "database.h5")
+        shutil.copy(DATABASE, self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertConsistent(self, db, catalog = "sac"):
+        table = db.get_catalog(catalog)
+        columns = db._columns_of(table)
+        self.assertEqual(columns.data.tostring(), table.read().tostring())
+        for colname, col in columns._normalized.iteritems():
+            self.assertTrue((col == np.char.lower(np.char.replace(
+                columns.data[colname], " ", ""))).all())
+
+    def check_writes(self, db):
+        table = db.get_catalog("sac")
+        m31 = list(db.find_body("M31", "sac"))[0]
+        #the normalized names are computed by the lookups
+        self.assertEqual(len(db.find_body("Zzyzx Cloud", "sac")), 0)
+
+        m31.mag = 2.5
+        m31.additional_names = "Zzyzx Cloud"
+        self.assertConsistent(db)
+        self.assertEqual(db.find_body("zzyzxcloud", "sac"), set([m31]))
+
+        nrows = np.array([3, 5, 8])
+        rows = table.readCoordinates(nrows[::-1])
+        db._set_rows(table, nrows, rows)
+        self.assertConsistent(db)
+
+        def fail():
+            with db.batch():
+                m31.mag = 20
+                db._set_rows(table, nrows, rows[::-1])
+                self.assertConsistent(db)
+                raise RuntimeError("rolled back")
+        self.assertRaises(RuntimeError, fail)
+        self.assertConsistent(db)
+        self.assertEqual(m31.mag, 2.5)
+
+    def test_in_memory(self):
+        db = catalogs.MasterDatabase(self.database, in_memory=True,
+                                     migrate=True)
+        try:
+            self.assertFalse(db._columns_of(db.get_catalog("sac")).mapped)
+            self.check_writes(db)
+        finally:
+            db.close()
+
+    def test_memory_mapped(self):
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        db = catalogs.MasterDatabase(self.database, in_memory=True,
+                                     cache_dir=cache_dir, migrate=True)
+        try:
+            self.assertTrue(db._columns_of(db.get_catalog("sac")).mapped)
+            cached = os.listdir(cache_dir)
+            self.check_writes(db)
+        finally:
+            db.close()
+
+        #the cache file of the old generation is replaced
+        db = catalogs.MasterDatabase(self.database, in_memory=True,
+                                     cache_dir=cache_dir, migrate=True)
+        try:
+            self.assertConsistent(db)
+            self.assertNotEqual(os.listdir(cache_dir), cached)
+        finally:
+            db.close()
+
+    def test_shared_cache_dir(self):
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        other = os.path.join(self.tmpdir, "other.h5")
+        shutil.copy(DATABASE, other)
+        #the same generation and number of rows, other values
+        for database, mag in ((self.database, 2.5), (other, 3.5)):
+            db = catalogs.MasterDatabase(database, migrate=True)
+            list(db.find_body("M31", "sac"))[0].mag = mag
+            db.close()
+
+        for database in (self.database, other, self.database):
+            db = catalogs.MasterDatabase(database, in_memory=True,
+                                         cache_dir=cache_dir)
+            try:
+                self.assertConsistent(db)
+            finally:
+                db.close()
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+        #removed and created again with the same name, rows and generation
+        for seed in (0, 1):
+            db = catalogs.MasterDatabase(self.database, in_memory=True,
+                                         cache_dir=cache_dir)
+            try:
+                if seed == 1:
+                    with db.writing():
+                        db.db.removeNode("/catalogs", "syn")
+                    db._columns.pop("syn", None)
+                synthetic.create_synthetic_catalog(db, "syn", 500, seed)
+                self.assertConsistent(db, "syn")
+            finally:
+                db.close()
+            db = catalogs.MasterDatabase(self.database, in_memory=True,
+                                         cache_dir=cache_dir)
+            try:
+                self.assertConsistent(db, "syn")
+            finally:
+                db.close()
+
+class TestRecordBlocks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_boundaries(self):
+        table = self.db.get_catalog("sac")
+        data = table.read()
+        nrows = table.nrows
+        for chunk_rows in (1000, nrows // 4, nrows, nrows + 1, 7):
+            blocks = list(self.db.iter_chunks("sac", ["name", "mag"],
+                                              chunk_rows))
+            expected = (nrows + chunk_rows - 1) // chunk_rows
+            self.assertEqual(len(blocks), expected)
+            self.assertEqual([b.start for b in blocks],
+                             range(0, nrows, chunk_rows))
+            self.assertTrue(all(len(b) == chunk_rows for b in blocks[:-1]))
+            self.assertTrue(0 < len(blocks[-1]) <= chunk_rows)
+            self.assertTrue((np.concatenate([b.nrows for b in blocks]) ==
+                             np.arange(nrows)).all())
+            self.assertTrue((np.concatenate([b["mag"] for b in blocks]) ==
+                             data["mag"]).all())
+            self.assertEqual(blocks[0].data.dtype.names, ("name", "mag"))
+
+        last = blocks[-1]
+        bright = last["mag"] < 12
+        self.assertEqual([b._nrow for b in last.bodies(bright)],
+                         list(last.nrows[bright]))
+
+    def test_in_memory_blocks(self):
+        database = os.path.join(self.tmpdir, "in_memory.h5")
+        shutil.copy(DATABASE, database)
+        db = catalogs.MasterDatabase(database, in_memory=True, migrate=True)
+        try:
+            table = db.get_catalog("sac")
+            blocks = list(db.iter_chunks("sac", chunk_rows=table.nrows // 3))
+            self.assertEqual(
+                np.concatenate([b.data for b in blocks]).tostring(),
+                table.read().tostring())
+            self.assertEqual(len(list(db.iter_chunks(chunk_rows=100))),
+                             sum((t.nrows + 99) // 100
+                                 for t in db.db.root.catalogs))
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import math
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import ephem
+import numpy as np
+
+from astro_organizer import catalogs
+from astro_organizer import ephemerides
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+#an elliptical orbit from the xephem database format
+COMET = ("C/1995 O1 (Hale-Bopp),e,89.4245,282.4670,130.5884,186.0599,"
+         "0.0004020,0.995004,0.0000,04/01.1373/1997,2000,g -2.0,4.0")
+
+START = ephem.Date("2026/3/1")
+
+#one arc second
+TOLERANCE = math.radians(1 / 3600.0)
+
+class TestEphemeris(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+        cls.ephemeris = cls.db.build_ephemerides(
+            START, ephem.Date(START + 10), comets=[COMET])
+        cls.bodies = [body_cls() for _, body_cls, _ in
+                      ephemerides.SOLAR_SYSTEM] + [ephem.readdb(COMET)]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_positions(self):
+        #between the nodes of the fit, and at the ends of the segments
+        rng = random.Random(1)
+        dates = [START + rng.uniform(0, 10) for _ in xrange(20)]
+        dates += [START, START + 5, START + 10]
+        ra, dec = self.ephemeris.positions(dates)
+        magnitudes = self.ephemeris.magnitudes(dates)
+        self.assertEqual(ra.shape, (len(self.bodies), len(dates)))
+        for i, body_obj in enumerate(self.bodies):
+            for j, date in enumerate(dates):
+                body_obj.compute(date, epoch=ephem.J2000)
+                separation = float(ephem.separation(
+                    (body_obj.a_ra, body_obj.a_dec), (ra[i, j], dec[i, j])))
+                self.assertTrue(separation < TOLERANCE,
+                                (body_obj.name, ephem.Date(date),
+                                 math.degrees(separation) * 3600))
+                #PyEphem rounds the magnitudes to 0.01, the fit is rougher
+                #where they change fast (Mercury near a conjunction)
+                self.assertTrue(abs(magnitudes[i, j] - body_obj.mag) < 0.1,
+                                (body_obj.name, magnitudes[i, j]))
+
+    def test_rows_and_range(self):
+        ra, dec = self.ephemeris.positions(START + 2.5)
+        moon = self.ephemeris.positions(START + 2.5, nrows=[0])
+        self.assertEqual(moon[0].shape, (1, 1))
+        self.assertEqual(moon[0][0, 0], ra[0, 0])
+        self.assertEqual(moon[1][0, 0], dec[0, 0])
+
+        ra, dec = self.ephemeris.positions([START - 1, START + 11])
+        self.assertTrue(np.isnan(ra).all() and np.isnan(dec).all())
+        self.assertTrue(np.isnan(self.ephemeris.magnitudes(START + 11)).all())
+
+    def test_catalog(self):
+        table = self.db.get_catalog("solar_system")
+        self.assertEqual(table.nrows, len(self.bodies))
+        self.assertEqual(self.db.get_ephemeris("solar_system").end,
+                         START + 10)
+        self.assertEqual(self.db.get_ephemeris("sac"), None)
+
+if __name__ == "__main__":
+    unittest.main()
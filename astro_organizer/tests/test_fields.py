@@ -0,0 +1,91 @@
+import math
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from astro_organizer import catalogs
+from astro_organizer import fields
+from astro_organizer import query
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+def separations(ra1, dec1, ra2, dec2):
+    return np.arccos(np.clip(np.sin(dec1) * np.sin(dec2) + np.cos(dec1) *
+                             np.cos(dec2) * np.cos(ra1 - ra2), -1, 1))
+
+class TestFields(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_virgo_field(self):
+        #2000 objects in the Virgo region
+        rng = np.random.RandomState(0)
+        ra = rng.uniform(math.radians(180), math.radians(195), 2000)
+        dec = rng.uniform(math.radians(5), math.radians(20), 2000)
+        start = time.time()
+        labels, leads = fields.group_positions(ra, dec, 30)
+        self.assertTrue(time.time() - start < 1)
+
+        i, j = fields.neighbor_pairs(ra, dec, math.radians(0.25))
+        all_pairs = separations(ra[:, np.newaxis], dec[:, np.newaxis],
+                                ra, dec) <= math.radians(0.25)
+        np.fill_diagonal(all_pairs, False)
+        self.assertEqual(len(i), all_pairs.sum())
+        self.assertTrue(all_pairs[i, j].all())
+
+        self.assertTrue(len(leads) < 2000)
+        self.assertEqual(list(labels[leads]), range(len(leads)))
+        lead = leads[labels]
+        self.assertTrue((separations(ra, dec, ra[lead], dec[lead]) <=
+                         math.radians(0.25) + 1e-12).all())
+
+    def test_markarian_chain(self):
+        expression = ((query.ra > math.radians(185)) &
+                      (query.ra < math.radians(190)) &
+                      (query.dec > math.radians(10)) &
+                      (query.dec < math.radians(16)) & (query.mag <= 12))
+        bodies = self.db.filter_catalog("sac", expression)
+        groups = fields.group_bodies(bodies, 40)
+        self.assertTrue(len(groups) < len(bodies))
+        self.assertEqual(sum(len(g) for g in groups), len(bodies))
+        m84 = list(self.db.find_body("M84", "sac"))[0]
+        m86 = list(self.db.find_body("M86", "sac"))[0]
+        group = [g for g in groups if m84 in g.bodies][0]
+        self.assertIn(m86, group.bodies)
+        self.assertTrue(group.radius <= 20)
+
+    def test_tour_stops(self):
+        tour = self.db.get_tour("fields")
+        for name in ("M84", "M86", "M31"):
+            tour.append(list(self.db.find_body(name, "sac"))[0])
+        self.assertEqual([len(g) for g in tour.field_groups(40)], [2, 1])
+        entries = tour.sky_safari_entry(field_of_view=40)
+        self.assertEqual(entries.count("SkyObject=BeginObject"), 2)
+        self.assertIn("Same field: ", entries)
+        self.assertEqual(tour.sky_safari_entry().count(
+            "SkyObject=BeginObject"), 3)
+
+        night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+        scorer = self.db.night_scorer("Grizzly", night)
+        best = scorer.best_fields("sac", 60, count=10, min_score=0.5)
+        self.assertEqual(len(best), 10)
+        scores = [max(scorer.score(b) for b in g) for g in best]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import time
+import unittest
+
+from astro_organizer import filters
+
+def slow(x):
+    time.sleep(0.0005)
+    return x % 2 == 0
+
+def fast_selective(x):
+    return x % 10 == 0
+
+def accept_all(x):
+    return True
+
+class TestMultiFilter(unittest.TestCase):
+
+    def test_reorder(self):
+        master_filter = filters.MultiFilter(reorder_every=16)
+        master_filter.append(slow)
+        master_filter.append(accept_all)
+        master_filter.append(fast_selective)
+        accepted = master_filter.filter(range(200))
+        #the cheap and selective filter moves first, the result is the same
+        self.assertEqual(master_filter.filters[0], fast_selective)
+        self.assertEqual(accepted, range(0, 200, 10))
+        self.assertEqual(sorted(s["position"] for s in
+                                master_filter.statistics()), [0, 1, 2])
+
+        fixed = filters.MultiFilter(adaptive=False)
+        for f in (slow, accept_all, fast_selective):
+            fixed.append(f)
+        self.assertEqual(fixed.filter(range(200)), accepted)
+        self.assertEqual(fixed.filters, [slow, accept_all, fast_selective])
+
+    def test_barrier(self):
+        calls = []
+        def barrier(x):
+            calls.append(x)
+            return True
+        master_filter = filters.MultiFilter(reorder_every=16)
+        master_filter.append(slow)
+        master_filter.append(fast_selective)
+        master_filter.append(barrier, reorder=False)
+        master_filter.append(accept_all)
+        master_filter.append(fast_selective)
+        accepted = master_filter.filter(range(200))
+        self.assertEqual(accepted, range(0, 200, 10))
+        #reordered before the barrier, nothing moved across it
+        self.assertEqual(master_filter.filters[:3],
+                         [fast_selective, slow, barrier])
+        self.assertEqual(set(master_filter.filters[3:]),
+                         set([accept_all, fast_selective]))
+        #the barrier sees only what the filters before it accepted
+        self.assertEqual(set(calls), set(range(0, 200, 10)))
+
+if __name__ == "__main__":
+    unittest.main()
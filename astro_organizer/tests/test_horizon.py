@@ -0,0 +1,110 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import ephem
+import numpy as np
+
+from astro_organizer import catalogs
+from astro_organizer import filters
+from astro_organizer import horizon
+from astro_organizer import query
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+#trees at 40 degrees in the south, the rest is clear
+SOUTH_TREES = [(0, 0), (120, 0), (130, 40), (230, 40), (240, 0)]
+
+class TestHorizon(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_profile(self):
+        profile = horizon.HorizonProfile([(0, 10), (90, 30)])
+        azimuths = np.radians([45, 225, 359.99, 90])
+        self.assertTrue(np.allclose(np.degrees(profile.altitudes(azimuths)),
+                                    [20, 20, 10, 30]))
+        self.assertTrue(np.allclose(horizon.flat(15).table,
+                                    math.radians(15)))
+
+    def test_alt_az(self):
+        night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+        m31 = list(self.db.find_body("M31", "sac"))[0]
+        alt, az = night.alt_az(*night.apparent_positions([m31.ra],
+                                                         [m31.dec]))
+        observer = night.observer
+        observer.date = night.dates[3]
+        observer.pressure = 0
+        ephem_body = m31.ephem_body
+        ephem_body.compute(observer)
+        self.assertAlmostEqual(alt[0, 3], ephem_body.alt, 3)
+        self.assertAlmostEqual(az[0, 3], ephem_body.az, 3)
+
+    def test_stored_profile_limits_the_night(self):
+        self.assertEqual(self.db.get_horizon("Grizzly"), None)
+        open_sky = self.db.create_session("Grizzly", "2026/11/10 05:00")
+        self.db.set_horizon("Grizzly", SOUTH_TREES)
+        try:
+            self.assertEqual(self.db.get_horizon("Grizzly").points,
+                             tuple((float(az), float(alt))
+                                   for az, alt in SOUTH_TREES))
+            night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+            self.assertNotEqual(night.horizon_profile, None)
+
+            clear = open_sky.catalog_time_above_horizon(self.db, "sac")
+            behind_trees = night.catalog_time_above_horizon(self.db, "sac")
+            self.assertTrue((behind_trees <= clear).all())
+            self.assertTrue((behind_trees < clear).sum() > 100)
+
+            #vectorized query and per-body filter agree
+            expected = self.db.filter_catalog(
+                "sac", query.time_above_horizon(night, 120))
+            self.assertNotEqual(len(expected), 0)
+            master_filter = filters.MultiFilter()
+            master_filter.append(filters.min_time_above_horizon(night, 120))
+            self.assertEqual(self.db.filter_catalog("sac", master_filter),
+                             expected)
+            for b in expected[:20]:
+                self.assertTrue(night.body_time_above_horizon(b) >=
+                                120 * ephem.minute)
+
+            scorer = self.db.night_scorer("Grizzly", night)
+            self.assertTrue((scorer.scores("sac")[behind_trees == 0] ==
+                             0).all())
+        finally:
+            self.db.set_horizon("Grizzly", None)
+        self.assertEqual(self.db.get_horizon("Grizzly"), None)
+
+    def test_session_horizon(self):
+        times = [self.db.create_session(
+            "Grizzly", "2026/11/10 05:00",
+            horizon=h).catalog_time_above_horizon(self.db, "sac")
+                 for h in (0, 30, 60)]
+        #a higher horizon shortens the time above it
+        for higher, lower in zip(times[1:], times):
+            self.assertTrue((higher <= lower).all())
+            #by more than an hour on average
+            self.assertTrue((lower - higher).mean() > ephem.hour)
+
+        night = self.db.create_session("Grizzly", "2026/11/10 05:00",
+                                       horizon=30)
+        self.assertAlmostEqual(night.minimum_altitudes(np.zeros(1)),
+                               night.minimum_altitudes(np.zeros(1), 30))
+        self.assertTrue(math.degrees(night.minimum_altitudes(
+            np.zeros(1))) > 29)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from astro_organizer import catalogs
+from astro_organizer import importers
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+DATABASE = os.path.join(ROOT, "main_database.h5")
+LISTS = os.path.join(ROOT, "catalogues")
+
+class TestImporters(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_normalize(self):
+        for designation, key in (("NGC  188", "ngc188"),
+                                 ("Melotte 25", "mel25"),
+                                 ("Sh2 155", "sh2155"),
+                                 ("Win4", "winnecke4")):
+            self.assertEqual(importers.normalize_designation(designation),
+                             key)
+
+    def test_bundled_lists(self):
+        for filename, count in (("caldwell.txt", 109),
+                                ("al_binocular_club.txt", 59),
+                                ("sac_110_best_ngc.txt", 111),
+                                ("observing_list_2012_fall.csv", 110)):
+            report = self.db.import_tour(os.path.join(LISTS, filename))
+            self.assertTrue(report.complete, report.summary())
+            self.assertEqual(len(report.added), count)
+            unique = []
+            for b in report.added:
+                if b not in unique:
+                    unique.append(b)
+            tour_obj = self.db.get_tour(os.path.splitext(filename)[0])
+            self.assertEqual(tour_obj.ordered_bodies, unique)
+
+    def test_resolution(self):
+        index = importers.get_index(self.db)
+        entries = [importers.Entry(1, ("M 8", "NGC 6530"), ""),
+                   importers.Entry(2, ("Coalsack Dark Nebula", "Coalsack"),
+                                   ""),
+                   importers.Entry(3, ("NGC 99999",), "")]
+        resolved, unresolved, ambiguous = importers.resolve_entries(entries,
+                                                                    index)
+        self.assertEqual([b.name for _, b in resolved],
+                         ["NGC 6523", "Coalsack"])
+        self.assertEqual([e.line for e in unresolved], [3])
+        self.assertEqual(ambiguous, [])
+
+    def test_strict(self):
+        path = os.path.join(self.tmpdir, "list.csv")
+        with open(path, "w") as f:
+            f.write("1,31,1,224,|Andromeda Galaxy|,,\n"
+                    "2,,1,99999,,,\n")
+        with self.assertRaises(ValueError):
+            self.db.import_tour(path, "strict", strict=True)
+        self.assertNotIn("strict", self.db.list_tours())
+        report = self.db.import_tour(path, "lenient")
+        self.assertEqual(len(report.added), 1)
+        self.assertEqual(len(report.unresolved), 1)
+
+if __name__ == "__main__":
+    unittest.main()
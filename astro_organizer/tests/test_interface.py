@@ -5,7 +5,7 @@ from astro_organizer import qt_interface
 from astro_organizer import catalogs
 
 def main():
-    db = catalogs.MasterDatabase("main_database.h5")
+    db = catalogs.MasterDatabase("main_database.h5", migrate=True)
     tour = db.get_tour('binocular_objects')
     observer = db.create_observer("Grizzly")
     t = qt_interface.create_table_from_set(observer, tour)
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from astro_organizer import catalogs
+from astro_organizer import body
+from astro_organizer import filters
+from astro_organizer import query
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestQuery(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_columns_match_filters(self):
+        expression = (query.mag <= 9) & query.body_type.isin("GALXY", "GLOCL")
+        master_filter = filters.MultiFilter()
+        master_filter.append(filters.limit_magnitude(9))
+        master_filter.append(filters.body_type("GALXY", "GLOCL"))
+        expected = self.db.filter_catalog("sac", master_filter)
+        self.assertNotEqual(len(expected), 0)
+        self.assertEqual(self.db.filter_catalog("sac", expression), expected)
+        self.assertEqual(expression.plan().stages, [])
+
+        m31 = list(self.db.find_body("M31", "sac"))[0]
+        self.assertTrue(expression(m31))
+        self.assertFalse((~expression)(m31))
+        self.assertRaises(TypeError, lambda: 5 < query.mag < 9)
+
+    def test_plan_stages(self):
+        night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+        expression = (query.observable(night) &
+                      query.where(filters.messier_only()) &
+                      query.text(self.db, "bright") & (query.mag < 9))
+        plan = expression.plan()
+        self.assertEqual(plan.where, "(mag < 9.0)")
+        self.assertEqual([s.kind for s in plan.stages],
+                         [query.VECTORIZED, query.VECTORIZED,
+                          query.PER_BODY])
+        self.assertTrue(repr(plan.stages[0]).startswith("text"))
+        self.assertIn("not run yet", plan.explain())
+
+        found = self.db.filter_catalog("sac", expression)
+        self.assertNotEqual(len(found), 0)
+        explanation = plan.explain()
+        self.assertEqual(len(explanation.splitlines()), 5)
+        self.assertIn("rows", explanation)
+        for b in found:
+            self.assertTrue(b.mag < 9 and "M" in b.catalog)
+        self.assertEqual(self.db.explain("sac", expression), plan.explain())
+
+    def test_observable_matches_filter(self):
+        night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+        master_filter = filters.MultiFilter()
+        master_filter.append(filters.limit_magnitude(11))
+        master_filter.append(filters.observable(night))
+        expected = self.db.filter_catalog("sac", master_filter)
+        found = self.db.filter_catalog("sac", (query.mag <= 11) &
+                                       query.observable(night))
+        #sampled at the steps of the session, the objects rising or setting
+        #at the edges of the window can differ
+        difference = set(expected).symmetric_difference(found)
+        self.assertTrue(len(difference) < len(expected) / 100)
+
+    def test_body_without_database(self):
+        night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+        expression = ((query.mag < 10) & query.where(filters.messier_only()) &
+                      query.observable(night) & query.text(self.db, "bright"))
+        found = set(b._nrow for b in self.db.filter_catalog("sac",
+                                                            expression))
+        self.assertNotEqual(len(found), 0)
+        table = self.db.get_catalog("sac")
+        for nrow in sorted(found)[:5] + [0, 1, 2]:
+            self.assertEqual(expression(body.Body(table, nrow)),
+                             nrow in found)
+
+if __name__ == "__main__":
+    unittest.main()
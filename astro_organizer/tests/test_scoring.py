@@ -0,0 +1,105 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import ephem
+import numpy as np
+
+from astro_organizer import catalogs
+from astro_organizer import scoring
+from astro_organizer import session
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+NIGHT = ephem.Date("2026/11/10 05:00")
+
+#scores differing less are equal
+EPSILON = 1e-9
+
+class TestNightScorer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def create_session(self, start_time, end_time, moon_alt, moon_phase):
+        """A session without horizon profile, the Moon at a fixed altitude
+        and phase."""
+        night = session.ObservingSession(
+            self.db.create_observer("Grizzly", start_time), start_time,
+            end_time)
+        moon = night.moon
+        night._memo["moon"] = session.MoonTrack(
+            moon.ra, moon.dec, np.empty_like(moon.alt),
+            np.empty_like(moon.phase))
+        night.moon.alt.fill(moon_alt)
+        night.moon.phase.fill(moon_phase)
+        return night
+
+    def test_moon_phase(self):
+        phases = [0, 0.25, 0.5, 0.75, 1]
+        scores = np.array([scoring.NightScorer(self.db, self.create_session(
+            NIGHT, ephem.Date(NIGHT + 2 * ephem.hour), math.radians(40),
+            phase)).scores("sac") for phase in phases])
+        #a brighter Moon never helps, and hides some objects
+        self.assertTrue((np.diff(scores, axis=0) <= EPSILON).all())
+        self.assertTrue((scores[-1] < scores[0] - 0.1).any())
+
+        #below the horizon, the phase makes no difference
+        down = [scoring.NightScorer(self.db, self.create_session(
+            NIGHT, ephem.Date(NIGHT + 2 * ephem.hour), -0.1,
+            phase)).scores("sac") for phase in (0, 1)]
+        self.assertTrue(np.array_equal(down[0], down[1]))
+
+    def test_airmass(self):
+        table = self.db.get_catalog("sac")
+        ra, dec = table.cols.ra[:], table.cols.dec[:]
+        scores = []
+        altitudes = []
+        for hour in xrange(8):
+            date = ephem.Date(NIGHT - 4 * ephem.hour + hour * ephem.hour)
+            night = self.create_session(date, date, -0.1, 0)
+            scores.append(scoring.NightScorer(self.db, night).scores("sac"))
+            altitudes.append(night.altitudes(
+                *night.apparent_positions(ra, dec))[:, 0])
+        scores = np.array(scores)
+        altitudes = np.array(altitudes)
+
+        #for every object, lower means a worse score
+        order = np.argsort(-altitudes, axis=0)
+        ranked = scores[order, np.arange(scores.shape[1])]
+        self.assertTrue((np.diff(ranked, axis=0) <= EPSILON).all())
+        self.assertTrue((np.diff(ranked, axis=0) < -0.1).any())
+
+        self.assertTrue((np.diff(scoring.airmass(
+            np.radians(np.arange(90, -1, -5)))) > 0).all())
+
+    def test_best(self):
+        scorer = scoring.NightScorer(self.db, self.create_session(
+            NIGHT, ephem.Date(NIGHT + 2 * ephem.hour), -0.1, 0))
+        scores = scorer.scores("sac")
+        best = scorer.best("sac")
+        self.assertEqual(len(best), (scores > 0).sum())
+        self.assertTrue(all(scorer.score(b) > 0 for b in best))
+
+        #a row left empty by an update is not an object
+        visible = best[0]._nrow
+        best[0].name = ""
+        self.assertEqual(list(self.db.deleted_rows("sac")), [visible])
+        best = scorer.best("sac")
+        self.assertEqual(len(best), (scorer.scores("sac") > 0).sum() - 1)
+        self.assertNotIn(visible, [b._nrow for b in best])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib
+import urllib2
+
+from astro_organizer import server
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestQueryServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.server = server.QueryServer(("localhost", 0), database, workers=2,
+                                        migrate=True)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = "http://localhost:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.tmpdir)
+
+    def get(self, path, params = ()):
+        url = self.url + path
+        if params:
+            url += "?" + urllib.urlencode(params)
+        return urllib2.urlopen(url).read()
+
+    def get_json(self, path, params = ()):
+        return json.loads(self.get(path, params))
+
+    def assertStatus(self, code, path, params = ()):
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            self.get(path, params)
+        self.assertEqual(cm.exception.code, code)
+
+    def test_catalogs(self):
+        self.assertIn("sac", self.get_json("/catalogs"))
+
+    def test_find(self):
+        found = self.get_json("/find", [("name", "M31"), ("catalog", "sac")])
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0]["name"].strip(), "NGC  224")
+        self.assertEqual(found[0]["table"], "sac")
+
+    def test_query(self):
+        params = [("catalog", "sac"), ("filter", "body_type:GALXY"),
+                  ("filter", "min_size:5"),
+                  ("filter", "limit_surface_brightness:13")]
+        result = self.get_json("/query", params)
+        self.assertEqual(result["total"], len(result["bodies"]))
+        for b in result["bodies"]:
+            self.assertEqual(b["body_type"], "GALXY")
+            self.assertGreaterEqual(b["size_max_arcsec"], 300)
+            self.assertLessEqual(b["surface_brightness_mag"], 13)
+
+        page = self.get_json("/query", params + [("offset", 2), ("limit", 3)])
+        self.assertEqual(page["bodies"], result["bodies"][2:5])
+
+    def test_bad_requests(self):
+        self.assertStatus(404, "/nothing")
+        self.assertStatus(400, "/query", [("catalog", "sac"),
+                                          ("filter", "no_filter:1")])
+        self.assertStatus(400, "/find")
+        self.assertStatus(404, "/tour", [("name", "no_tour")])
+
+    def test_tours(self):
+        names = self.get_json("/tours")
+        self.assertNotEqual(len(names), 0)
+        tour = self.get_json("/tour", [("name", names[0])])
+        self.assertEqual(tour["name"], names[0])
+        self.assertNotEqual(len(tour["bodies"]), 0)
+
+        text = self.get("/skysafari", [("name", names[0])])
+        self.assertTrue(text.startswith("SkySafariObservingListVersion"))
+
+    def test_skysafari_bodies(self):
+        text = self.get("/skysafari", [("body", "NGC  224")])
+        self.assertIn("NGC 224", text.replace("  ", " "))
+
+    def test_concurrent_clients(self):
+        expected = self.get("/find", [("name", "M13")])
+        results = []
+        def client():
+            for _ in xrange(20):
+                results.append(self.get("/find", [("name", "M13")]))
+        threads = [threading.Thread(target=client) for _ in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [expected] * 80)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from astro_organizer import catalogs
+from astro_organizer import filters
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestObservingSession(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_night_plan_computes_once(self):
+        night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+        master_filter = filters.MultiFilter()
+        master_filter.append(filters.observable(night))
+        master_filter.append(filters.limit_magnitude(7))
+        found = self.db.filter_catalog("sac", master_filter)
+        self.assertNotEqual(len(found), 0)
+
+        scorer = self.db.night_scorer("Grizzly", night)
+        ranked = sorted(found, key=scorer.score, reverse=True)
+        for b in ranked:
+            night.best_time(b)
+        #a second pass reuses everything
+        for b in ranked:
+            night.best_time(b)
+            night.is_up(b)
+
+        for name in ("twilight", "dates", "sidereal_times", "moon"):
+            self.assertEqual(night.computed[name], 1)
+        self.assertEqual(night.computed["best_time"], len(found))
+        self.assertEqual(night.computed["body_altitudes"], len(found))
+
+    def test_best_time_is_in_window(self):
+        night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+        m31 = list(self.db.find_body("M31", "sac"))[0]
+        self.assertTrue(night.is_up(m31))
+        best = night.best_time(m31)
+        self.assertTrue(night.start <= best <= night.end)
+        self.assertAlmostEqual(night.body_altitudes(m31).max(),
+                               night.altitudes(*night.apparent_positions(
+                                   [m31.ra], [m31.dec]))[0].max())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import ephem
+
+from astro_organizer import catalogs
+from astro_organizer import skychart
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class MockSkyChart(object):
+    """Answers the commands like the SkyChart server, after delay seconds,
+    and records them."""
+
+    def __init__(self, delay = 0.0, unknown = ()):
+        self.delay = delay
+        self.unknown = unknown
+        self.commands = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("localhost", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        connection = self.listener.accept()[0]
+        connection.sendall("OK! id=1 Welcome to Cartes du Ciel\r\n")
+        data = ""
+        while True:
+            received = connection.recv(1024)
+            if received == "":
+                break
+            data += received
+            while "\r\n" in data:
+                command, data = data.split("\r\n", 1)
+                self.commands.append(command)
+                time.sleep(self.delay)
+                if command.split(" ", 1)[1] in self.unknown:
+                    connection.sendall("Not found!\r\n")
+                else:
+                    connection.sendall("OK!\r\n")
+        connection.close()
+        self.listener.close()
+
+class TestSkyChart(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+        cls.tour = cls.db.get_tour("playback")
+        for name in ("M31", "M33", "M45", "M42", "M84", "M86"):
+            cls.tour.append(list(cls.db.find_body(name, "sac"))[0])
+        cls.night = cls.db.create_session("Grizzly", "2026/11/10 05:00")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_client(self):
+        server = MockSkyChart(unknown=("Vulcan",))
+        client = skychart.SkyChartClient("localhost", server.port)
+        self.assertTrue(client.search("M 31"))
+        self.assertFalse(client.search("Vulcan"))
+        self.assertTrue(client.setdate("2026/11/10 05:00"))
+        self.assertTrue(client.setdate("2026/11/10 05:00"))
+        self.assertTrue(client.setdate("2026/11/10 05:00", force=True))
+        client.close()
+        server.thread.join(5)
+        self.assertEqual([c.split(" ")[0] for c in server.commands],
+                         ["SEARCH", "SEARCH", "SETDATE", "SETDATE"])
+        self.assertEqual(server.commands[0], "SEARCH M31")
+
+    def test_playback(self):
+        #M86, searched by its catalog name
+        unknown = self.tour.ordered_bodies[-1].name.replace(" ", "")
+        server = MockSkyChart(delay=0.05, unknown=(unknown,))
+        client = skychart.SkyChartClient("localhost", server.port)
+        playback = skychart.TourPlayback(client, self.tour, self.night,
+                                         time_step=60)
+        dates = [d for _, d in playback.stops]
+        changes = 1 + sum(1 for a, b in zip(dates, dates[1:]) if a != b)
+        self.assertTrue(changes < len(dates))
+
+        sent = []
+        start = time.time()
+        results = playback.play(on_stop=lambda b, d: sent.append(
+            time.time()), wait=False)
+        #sent back to back, without waiting for the answers
+        self.assertTrue(sent[-1] - start < 0.05 * len(dates))
+        self.assertTrue(len(client.pending) > 0)
+        self.assertTrue(client.wait())
+
+        self.assertEqual([r[0] for r in results], self.tour.ordered_bodies)
+        self.assertEqual([r[2] for r in results], [True] * 5 + [False])
+        for (body_obj, date, ok), (_, expected) in zip(results,
+                                                       playback.stops):
+            self.assertEqual(date, expected)
+            self.assertTrue(abs(date - self.night.best_time(body_obj)) <=
+                            30 * ephem.minute)
+        client.close()
+        server.thread.join(5)
+        self.assertEqual(len([c for c in server.commands
+                              if c.startswith("SETDATE")]), changes)
+        self.assertEqual(len(server.commands), changes + len(dates))
+
+    def test_dwell(self):
+        server = MockSkyChart()
+        client = skychart.SkyChartClient("localhost", server.port)
+        playback = skychart.TourPlayback(client, self.tour, self.night,
+                                         field_of_view=40)
+        self.assertEqual(len(playback.stops), 5)
+        start = time.time()
+        results = playback.play(dwell=lambda b: 0.1)
+        self.assertTrue(time.time() - start >= 0.5)
+        #the answers arrive during the dwell times
+        self.assertEqual(len(client.pending), 0)
+        self.assertTrue(all(ok for _, _, ok in results))
+        client.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import tables
+
+from astro_organizer import catalogs
+from astro_organizer import storage
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestRepack(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, cls.database)
+        #upgraded and with a tour, a location and a calendar
+        db = catalogs.MasterDatabase(cls.database, migrate=True)
+        db.get_tour("repack").append(list(db.find_body("M31", "sac"))[0])
+        db.build_visibility_calendar("Grizzly", 2026)
+        db.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_round_trip(self):
+        for name in sorted(storage.PROFILES):
+            profile = storage.PROFILES[name]
+            destination = os.path.join(self.tmpdir, name + ".h5")
+            storage.repack(self.database, destination, name)
+            self.assertRaises(ValueError, storage.repack, self.database,
+                              destination, name)
+
+            src = tables.openFile(self.database, "r")
+            dst = tables.openFile(destination, "r")
+            try:
+                self.assertEqual(dst.root._v_attrs.storage_profile, name)
+                paths = [n._v_pathname for n in src.walkNodes("/")]
+                self.assertEqual(paths,
+                                 [n._v_pathname for n in dst.walkNodes("/")])
+                self.assertIn("/horizons", paths)
+                for path in paths:
+                    node = src.getNode(path)
+                    if isinstance(node, tables.Group):
+                        continue
+                    copy = dst.getNode(path)
+                    self.assertEqual(node.read().tostring(),
+                                     copy.read().tostring(), path)
+                    for attr in node._v_attrs._v_attrnamesuser:
+                        self.assertEqual(
+                            repr(getattr(node._v_attrs, attr)),
+                            repr(getattr(copy._v_attrs, attr)))
+                    kind = storage.table_kind(path)
+                    if kind is not None:
+                        self.assertEqual(copy.filters.complib,
+                                         profile.filters.complib)
+                        self.assertEqual(copy.filters.complevel,
+                                         profile.complevel)
+                        if profile.chunkshape(kind) is not None:
+                            self.assertEqual(copy.chunkshape,
+                                             profile.chunkshape(kind))
+            finally:
+                src.close()
+                dst.close()
+
+            #the new tables of the database use its profile
+            db = catalogs.MasterDatabase(destination)
+            try:
+                self.assertEqual(db.storage.name, name)
+                tour = db.get_tour("new")
+                self.assertEqual(tour._table.filters.complib,
+                                 profile.filters.complib)
+                self.assertEqual(len(db.get_tour("repack")), 1)
+            finally:
+                db.close()
+
+    def test_benchmark(self):
+        results = storage.benchmark(self.database, ["fast", "archival"],
+                                    nreads=20, nwrites=5)
+        self.assertEqual(sorted(results), ["archival", "fast"])
+        for result in results.values():
+            self.assertEqual(sorted(result), ["random_reads", "scan", "size",
+                                              "tours", "where", "writes"])
+            self.assertTrue(result["size"] > 0)
+            self.assertTrue(min(result.values()) >= 0)
+
+        self.assertEqual(storage.table_kind("/horizons"), "locations")
+        self.assertEqual(storage.table_kind("/catalogs/sac"), "catalog")
+        self.assertEqual(storage.table_kind("/calendars"), None)
+
+if __name__ == "__main__":
+    unittest.main()
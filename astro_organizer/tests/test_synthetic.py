@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from astro_organizer import catalogs
+from astro_organizer import filters
+from astro_organizer import query
+from astro_organizer import synthetic
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestOutOfCore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+        cls.table = synthetic.create_synthetic_catalog(cls.db, "synthetic",
+                                                       20000, seed=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_generated_catalog(self):
+        self.assertEqual(self.table.nrows, 20000)
+        self.assertEqual(self.table[19999]["name"], "SYN 20000")
+        self.assertEqual(len(self.db), self.db.get_catalog("sac").nrows +
+                         20000 - len(self.db.deleted_rows("sac")))
+        self.assertEqual(len(self.db.find_body("syn12345", "synthetic")), 1)
+
+    def test_chunks_match_whole_catalog(self):
+        expression = (query.mag <= 12) & (query.dec > 0)
+        expected = self.db.filter_catalog("synthetic", expression)
+        self.assertNotEqual(len(expected), 0)
+        self.assertEqual(list(self.db.iter_filter("synthetic", expression,
+                                                  chunk_rows=3000)), expected)
+
+        master_filter = filters.MultiFilter()
+        master_filter.append(filters.limit_magnitude(12))
+        master_filter.append(lambda b: b.dec > 0)
+        self.assertEqual(list(self.db.iter_filter("synthetic", master_filter,
+                                                  chunk_rows=3000)), expected)
+
+    def test_pages(self):
+        expression = (query.mag <= 11) & query.body_type.isin("GLOCL")
+        pages = []
+        cursor = 0
+        while cursor is not None:
+            page, cursor = self.db.filter_page("synthetic", expression, 7,
+                                               cursor)
+            self.assertTrue(len(page) <= 7)
+            pages.extend(page)
+        expected = self.db.filter_catalog("synthetic", expression)
+        self.assertEqual(pages, expected)
+        #once cached, the pages are read from the cache
+        self.assertEqual(self.db.filter_page("synthetic", expression, 3,
+                                             expected[2]._nrow)[0],
+                         expected[2:5])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from astro_organizer import catalogs
+from astro_organizer import filters
+from astro_organizer import synthetic
+from astro_organizer import text_index
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestTextIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_decode(self):
+        self.assertEqual(text_index.decode_ngc_description("pB;vS;eeF"),
+                         [[["pretty"], ["bright"]], [["very"], ["small"]],
+                          [["most", "extremely"], ["faint"]]])
+        terms = text_index.ngc_description_terms("vB;L;R")
+        self.assertTrue(set(["very bright", "large", "round"]) <= terms)
+        self.assertEqual(text_index.parse_query("very bright, large OR ring"),
+                         ((("very", "bright"), ("large",)), (("ring",),)))
+
+    def test_search_matches_scan(self):
+        table = self.db.get_catalog("sac")
+        expected = [n for n, d in enumerate(table.cols.ngc_descr[:])
+                    if "!!!" in d]
+        found = self.db.search_text("magnificent", "sac")
+        self.assertEqual([b._nrow for b in found], expected)
+
+        expected = [n for n, notes in enumerate(table.cols.notes[:])
+                    if "compact group" in notes.lower()]
+        found = self.db.search_text("compact group", "sac")
+        self.assertEqual([b._nrow for b in found], expected)
+
+    def test_combined_with_filters(self):
+        bright = self.db.search_text("very bright, large", "sac",
+                                     filters.limit_magnitude(8))
+        self.assertNotEqual(len(bright), 0)
+        self.assertTrue(all(b.mag <= 8 for b in bright))
+
+        master_filter = filters.MultiFilter()
+        master_filter.append(filters.text_match(self.db, "very bright, large"))
+        master_filter.append(filters.limit_magnitude(8))
+        self.assertEqual(self.db.filter_catalog("sac", master_filter), bright)
+
+    def test_additional_notes(self):
+        m31 = list(self.db.find_body("M31", "sac"))[0]
+        text_match = filters.MultiFilter()
+        text_match.append(filters.text_match(self.db, "zodiacal glow"))
+        self.assertEqual(self.db.filter_catalog("sac", text_match), [])
+        m31.additional_notes = "Zodiacal glow all over the field"
+        self.assertEqual(self.db.search_text("zodiacal glow"), [m31])
+        self.assertEqual(self.db.filter_catalog("sac", text_match), [m31])
+
+    def test_writes_patch_index(self):
+        database = os.path.join(self.tmpdir, "writes.h5")
+        shutil.copy(DATABASE, database)
+        db = catalogs.MasterDatabase(database, migrate=True)
+        try:
+            index = db.get_text_index("sac")
+            notes = index.notes
+            m31 = list(db.find_body("M31", "sac"))[0]
+            #not a text column, nothing to index again
+            m31.mag = 3.5
+            self.assertIs(db.get_text_index("sac"), index)
+            self.assertIs(index.notes, notes)
+
+            m31.notes = "Quokka shaped halo"
+            self.assertIs(db.get_text_index("sac"), index)
+            self.assertEqual(db.search_text("quokka shaped", "sac"), [m31])
+            m31.notes = "Wombat trail"
+            self.assertEqual(db.search_text("quokka shaped", "sac"), [])
+            self.assertEqual(db.search_text("wombat trail", "sac"), [m31])
+            built = text_index.build(db, "sac")
+            self.assertEqual(index.terms.tolist(), built.terms.tolist())
+            self.assertEqual(index.postings.tolist(),
+                             built.postings.tolist())
+        finally:
+            db.close()
+
+        #stored when closed
+        db = catalogs.MasterDatabase(database)
+        try:
+            stored = text_index.load(db.db, "sac")
+            self.assertEqual(stored.signature,
+                             text_index.signature(db, "sac"))
+            self.assertEqual(stored.terms.tolist(), built.terms.tolist())
+        finally:
+            db.close()
+
+    def test_reimported_catalog(self):
+        def expected():
+            table = self.db.get_catalog("syn")
+            return [n for n, d in enumerate(table.cols.ngc_descr[:])
+                    if "vF" in d]
+        def found():
+            return [b._nrow for b in self.db.search_text("very faint",
+                                                         "syn")]
+        synthetic.create_synthetic_catalog(self.db, "syn", 300, seed=0)
+        self.assertEqual(found(), expected())
+
+        #removed and imported again, other rows with as many rows
+        with self.db.writing():
+            self.db.db.removeNode("/catalogs", "syn")
+        synthetic.create_synthetic_catalog(self.db, "syn", 300, seed=1)
+        self.assertNotEqual(found(), [])
+        self.assertEqual(found(), expected())
+
+        #not the index stored in the database either
+        del self.db._text_indexes["syn"]
+        self.assertEqual(found(), expected())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import tables
+
+from astro_organizer import catalogs
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+SAC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                   "catalogues", "SAC_DeepSky_ver81",
+                   "SAC_DeepSky_Ver81_QCQ.TXT")
+
+class TestTourReferences(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, "database.h5")
+        shutil.copy(DATABASE, self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_explicit_migration(self):
+        #the bundled database has tours without references
+        handle = tables.openFile(self.database, "r")
+        try:
+            self.assertRaises(ValueError, catalogs.MasterDatabase, handle)
+            self.assertTrue(handle.isopen)
+        finally:
+            handle.close()
+        self.assertRaises(ValueError, catalogs.MasterDatabase, self.database)
+        handle = tables.openFile(self.database, "r")
+        try:
+            #left untouched
+            self.assertNotIn("size_max_arcsec",
+                             handle.root.catalogs.sac.colnames)
+            self.assertNotIn("nrow", handle.root.tours.sac_110_best.colnames)
+        finally:
+            handle.close()
+
+        db = catalogs.MasterDatabase(self.database, migrate=True)
+        try:
+            self.assertFalse(db.needs_migration)
+            for name in db.list_tours():
+                self.assertIn("nrow", db.db.getNode("/tours", name).colnames)
+            tour = db.get_tour("sac_110_best")
+            self.assertEqual(len(tour), tour._table.nrows)
+        finally:
+            db.close()
+        db = catalogs.MasterDatabase(tables.openFile(self.database, "r"))
+        try:
+            self.assertEqual(len(db.get_tour("sac_110_best")), len(tour))
+        finally:
+            db.close()
+
+    def test_stale_references_resolved_in_memory(self):
+        db = catalogs.MasterDatabase(self.database, migrate=True)
+        try:
+            tour = db.get_tour("sac_110_best")
+            bodies = tour.ordered_bodies
+            table = tour._table
+            table.cols.nrow[0] = (bodies[0]._nrow + 1) % 100
+            table.flush()
+            serial = db._write_serial
+
+            #read again: the reference is stale and resolved by name
+            tour = db.get_tour("sac_110_best")
+            self.assertEqual(tour.ordered_bodies, bodies)
+            self.assertEqual(db._write_serial, serial)
+            self.assertNotEqual(table.cols.nrow[0], bodies[0]._nrow)
+
+            self.assertEqual(tour.repair(), [])
+            self.assertEqual(table.cols.nrow[0], bodies[0]._nrow)
+            self.assertEqual(tour.ordered_bodies, bodies)
+        finally:
+            db.close()
+
+    def sac_lines(self, keep):
+        """Writes the SAC release with only the lines for which keep is 
+        True (the header is kept)."""
+        filename = os.path.join(self.tmpdir, "sac.txt")
+        with open(SAC) as f:
+            lines = f.readlines()
+        with open(filename, "w") as f:
+            f.writelines(lines[:1] + [l for l in lines[1:] if keep(l)])
+        return filename
+
+    def test_missing_bodies(self):
+        db = catalogs.MasterDatabase(self.database, migrate=True)
+        try:
+            tour = db.get_tour("sac_110_best")
+            bodies = tour.ordered_bodies
+            first, second = bodies[0], bodies[1]
+            first_name, second_name = first.name, second.name
+            def named(name):
+                return lambda line: line.startswith('"%s ' % name)
+
+            #a second catalog with the same name: the stale reference is
+            #ambiguous
+            db.load_sac("copy", self.sac_lines(named(first_name)))
+            tour._table.cols.nrow[0] = first._nrow + 1
+            tour._table.flush()
+            #the second body is removed by an update
+            db.load_sac("sac", self.sac_lines(
+                lambda line: not named(second_name)(line)), update=True)
+
+            tour = db.get_tour("sac_110_best")
+            self.assertEqual(tour.ordered_bodies, bodies[2:])
+            self.assertEqual(sorted(tour.missing),
+                             sorted([first_name, second_name]))
+            self.assertEqual(sorted(tour.repair()),
+                             sorted([first_name, second_name]))
+            self.assertEqual(len(tour), len(bodies) - 2)
+        finally:
+            db.close()
+
+class TestOrderedView(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(cls.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        cls.db = catalogs.MasterDatabase(database, migrate=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_view_follows_changes(self):
+        tour = self.db.get_tour("view")
+        m31, m33, m42 = [list(self.db.find_body(name, "sac"))[0]
+                         for name in ("M31", "M33", "M42")]
+        tour.append(m42, "Orion")
+        tour.append(m31)
+        self.assertEqual(tour.ordered_bodies, [m42, m31])
+
+        tour.append(m33)
+        self.assertEqual(list(tour), [m42, m31, m33])
+        self.assertEqual(len(tour), 3)
+        self.assertEqual(tour[2], m33)
+
+        tour.filter_fun = lambda b: b.constellation != "ORI"
+        self.assertEqual(tour.ordered_bodies, [m31, m33])
+        self.assertEqual(list(tour.iteritems()), [(m31, ""), (m33, "")])
+        tour.extend([m42])
+        #the duplicate keeps its first position and is still filtered
+        self.assertEqual(tour.ordered_bodies, [m31, m33])
+        tour.filter_fun = lambda b: True
+        self.assertEqual(tour.ordered_bodies, [m42, m31, m33])
+        self.assertEqual(tour.note(m42), "Orion")
+
+        #a new instance reads the same view from the database
+        self.assertEqual(self.db.get_tour("view").ordered_bodies,
+                         [m42, m31, m33])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import ephem
+import numpy as np
+
+from astro_organizer import catalogs
+from astro_organizer import query
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                        "main_database.h5")
+
+class TestVisibilityTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(self.tmpdir, "database.h5")
+        shutil.copy(DATABASE, database)
+        self.db = catalogs.MasterDatabase(database, migrate=True)
+        self.night = self.db.create_session("Grizzly", "2026/11/10 05:00")
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def visible_at(self, nrows, date):
+        """The rows up at date, computed from scratch."""
+        data = self.db.get_catalog("sac").readCoordinates(nrows)
+        ra, dec = self.night.apparent_positions(data["ra"], data["dec"])
+        lat = float(self.night.observer.lat)
+        self.night.observer.date = date
+        lst = float(self.night.observer.sidereal_time())
+        alt = np.arcsin(np.sin(lat) * np.sin(dec) + np.cos(lat) *
+                        np.cos(dec) * np.cos(lst - ra))
+        return set(nrows[alt > self.night.minimum_altitudes(0)])
+
+    def test_events_match_recomputation(self):
+        tracker = self.db.visibility_tracker("sac", self.night,
+                                             query.mag <= 10)
+        risen, set_ = [], []
+        tracker.subscribe(on_rise=lambda b, t: risen.append(b),
+                          on_set=lambda b, t: set_.append(b))
+        self.assertTrue(0 < tracker.visible.sum() < len(tracker.nrows))
+
+        total = 0
+        for hours in (1, 2.5, 6):
+            date = ephem.Date(self.night.start + hours * ephem.hour)
+            total += tracker.advance(date)
+            expected = self.visible_at(tracker.nrows, date)
+            #the objects crossing the horizon within a minute can differ
+            difference = expected.symmetric_difference(
+                tracker.visible_rows())
+            self.assertTrue(len(difference) <= 3, difference)
+        self.assertEqual(len(risen) + len(set_), total)
+        self.assertNotEqual(len(risen), 0)
+        self.assertNotEqual(len(set_), 0)
+        self.assertRaises(ValueError, tracker.advance,
+                          ephem.Date(self.night.start))
+
+        upcoming = tracker.upcoming(5)
+        self.assertTrue(all(t >= tracker.clock for t, _, _ in upcoming))
+
+    def test_catalog_change_notifies(self):
+        tracker = self.db.visibility_tracker("sac", self.night,
+                                             query.mag <= 10)
+        tracker.advance(ephem.Date(self.night.start + ephem.hour))
+        body_obj = self.db.get_bodies("sac", tracker.visible_rows()[:1])[0]
+        gone = []
+        tracker.subscribe(on_set=lambda b, t: gone.append(b))
+        #moved to the other side of the sky
+        body_obj.dec = -body_obj.dec
+        body_obj.ra = (body_obj.ra + np.pi) % (2 * np.pi)
+        tracker.advance(ephem.Date(self.night.start + ephem.hour))
+        self.assertIn(body_obj, gone)
+        self.assertFalse(tracker.is_visible(body_obj))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import math
+import unittest
+
+import ephem
+import numpy as np
+
+from astro_organizer import visibility
+
+DUSK = ephem.Date("2026/1/10 00:00")
+
+class TestNightVisibility(unittest.TestCase):
+
+    def compare(self, latitude, dec, hour_angle, hours):
+        """Checks night_visibility against ephem, sampling the night every
+        minute, for an object at a given hour angle at dusk."""
+        observer = ephem.Observer()
+        observer.lat = math.radians(latitude)
+        observer.lon = 0
+        observer.pressure = 0
+        observer.date = DUSK
+        lst = float(observer.sidereal_time())
+
+        star = ephem.FixedBody()
+        star._ra = (lst - hour_angle) % (2 * math.pi)
+        star._dec = math.radians(dec)
+        star._epoch = DUSK
+        star.compute(observer)
+        ra, dec = float(star.ra), float(star.dec)
+
+        start, end, peak = visibility.night_visibility(
+            [ra], [dec], math.radians(latitude), 0, np.array([lst]),
+            np.array([hours / 24.0]))
+        start, end, peak = start[0, 0], end[0, 0], peak[0, 0]
+
+        altitudes = []
+        for minute in xrange(int(hours * 60) + 1):
+            observer.date = DUSK + minute * ephem.minute
+            star.compute(observer)
+            altitudes.append(math.degrees(star.alt))
+        altitudes = np.array(altitudes)
+        self.assertAlmostEqual(peak, altitudes.max(), 1)
+
+        #the passes above the horizon, in minutes after dusk
+        up = np.concatenate(([False], altitudes > 0, [False]))
+        edges = np.nonzero(up[1:] != up[:-1])[0]
+        passes = zip(edges[::2], edges[1::2] - 1)
+        if len(passes) == 0:
+            self.assertTrue(np.isnan(start) and np.isnan(end))
+            return passes
+        first, last = max(passes, key=lambda p: p[1] - p[0])
+        self.assertTrue(abs(start * 60 - first) <= 2, (start * 60, first))
+        self.assertTrue(abs(end * 60 - last) <= 2, (end * 60, last))
+        return passes
+
+    def test_culminates_in_the_night(self):
+        self.compare(45, 20, -1.0, 8)
+
+    def test_culminates_after_dawn(self):
+        #rising at dusk, the meridian is crossed only after dawn: the peak is
+        #at dawn, not on the meridian
+        passes = self.compare(45, 20, -math.pi + 0.2, 8)
+        self.assertEqual(len(passes), 1)
+
+    def test_setting(self):
+        self.compare(45, -10, 0.5, 8)
+
+    def test_never_up(self):
+        self.compare(45, -60, 0, 8)
+
+    def test_two_passes(self):
+        #sets and rises again in a long night: the longer pass is kept
+        passes = self.compare(60, 25, 2.0, 14)
+        self.assertEqual(len(passes), 2)
+
+    def test_circumpolar(self):
+        #up all night, not two passes meeting below the pole
+        passes = self.compare(60, 70, 2.0, 14)
+        self.assertEqual(len(passes), 1)
+        self.assertEqual(passes[0], (0, 14 * 60))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,384 @@
+import re
+import time
+import logging
+import collections
+import numpy as np
+import tables
+
+import body
+import storage
+import string_conversions
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+#the parts of a text that can't form a phrase together
+_NOTES_SEGMENTS = re.compile(r"[;,.:()]")
+
+_STOPWORDS = frozenset(["a", "an", "and", "at", "by", "for", "from", "in",
+                        "of", "on", "or", "the", "to", "w", "with"])
+
+#the abbreviations of the NGC descriptions, the longest first so that "eeF"
+#is read as ee-F rather than e-e-F
+_NGC_ABBREVIATION = re.compile("|".join(
+    re.escape(k) for k in sorted(string_conversions.ngc_dict, key=len,
+                                 reverse=True)))
+
+#p is preceding, unless it comes before an adjective: pB, pL...
+_PRETTY = ["pretty"]
+
+def _words(text):
+    return [w for w in _WORD.findall(text.lower()) if w not in _STOPWORDS]
+
+_NGC_WORDS = dict((k, _words(v))
+                  for k, v in string_conversions.ngc_dict.iteritems())
+
+def decode_ngc_description(description):
+    """Decodes an NGC description (e.g. "vF;vS;mE") into the words of its
+    abbreviations (see string_conversions.ngc_dict). Unlike
+    string_conversions.ngc_to_string, what isn't an abbreviation (numbers,
+    names...) is skipped instead of making the whole clause fail.
+
+    Returns:
+    a list with a list for each clause (separated by ";"), with a list of
+    words for each abbreviation, e.g. [[["very"], ["faint"]], ...]
+    """
+    clauses = []
+    for clause in description.split(";"):
+        matches = list(_NGC_ABBREVIATION.finditer(clause))
+        decoded = []
+        for i, match in enumerate(matches):
+            abbreviation = match.group()
+            following = matches[i + 1] if i + 1 < len(matches) else None
+            if (abbreviation == "p" and following is not None and
+                following.start() == match.end() and
+                following.group()[0].isupper()):
+                decoded.append(_PRETTY)
+            else:
+                decoded.append(_NGC_WORDS[abbreviation])
+        clauses.append([d for d in decoded if len(d) != 0])
+    return clauses
+
+def ngc_description_terms(description):
+    """Returns the terms of an NGC description: the words of its
+    abbreviations and the phrases of two words ("very faint") made by two
+    abbreviations in a row."""
+    terms = set()
+    for clause in decode_ngc_description(description):
+        for i, words in enumerate(clause):
+            terms.update(words)
+            if i + 1 < len(clause):
+                terms.update("%s %s" % (w1, w2) for w1 in words
+                             for w2 in clause[i + 1])
+    return terms
+
+def text_terms(text):
+    """Returns the terms of a free text: its words and the phrases made by
+    two words in a row."""
+    terms = set()
+    for segment in _NOTES_SEGMENTS.split(text):
+        words = _words(segment)
+        terms.update(words)
+        terms.update("%s %s" % pair for pair in zip(words, words[1:]))
+    return terms
+
+def parse_query(query):
+    """Parses a text query: alternatives separated by OR, each made of
+    phrases separated by commas (or AND) that must all match. The words of a
+    phrase must appear in the same order, two by two, where the index has
+    them as a phrase, otherwise anywhere in the text.
+
+    Example:
+    "very bright, large, round OR planetary" is (very bright and large and
+    round) or planetary
+
+    Returns:
+    a tuple of alternatives, each a tuple of phrases, each a tuple of words
+    """
+    alternatives = []
+    for alternative in re.split(r"\bOR\b", query):
+        phrases = []
+        for phrase in re.split(r",|\bAND\b", alternative):
+            words = tuple(_words(phrase))
+            if len(words) != 0:
+                phrases.append(words)
+        if len(phrases) != 0:
+            alternatives.append(tuple(phrases))
+    return tuple(alternatives)
+
+#the columns of a catalog the index is built from
+COLUMNS = ["name", "notes", "ngc_descr"]
+
+def notes_generation(db):
+    """Returns a counter increased every time an additional note is written
+    (see body.Body.additional_notes)."""
+    return body.table_generation(db.root.notes)
+
+def _intersect(short, longer):
+    """The intersection of two sorted arrays, with a binary search of each
+    element of the short one in the other."""
+    if len(longer) == 0:
+        return longer
+    i = np.minimum(np.searchsorted(longer, short), len(longer) - 1)
+    return short[longer[i] == short]
+
+class TextIndex(object):
+    """An inverted index of the words of a catalog: for each term (a word, or
+    two words in a row) of the notes, of the additional notes and of the
+    decoded NGC descriptions (see decode_ngc_description), the sorted row
+    numbers of the objects whose texts contain it.
+
+    The terms are kept in a sorted array and the lists of row numbers
+    (the postings) are concatenated in a single array, with the offset of the
+    postings of each term in another one. They are stored in the
+    /text_index group of the database (see save) and kept in memory once
+    loaded.
+
+    The additional notes change more often than the catalogs and are few:
+    they have their own small index, notes, rebuilt in memory when they
+    change (see catalogs.MasterDatabase.get_text_index). The postings of a
+    term are those of both.
+
+    Attributes:
+    catalog: the name of the catalog
+    signature: the token, the number of rows and the generation of the
+               catalog (and of the additional notes for notes) the index has
+               been built from, see signature
+    notes: the TextIndex of the additional notes, or None
+    """
+
+    def __init__(self, catalog, signature, terms, offsets, postings):
+        self.catalog = catalog
+        self.signature = signature
+        self.terms = terms
+        self.offsets = offsets
+        self.postings = postings
+        self._positions = dict((t, i) for i, t in enumerate(terms.tolist()))
+        self.notes = None
+
+    def __repr__(self):
+        return "TextIndex: %s, %d terms, %d postings" % (
+            self.catalog, len(self.terms), self.offsets[-1])
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __get_notes(self):
+        return self._notes
+
+    def __set_notes(self, notes):
+        self._notes = notes
+        #the postings of the terms also in the notes, merged
+        self._merged = {}
+
+    notes = property(__get_notes, __set_notes)
+
+    def __contains__(self, term):
+        return term in self._positions or (self.notes is not None and
+                                           term in self.notes)
+
+    def rows(self, term):
+        """Returns the row numbers of a term, a sorted array."""
+        i = self._positions.get(term)
+        if i is None:
+            rows = self.postings[:0]
+        else:
+            rows = self.postings[self.offsets[i]:self.offsets[i + 1]]
+        if self.notes is not None and term in self.notes:
+            merged = self._merged.get(term)
+            if merged is None:
+                merged = self._merged[term] = np.union1d(
+                    rows, self.notes.rows(term))
+            rows = merged
+        return rows
+
+    def __phrase_rows(self, words):
+        """The rows of a phrase: its words two by two where the index has the
+        pair as a term, one by one otherwise."""
+        postings = []
+        i = 0
+        while i < len(words):
+            if i + 1 < len(words):
+                pair = "%s %s" % (words[i], words[i + 1])
+                if pair in self:
+                    postings.append(self.rows(pair))
+                    i += 2
+                    continue
+            postings.append(self.rows(words[i]))
+            i += 1
+        return postings
+
+    def search(self, query):
+        """Returns the row numbers matching a query (see parse_query), a
+        sorted array. The query can be parsed already."""
+        if isinstance(query, basestring):
+            query = parse_query(query)
+        ret = None
+        for alternative in query:
+            postings = []
+            for phrase in alternative:
+                postings.extend(self.__phrase_rows(phrase))
+            #the shortest first, the intersection only gets shorter
+            postings.sort(key=len)
+            rows = postings[0]
+            for p in postings[1:]:
+                if len(rows) == 0:
+                    break
+                rows = _intersect(rows, p)
+            ret = rows if ret is None else np.union1d(ret, rows)
+        if ret is None:
+            return self.postings[:0]
+        return ret
+
+    def replace(self, nrows, old_rows, new_rows):
+        """Updates the index after some rows of the catalog have been 
+        replaced, instead of building it again: only the postings of the 
+        terms of these rows change. The signature and the index of the 
+        additional notes are not changed.
+
+        Parameters:
+        nrows: the row numbers
+        old_rows: a structured array with the name, notes and ngc_descr of
+                  the rows before, None if they have just been appended
+        new_rows: the same, after
+        """
+        removed = collections.defaultdict(set)
+        added = collections.defaultdict(set)
+        known = {}
+        for rows, rows_of in ((old_rows, removed), (new_rows, added)):
+            if rows is None:
+                continue
+            for nrow, name, notes, descr in zip(nrows, rows["name"],
+                                                rows["notes"],
+                                                rows["ngc_descr"]):
+                if name != "":
+                    for term in _row_terms(notes, descr, known):
+                        rows_of[term].add(int(nrow))
+        changed = set(removed) | set(added)
+        if len(changed) == 0:
+            return
+
+        postings = dict((t, self.postings[self.offsets[i]:
+                                          self.offsets[i + 1]])
+                        for t, i in self._positions.iteritems())
+        for term in changed:
+            rows = ((set(postings.get(term, self.postings[:0]).tolist()) -
+                     removed[term]) | added[term])
+            if len(rows) == 0:
+                postings.pop(term, None)
+            else:
+                postings[term] = np.array(sorted(rows), self.postings.dtype)
+        terms = sorted(postings)
+        self.terms, self.offsets, self.postings = _arrays(
+            terms, [postings[t] for t in terms])
+        self._positions = dict((t, i) for i, t in enumerate(terms))
+        self._merged = {}
+
+    def save(self, db, filters = None):
+        """Stores the index in the /text_index group of db, replacing the
+        previous one of the catalog."""
+        if "/text_index" not in db:
+            db.createGroup("/", "text_index")
+        if self.catalog in db.root.text_index:
+            db.removeNode("/text_index", self.catalog, recursive=True)
+        group = db.createGroup("/text_index", self.catalog)
+        group._v_attrs.signature = self.signature
+        #empty arrays can't be stored
+        for name in ("terms", "offsets", "postings"):
+            array = getattr(self, name)
+            if len(array) == 0:
+                array = np.zeros(1, array.dtype)
+            db.createCArray(group, name, tables.Atom.from_dtype(array.dtype),
+                            array.shape, filters=filters)[:] = array
+        group._v_attrs.nterms = len(self.terms)
+        db.flush()
+
+def load(db, catalog):
+    """Returns the TextIndex of a catalog stored in db, None if there is
+    none."""
+    try:
+        group = db.getNode("/text_index", catalog)
+    except tables.NoSuchNodeError:
+        return None
+    nterms = group._v_attrs.nterms
+    return TextIndex(catalog, group._v_attrs.signature,
+                     group.terms[:nterms], group.offsets[:nterms + 1],
+                     group.postings[:group.offsets[nterms]])
+
+def signature(master_db, catalog):
+    """Returns the signature a TextIndex of the columns of a catalog must
+    have to be up to date. The token of the table tells a catalog removed
+    and imported again from the one the index was built from, even with the
+    same number of rows and generation (see body.table_token)."""
+    table = master_db.get_catalog(catalog)
+    return (body.table_token(table), table.nrows,
+            body.table_generation(table))
+
+def notes_signature(master_db, catalog):
+    """Returns the signature a TextIndex of the additional notes of a catalog
+    must have to be up to date."""
+    return signature(master_db, catalog) + (notes_generation(master_db.db),)
+
+def _arrays(terms, lists):
+    """The terms, offsets and postings arrays of a TextIndex, from the sorted
+    terms and their sorted row numbers."""
+    offsets = np.zeros(len(terms) + 1, np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in lists])
+    postings = np.empty(offsets[-1], np.int32)
+    for i, l in enumerate(lists):
+        postings[offsets[i]:offsets[i + 1]] = l
+    return np.array(terms, dtype="S"), offsets, postings
+
+def _from_postings(catalog, sig, rows_of):
+    terms = sorted(rows_of)
+    lists = [sorted(set(rows_of[t])) for t in terms]
+    return TextIndex(catalog, sig, *_arrays(terms, lists))
+
+def _row_terms(notes, descr, known):
+    """The terms of the notes and the NGC description of an object. known
+    maps the descriptions already decoded to their terms: most of them are
+    repeated many times ("eF;vS")."""
+    terms = known.get(descr)
+    if terms is None:
+        terms = known[descr] = ngc_description_terms(descr)
+    return terms | text_terms(notes)
+
+def build(master_db, catalog):
+    """Builds the TextIndex of the notes and the NGC descriptions of a
+    catalog, with a single read of the two columns."""
+    start = time.time()
+    sig = signature(master_db, catalog)
+    rows_of = collections.defaultdict(list)
+    known = {}
+    for block in master_db.iter_chunks(catalog, COLUMNS):
+        for i, (name, notes, descr) in enumerate(zip(block["name"],
+                                                     block["notes"],
+                                                     block["ngc_descr"])):
+            if name == "":
+                #a deleted object, see catalogs.MasterDatabase.deleted_rows
+                continue
+            nrow = block.start + i
+            for term in _row_terms(notes, descr, known):
+                rows_of[term].append(nrow)
+    index = _from_postings(catalog, sig, rows_of)
+    logging.info("Built %s in %.2f s", index, time.time() - start)
+    return index
+
+def build_notes(master_db, catalog):
+    """Builds the TextIndex of the additional notes of the objects of a
+    catalog (see body.Body.additional_notes)."""
+    sig = notes_signature(master_db, catalog)
+    with storage.hdf5_lock:
+        notes = dict((node.name, node.cols.additional_notes[:])
+                     for node in master_db.db.root.notes)
+    rows_of = collections.defaultdict(list)
+    if len(notes) != 0:
+        for block in master_db.iter_chunks(catalog, ["name"]):
+            for i, name in enumerate(block["name"]):
+                if name not in notes:
+                    continue
+                terms = set()
+                for note in notes[name]:
+                    terms |= text_terms(note)
+                for term in terms:
+                    rows_of[term].append(block.start + i)
+    return _from_postings(catalog, sig, rows_of)
@@ -1,17 +1,73 @@
 import catalogs
 import body
+import fields
+import storage
 
 import tables
 import logging
-import itertools
+import zlib
 
 class _TourTable(tables.IsDescription):
     name = tables.StringCol(20)
     note = tables.StringCol(512)
+    #where the body is stored, so that it can be fetched directly. The 
+    #checksum of the name tells if the reference went stale.
+    catalog = tables.StringCol(32)
+    nrow = tables.Int64Col(dflt=-1)
+    checksum = tables.UInt32Col()
+
+def name_checksum(name):
+    """Returns the checksum of a body name stored in the tour tables."""
+    return zlib.crc32(name) & 0xffffffff
+
+def _pick(name, candidates):
+    """Returns the only body among candidates named name, None if there is none
+    or more than one."""
+    if len(candidates) == 1:
+        return iter(candidates).next()
+    exact = [b for b in candidates if b.name == name]
+    if len(exact) == 1:
+        return exact[0]
+    return None
+
+def upgrade_table(db, table):
+    """Rewrites a tour table created before the (catalog, nrow) references
+    were introduced, resolving each name once. Returns the new table. To be
+    called within catalogs.MasterDatabase.writing (see 
+    catalogs.MasterDatabase.migrate_tours)."""
+    logging.info("Upgrading tour %s", table.name)
+    names = table.cols.name[:]
+    notes = table.cols.note[:]
+    found = db.resolve_names(names)
+    
+    name = table.name
+    new_table = db.db.createTable("/tours", name + "__upgrade", _TourTable,
+                                  table.title, 
+                                  **db.storage.table_options("tour"))
+    row = new_table.row
+    for n, note in zip(names, notes):
+        row["name"] = n
+        row["note"] = note
+        row["checksum"] = name_checksum(n)
+        b = _pick(n, found[n])
+        if b is None:
+            logging.warn("Could not resolve %s in tour %s", n, name)
+        else:
+            row["catalog"] = b._table.name
+            row["nrow"] = b._nrow
+        row.append()
+    new_table.flush()
+    table._f_remove()
+    new_table._f_rename(name)
+    return new_table
 
 class Tour(object):
     """Defines a tour as a list of objects to view and notes. It automatically
-    manages the entries in the database"""
+    manages the entries in the database.
+    
+    The entries whose body can't be found any more (removed from its catalog,
+    or its name now matches several bodies) are left out, their names are in
+    missing. See repair."""
     
     def __init__(self, tourname, db, title=""):
         """
@@ -25,40 +81,133 @@ class Tour(object):
         self._db = db        
         assert isinstance(db, catalogs.MasterDatabase)
         
-        try: 
-            self._table = db.db.getNode("/tours",tourname)
-        except tables.NoSuchNodeError:
-            self._table = db.db.createTable("/tours", tourname, _TourTable,
-                                           title,
-                                           createparents=True)
-        
-        self.title = self._table.title
-        self._bodies = set()
-        self._notes = []
-        self._positions = {}
-        self.__load_bodies()
-        self.filter_fun = lambda x : True
+        with storage.hdf5_lock:
+            path = "/tours/" + tourname
+            if path in db.db:
+                self._table = db.db.getNode(path)
+            else:
+                with db.writing():
+                    self._table = db.db.createTable("/tours", tourname, 
+                                                    _TourTable, title,
+                                                    createparents=True,
+                                                    **db.storage.table_options(
+                                                        "tour"))
+                    db._created(self._table)
+            
+            self.title = self._table.title
+            self._filter_fun = lambda x : True
+            self.__load_bodies()
 
+    @property
+    def _has_references(self):
+        """False for a tour table created before the (catalog, nrow) 
+        references were introduced, not yet upgraded (see 
+        catalogs.MasterDatabase.migrate_tours)."""
+        return "nrow" in self._table.colnames
+    
     def __load_bodies(self):
+        """Reads the tour. The bodies whose reference is stale are looked up
+        again by name, in memory only: see repair to store them. Those that
+        can't be found are skipped and listed in missing."""
+        self.missing = []
         self._bodies = set()
-        names = []
+        self._notes = []
+        self._positions = {}
+        self._view = None
         
-        for row in self._table.iterrows():
-            n = row["name"]
-            names.append(n)
-            self._notes.append(row["note"])
-            self._positions[n] = row.nrow
+        rows = self._table.read()
+        found = self.__fetch(rows)
+        stale = []
+        for i, entry in enumerate(rows):
+            if found[i] is None:
+                stale.append(i)
+            else:
+                self._bodies.add(found[i])
+                self._positions.setdefault(found[i], i)
+            self._notes.append(entry["note"])
         
-        if len(names) == 0:
-            return 
+        if len(stale) == 0:
+            return
+        logging.info("%d stale entries in tour %s", len(stale), self.name)
+        resolved, missing = self.__resolve(stale, rows["name"][stale])
+        for i, b in resolved:
+            self._bodies.add(b)
+            self._positions.setdefault(b, i)
+        if len(missing) != 0:
+            logging.warn("Tour %s: %d bodies found over %d total, missing: "
+                         "%s", self.name, len(rows) - len(missing), len(rows),
+                         ", ".join(missing))
+            self.missing = missing
+    
+    def __fetch(self, rows):
+        """Returns the bodies referenced by some rows of the tour table, None 
+        where the reference is stale. The names are read once per catalog to
+        validate the references."""
+        found = [None] * len(rows)
+        if not self._has_references:
+            return found
+        for catalog in set(rows["catalog"]):
+            try:
+                table = self._db.get_catalog(catalog)
+            except tables.NoSuchNodeError:
+                continue
+            indices = [i for i, entry in enumerate(rows) 
+                       if entry["catalog"] == catalog and 
+                       0 <= entry["nrow"] < table.nrows]
+            if len(indices) == 0:
+                continue
+            nrows = rows["nrow"][indices]
+            names = table.readCoordinates(nrows, field="name")
+            for i, nrow, name in zip(indices, nrows, names):
+                if name_checksum(name) == rows[i]["checksum"]:
+                    found[i] = self._db._get_body(table, nrow)
+        return found
+    
+    def __resolve(self, indices, names):
+        """Looks up again by name the bodies of some rows.
         
-        s = self._db.find_bodies(names)
-        nbodies = self._table.nrows
-        if len(s) != nbodies:
-            raise Exception("Mismatch: %d bodies found over %d total" %(len(s),
-                                                                        nbodies)
-                                                                        )
-        self._bodies = s
+        Returns:
+        a tuple (resolved, missing): a list of (row index, body.Body) and the
+        names that could not be resolved
+        """
+        found = self._db.resolve_names(names)
+        resolved = []
+        missing = []
+        for i, n in zip(indices, names):
+            b = _pick(n, found[n])
+            if b is None:
+                missing.append(n)
+            else:
+                resolved.append((i, b))
+        return resolved, missing
+    
+    def repair(self):
+        """Checks that all the bodies referenced by the tour are still where 
+        they were added (e.g. after a catalog has been reloaded), looking them 
+        up again by name if they are not, and stores the new references.
+        
+        Returns:
+        the list of names that could not be found.
+        """
+        with self._db.writing():
+            if not self._has_references:
+                raise ValueError("Tour %s must be upgraded first, see "
+                                 "MasterDatabase.migrate_tours" % self.name)
+            rows = self._table.read()
+            stale = [i for i, b in enumerate(self.__fetch(rows)) if b is None]
+            if len(stale) == 0:
+                return []
+            logging.info("Repairing %d entries of tour %s", len(stale), 
+                         self.name)
+            resolved, missing = self.__resolve(stale, rows["name"][stale])
+            self._db._tour_modified(self)
+            for i, b in resolved:
+                self._table.cols.catalog[i] = b._table.name
+                self._table.cols.nrow[i] = b._nrow
+                self._table.cols.checksum[i] = name_checksum(b.name)
+            self._db._written(self._table)
+            self.__load_bodies()
+            return missing
     
     def append(self, body_obj, note=""):
         """Add an element to the tour.
@@ -77,15 +226,85 @@ class Tour(object):
             body_obj = s.pop()
         
         assert isinstance(body_obj, body.Body)
-        row = self._table.row
-        row["name"] = body_obj.name
-        row["note"] = note
-        row.append()
-        self._table.flush()
+        self.__append_rows([body_obj], [note])
+    
+    def extend(self, bodies, notes = None):
+        """Add several elements to the tour at once. The names are resolved in
+        a single pass (see catalogs.MasterDatabase.resolve_names) and the tour
+        is written only once. Nothing is added if any name can't be resolved.
         
-        self._bodies.add(body_obj)
-        self._notes.append(note)
-        self._positions[body_obj.name] = self._table.nrows - 1
+        Parameters:
+        bodies: an iterable over strings or body.Body instances. Strings must 
+                match exactly one body.
+        notes: None or an iterable of notes, one for each body.
+        """
+        bodies = list(bodies)
+        if notes is None:
+            notes = [""] * len(bodies)
+        else:
+            notes = list(notes)
+        if len(notes) != len(bodies):
+            raise ValueError("%d notes for %d bodies" % (len(notes), 
+                                                          len(bodies)))
+        
+        names = [b for b in bodies if type(b) is str]
+        found = self._db.resolve_names(names)
+        for name, s in found.iteritems():
+            if len(s) == 0:
+                raise Exception("No body found with name %s" % name)
+            elif len(s) > 1:
+                raise Exception("%d bodies found with name %s" % (len(s), name))
+        
+        bodies = [iter(found[b]).next() if type(b) is str else b 
+                  for b in bodies]
+        for b in bodies:
+            assert isinstance(b, body.Body)
+        self.__append_rows(bodies, notes)
+    
+    def __names(self, bodies):
+        """Returns the names of some bodies, read at once for each catalog."""
+        names = [None] * len(bodies)
+        by_table = {}
+        for i, body_obj in enumerate(bodies):
+            by_table.setdefault(body_obj._table, []).append(i)
+        for table, indices in by_table.iteritems():
+            if len(indices) == 1:
+                names[indices[0]] = bodies[indices[0]].name
+                continue
+            nrows = [bodies[i]._nrow for i in indices]
+            for i, name in zip(indices, table.readCoordinates(nrows, 
+                                                              field="name")):
+                names[i] = name
+        return names
+    
+    def __append_rows(self, bodies, notes):
+        with self._db.writing():
+            if not self._has_references:
+                raise ValueError("Tour %s must be upgraded first, see "
+                                 "MasterDatabase.migrate_tours" % self.name)
+            self._db._appending(self._table)
+            self._db._tour_modified(self)
+            names = self.__names(bodies)
+            row = self._table.row
+            for body_obj, name, note in zip(bodies, names, notes):
+                row["name"] = name
+                row["note"] = note
+                row["catalog"] = body_obj._table.name
+                row["nrow"] = body_obj._nrow
+                row["checksum"] = name_checksum(name)
+                row.append()
+                
+                self._bodies.add(body_obj)
+                self._notes.append(note)
+                self._positions.setdefault(body_obj, len(self._notes) - 1)
+            self._view = None
+            self._db._written(self._table)
+    
+    def _reload(self):
+        """Reloads the tour from the database, discarding the state in 
+        memory."""
+        with storage.hdf5_lock:
+            self.__load_bodies()
     
     def delete(self):
         """Removes the tour from the database.
@@ -93,19 +312,34 @@ class Tour(object):
         be safe to delete it as well.
         """
         
-        self._db.db.removeNode("/tours", self.name)
+        with self._db.writing():
+            self._db.db.removeNode("/tours", self.name)
+    
+    def __ordered_view(self):
+        """The filtered bodies, in tour order. It is computed only after the
+        tour or the filter change."""
+        if self._view is None:
+            self._view = sorted(filter(self._filter_fun, self._bodies),
+                                key = self._positions.__getitem__)
+        return self._view
     
     def __getitem__(self, i):        
-        return (self.ordered_bodies[i])
+        return self.__ordered_view()[i]
 
     def __iter__(self):
-        return iter(self.ordered_bodies)
+        return iter(self.__ordered_view())
     
     def iteritems(self):
-        return itertools.izip(self.bodies, self._notes)
+        """Iterates over (body, note) in tour order."""
+        return ((b, self._notes[self._positions[b]]) 
+                for b in self.__ordered_view())
     
     def __len__(self):
-        return len(self.bodies)
+        return len(self.__ordered_view())
+    
+    def note(self, body_obj):
+        """Returns the note of a body of the tour."""
+        return self._notes[self._positions[body_obj]]
     
     def __repr__(self):
         if self.title != "":
@@ -113,24 +347,51 @@ class Tour(object):
         else:
             return "Tour: %s" %(self.name)
 
+    def __get_filter_fun(self):
+        return self._filter_fun
+    
+    def __set_filter_fun(self, value):
+        assert callable(value)
+        self._filter_fun = value
+        self._view = None
+    
+    filter_fun = property(__get_filter_fun, __set_filter_fun, 
+                          doc="Only the bodies for which filter_fun is True "
+                          "are part of the tour.")
+    
     @property
     def bodies(self):
-        return filter(self.filter_fun, self._bodies)
+        return list(self.__ordered_view())
     
     @property
     def ordered_bodies(self):
-        return sorted(self.bodies,
-                      key = lambda b: self._positions[b.name]
-                      )
+        return list(self.__ordered_view())
 
     
+    def field_groups(self, field_of_view):
+        """Groups the bodies of the tour that fit in the same eyepiece field,
+        see fields.group_bodies.
+        
+        Parameters:
+        field_of_view: the diameter of the field (arc minutes)
+        
+        Returns:
+        a list of fields.FieldGroup, in tour order
+        """
+        return fields.group_bodies(self.__ordered_view(), field_of_view)
+    
     def sky_safari_entry(self, add_notes = True,
                          add_additional_notes = True,
                          add_ngc_description = True,
-                         use_additional_names = False
+                         use_additional_names = False,
+                         field_of_view = None
                          ):
         """Creates a Sky Safari Observation list from this tour.
         Returns the string.
+        
+        If field_of_view (arc minutes) is not None, the bodies in the same
+        eyepiece field (see field_groups) are a single stop: the one the 
+        field is centered on, with the others listed in its comment.
         """
         def __note_filter(note):
             if note != "":
@@ -138,15 +399,32 @@ class Tour(object):
             else:
                 return None
         
+        if field_of_view is None:
+            stops = [(body, __note_filter(note)) 
+                     for body, note in self.iteritems()]
+        else:
+            stops = []
+            for group in self.field_groups(field_of_view):
+                comment = __note_filter(self.note(group.lead))
+                others = group.others
+                if len(others) != 0:
+                    same_field = "Same field: " + ", ".join(
+                        " ".join(b.name.split()) for b in others)
+                    notes = [__note_filter(self.note(b)) for b in others]
+                    same_field = " || ".join([same_field] + 
+                                             [n for n in notes if n])
+                    comment = (same_field if comment is None else 
+                               comment + " || " + same_field)
+                stops.append((group.lead, comment))
+        
         ret = "SkySafariObservingListVersion=3.0\n"
         ret += "\n".join(body.sky_safari_entry(add_notes,
                                                add_additional_notes,
                                                add_ngc_description,
-                                               __note_filter(note),
+                                               comment,
                                                use_additional_names
                                                )
-                         for body,note in zip(self.ordered_bodies,
-                                              self._notes)
+                         for body, comment in stops
                          )
                                                
         return ret
@@ -0,0 +1,224 @@
+import time
+import logging
+import ephem
+import numpy as np
+
+import body
+import utils
+import columnar
+
+class VisibilityTracker(object):
+    """Keeps the set of the objects of a catalog above the horizon up to date
+    as the clock moves forward, e.g. for a live display, without computing
+    the visibility of every object again at each refresh.
+
+    The risings and settings of all the objects in the time window of a
+    session.ObservingSession are computed once, in blocks of rows on the
+    grid of times of the session, with its horizon and horizon profile (see
+    session.ObservingSession.minimum_altitudes). The time of each event is
+    interpolated between the two times of the grid around it. The events are
+    kept ordered by time in three compact arrays (time, row, rising: 13
+    bytes per event), and advance replays those that happened since the
+    last call: finding them is a binary search, applying each one is O(1).
+    The objects visible are kept in a boolean array indexed by position.
+
+    The subscribers (see subscribe) are called for each rising and setting.
+    If the catalog is modified the events are computed again, from the
+    current time, and the subscribers are told about the objects whose
+    visibility changed.
+
+    A tracker must not be shared among threads.
+
+    Attributes:
+    catalog: the name of the catalog
+    session: the session.ObservingSession
+    clock: the time of the last advance, an ephem date
+    nrows: the row numbers of the objects tracked, sorted
+    """
+
+    def __init__(self, master_db, catalog, night, master_filter = None):
+        """
+        Parameters:
+        master_db: a catalogs.MasterDatabase instance
+        catalog: the name of the catalog
+        night: a session.ObservingSession, whose time window and grid are
+               used
+        master_filter: if not None, only the objects it accepts are tracked
+                       (see catalogs.MasterDatabase.iter_filter), e.g.
+                       query.mag <= 10
+        """
+        self._master_db = master_db
+        self.catalog = catalog
+        self.session = night
+        self.master_filter = master_filter
+        self.clock = night.start
+        self._subscribers = []
+        self.__compute()
+        self.visible = self._initially_visible.copy()
+
+    def __repr__(self):
+        return "VisibilityTracker: %s, %d objects, %d visible at %s" % (
+            self.catalog, len(self.nrows), self.visible.sum(),
+            ephem.Date(self.clock))
+
+    def __compute(self):
+        """Computes the events of the whole time window."""
+        start = time.time()
+        table = self._master_db.get_catalog(self.catalog)
+        self._generation = body.table_generation(table)
+        night = self.session
+        dates = night.dates
+        ephemeris = self._master_db.get_ephemeris(self.catalog)
+        if self.master_filter is None:
+            selected = None
+        else:
+            selected = np.array([b._nrow for b in self._master_db.iter_filter(
+                self.catalog, self.master_filter)], np.int64)
+
+        nrows = []
+        initially_visible = []
+        times = []
+        positions = []
+        rising = []
+        count = 0
+        for block in self._master_db.iter_chunks(self.catalog, ["ra", "dec"],
+                                                 columnar.SCAN_ROWS):
+            block_nrows = block.nrows
+            ra, dec = block["ra"], block["dec"]
+            if selected is not None:
+                keep = np.in1d(block_nrows, selected)
+                block_nrows, ra, dec = block_nrows[keep], ra[keep], dec[keep]
+            if len(block_nrows) == 0:
+                continue
+            ra, dec = night.positions(ra, dec, ephemeris, block_nrows)
+            alt, az = night.alt_az(ra, dec)
+            with np.errstate(invalid="ignore"):
+                height = alt - night.minimum_altitudes(az)
+                up = height > 0
+            nrows.append(block_nrows)
+            initially_visible.append(up[:, 0])
+
+            #the crossings between two times of the grid
+            obj, step = np.nonzero(up[:, 1:] != up[:, :-1])
+            before, after = height[obj, step], height[obj, step + 1]
+            fraction = before / (before - after)
+            times.append(dates[step] + fraction *
+                         (dates[step + 1] - dates[step]))
+            positions.append(count + obj)
+            rising.append(after > 0)
+            count += len(block_nrows)
+
+        def joined(arrays, dtype):
+            if len(arrays) == 0:
+                return np.zeros(0, dtype)
+            return np.concatenate(arrays).astype(dtype)
+
+        self.nrows = joined(nrows, np.int64)
+        self._initially_visible = joined(initially_visible, bool)
+        event_times = joined(times, np.float64)
+        order = np.argsort(event_times, kind="mergesort")
+        self._event_times = event_times[order]
+        self._event_positions = joined(positions, np.int32)[order]
+        self._event_rising = joined(rising, bool)[order]
+        self._next = 0
+        logging.debug("%s: %d events of %d objects computed in %.2f s",
+                      self.catalog, len(self._event_times), len(self.nrows),
+                      time.time() - start)
+
+    def subscribe(self, on_rise = None, on_set = None):
+        """Adds a subscriber: on_rise and on_set (if not None) are called
+        with the body.Body and the time (an ephem date) of each rising and
+        setting replayed by advance."""
+        self._subscribers.append((on_rise, on_set))
+
+    def unsubscribe(self, on_rise = None, on_set = None):
+        """Removes a subscriber added by subscribe."""
+        self._subscribers.remove((on_rise, on_set))
+
+    def __notify(self, position, rising, when):
+        body_obj = self._master_db.get_bodies(
+            self.catalog, [self.nrows[position]])[0]
+        for on_rise, on_set in self._subscribers:
+            callback = on_rise if rising else on_set
+            if callback is not None:
+                callback(body_obj, ephem.Date(when))
+
+    def advance(self, to_time = "now"):
+        """Moves the clock forward, applying the risings and the settings up
+        to to_time and calling the subscribers.
+
+        Parameters:
+        to_time: any value utils.create_date accepts, not before the clock.
+                 Past the end of the time window of the session, the
+                 objects stay as they are at the end.
+
+        Returns:
+        the number of events applied
+        """
+        to_time = float(utils.create_date(to_time))
+        if to_time < self.clock:
+            raise ValueError("The clock of a tracker only moves forward")
+        table = self._master_db.get_catalog(self.catalog)
+        if body.table_generation(table) != self._generation:
+            self.__refresh()
+
+        last = np.searchsorted(self._event_times, to_time, side="right")
+        first = self._next
+        positions = self._event_positions[first:last]
+        rising = self._event_rising[first:last]
+        if len(self._subscribers) == 0:
+            #applied in order, the last event of each object wins
+            self.visible[positions] = rising
+        else:
+            for position, up, when in zip(positions, rising,
+                                          self._event_times[first:last]):
+                self.visible[position] = up
+                self.__notify(position, up, when)
+        self._next = last
+        self.clock = to_time
+        return last - first
+
+    def __refresh(self):
+        """Computes the events again after a change of the catalog and
+        notifies the changes of visibility at the current time."""
+        old_nrows, old_visible = self.nrows, self.visible
+        self.__compute()
+        self._next = np.searchsorted(self._event_times, self.clock,
+                                     side="right")
+        visible = self._initially_visible.copy()
+        positions = self._event_positions[:self._next]
+        visible[positions] = self._event_rising[:self._next]
+        self.visible = visible
+
+        was_visible = np.zeros(len(self.nrows), bool)
+        known = np.in1d(old_nrows, self.nrows)
+        was_visible[np.searchsorted(self.nrows, old_nrows[known])] = \
+            old_visible[known]
+        for position in np.nonzero(visible != was_visible)[0]:
+            self.__notify(position, visible[position], self.clock)
+
+    def visible_rows(self):
+        """Returns the row numbers of the objects visible, sorted."""
+        return self.nrows[self.visible]
+
+    def visible_bodies(self):
+        """Returns the body.Body instances of the objects visible."""
+        return self._master_db.get_bodies(self.catalog, self.visible_rows())
+
+    def is_visible(self, body_obj):
+        """Returns True if a body.Body of the catalog is tracked and
+        visible."""
+        i = np.searchsorted(self.nrows, body_obj._nrow)
+        return bool(i < len(self.nrows) and self.nrows[i] == body_obj._nrow
+                    and self.visible[i])
+
+    def upcoming(self, count = 10):
+        """Returns the next events: a list of (time, body.Body, rising)
+        tuples, rising True for a rising."""
+        last = self._next + count
+        positions = self._event_positions[self._next:last]
+        bodies = self._master_db.get_bodies(self.catalog,
+                                            self.nrows[positions])
+        return [(ephem.Date(t), b, bool(r)) for t, b, r in
+                zip(self._event_times[self._next:last], bodies,
+                    self._event_rising[self._next:last])]
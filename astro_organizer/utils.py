@@ -6,11 +6,12 @@ import dateutil.parser
 import logging
 import pytz
 import webbrowser
+import numpy as np
 
 import catalogs
 import body
-
-from scipy import optimize
+import string_conversions
+import session
 
 def create_catalog_from_sac(name, master_db, sac_file_obj,):
     """Creates an h5 catalog from a Saguaro Astronomical Catalog cvs file.
@@ -34,7 +35,9 @@ def create_catalog_from_sac(name, master_db, sac_file_obj,):
     
     group = db.getNode("/", "catalogs")
     
-    table = db.createTable(group, name, catalogs._TableBody, "SAC Database")
+    table = db.createTable(group, name, catalogs._TableBody, "SAC Database",
+                           **master_db.storage.table_options("catalog"))
+    body.stamp_table(table)
     element = table.row    
         
     if type(sac_file_obj) is str:
@@ -45,42 +48,116 @@ def create_catalog_from_sac(name, master_db, sac_file_obj,):
     reader.next()
     
     for raw_line in reader:
-        line = [obj.strip() for obj in raw_line]
-        element['name'] = line[0]
-        element['additional_names'] = line[1]
-        element['body_type'] = line[2]
-        element['constellation'] = line[3]
-    
-        element['ra'] = ephem.hours(line[4])
-        element['dec'] = ephem.degrees(line[5])
-        element['mag'] = float(line[6])
-    
-        try:
-            element['surface_brightness'] = float(line[7])
-        except ValueError:
-            element['surface_brightness'] = float(line[6])
-            
-        element['size_max'] = line[10]
-        element['size_min'] = line[11]
-        try:
-            element['positional_angle'] = math.radians(float(line[12]))
-        except ValueError:
-            element['positional_angle'] = 0
-            
-        element['sci_class'] = line[13]
-        try:
-            element['central_star_mag'] = float(line[15])
-        except ValueError:
-            element['central_star_mag'] = float(line[6])
-        element['catalog'] = line[16]
-        element['ngc_descr'] = line[17]
-        element['notes'] = line[18]
-        
+        fill_sac_row(element, raw_line)
         element.append()
             
     db.flush()
     return master_db        
 
+def fill_sac_row(element, raw_line):
+    """Fills a catalog row from a line of the SAC csv file.
+    
+    Parameters:
+    element: a tables.Row or a record of a NumPy array with the catalog dtype
+    raw_line: the list of fields of the line
+    """
+    line = [obj.strip() for obj in raw_line]
+    element['name'] = line[0]
+    element['additional_names'] = line[1]
+    element['body_type'] = line[2]
+    element['constellation'] = line[3]
+
+    element['ra'] = ephem.hours(line[4])
+    element['dec'] = ephem.degrees(line[5])
+    element['mag'] = float(line[6])
+
+    try:
+        element['surface_brightness'] = float(line[7])
+    except ValueError:
+        element['surface_brightness'] = float(line[6])
+    element['surface_brightness_mag'] = \
+        string_conversions.surface_brightness_to_float(line[7])
+        
+    element['size_max'] = line[10]
+    element['size_min'] = line[11]
+    element['size_max_arcsec'] = string_conversions.size_to_arcsec(line[10])
+    element['size_min_arcsec'] = string_conversions.size_to_arcsec(line[11])
+    try:
+        element['positional_angle'] = math.radians(float(line[12]))
+    except ValueError:
+        element['positional_angle'] = 0
+        
+    element['sci_class'] = line[13]
+    try:
+        element['central_star_mag'] = float(line[15])
+    except ValueError:
+        element['central_star_mag'] = float(line[6])
+    element['catalog'] = line[16]
+    element['ngc_descr'] = line[17]
+    element['notes'] = line[18]
+
+def read_sac_rows(sac_file_obj, dtype, batch_rows = 1024):
+    """Reads a Saguaro Astronomical Catalog csv file in blocks of rows, 
+    without keeping it all in memory.
+    
+    Parameters:
+    sac_file_obj: either a file or a string with its name
+    dtype: the dtype of the catalog table
+    batch_rows: how many rows each block has at most
+    
+    Returns:
+    a generator of NumPy structured arrays
+    """
+    if type(sac_file_obj) is str:
+        sac_file_obj = open(sac_file_obj)
+    reader = csv.reader(sac_file_obj, delimiter = ',')
+    #skip first line with the field names
+    reader.next()
+    
+    block = np.zeros(batch_rows, dtype=dtype)
+    n = 0
+    for raw_line in reader:
+        fill_sac_row(block[n], raw_line)
+        n += 1
+        if n == batch_rows:
+            yield block
+            block = np.zeros(batch_rows, dtype=dtype)
+            n = 0
+    if n > 0:
+        yield block[:n]
+
+def upgrade_catalog(master_db, table):
+    """Rewrites a catalog created before the numeric size and surface 
+    brightness columns were introduced, filling them from the string columns.
+    The order of the rows is kept, so the references to them (e.g. in the 
+    tours) stay valid. Returns the new table."""
+    logging.info("Upgrading catalog %s", table.name)
+    db = master_db.db
+    name = table.name
+    new_table = db.createTable("/catalogs", name + "__upgrade", 
+                               catalogs._TableBody, table.title,
+                               **master_db.storage.table_options("catalog"))
+    data = np.zeros(table.nrows, dtype=new_table.dtype)
+    old = table.read()
+    for colname in table.colnames:
+        data[colname] = old[colname]
+    data["size_max_arcsec"] = [string_conversions.size_to_arcsec(s)
+                               for s in old["size_max"]]
+    data["size_min_arcsec"] = [string_conversions.size_to_arcsec(s)
+                               for s in old["size_min"]]
+    data["surface_brightness_mag"] = [
+        string_conversions.surface_brightness_to_float(s)
+        for s in old["surface_brightness"]]
+    new_table.append(data)
+    new_table.flush()
+    
+    for attr in table._v_attrs._v_attrnamesuser:
+        setattr(new_table._v_attrs, attr, getattr(table._v_attrs, attr))
+    table._f_remove()
+    new_table._f_rename(name)
+    body.touch_table(new_table)
+    return new_table
+
 def sunset(observer):
     """Returns the astronomical sunset time according to observer. 
     The observer's day is used for this calculation.
@@ -196,27 +273,11 @@ def find_best_observable_time(body_obj, observer, start_time, end_time):
     
     Returns:
     an ephem.Date instance.
+    
+    When planning more than one body, create one session.ObservingSession and
+    use its best_time method instead.
     """
     
     assert isinstance(body_obj, body.Body)
-    start_time = create_date(start_time)
-    end_time = create_date(end_time)
-        
-    ephem_body = body_obj.ephem_body
-    
-    observer = copy_observer(observer)
-    
-    def neg_altitude(time):
-        observer.date = time[0]
-        ephem_body.compute(observer)
-        return -ephem_body.alt
-    
-    middtime = start_time + (end_time - start_time) / 2
-    best_time = optimize.fmin_l_bfgs_b(neg_altitude, [middtime],
-                                       bounds=[(start_time, end_time)],
-                                       approx_grad=True,
-                                       epsilon=ephem.minute
-                                       )
-    
-    return ephem.Date(best_time[0])
-            
\ No newline at end of file
+    return session.ObservingSession(observer, start_time,
+                                    end_time).best_time(body_obj)
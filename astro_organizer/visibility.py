@@ -0,0 +1,506 @@
+import ephem
+import math
+import zlib
+import logging
+import numpy as np
+import tables
+
+import utils
+import ephemerides
+
+#sidereal radians swept in one (solar) day
+_SIDEREAL_RATE = 2 * math.pi * 1.00273790935
+
+#number of catalog rows computed at once while building a calendar
+_BLOCK_ROWS = 4096
+
+#standard refraction at the horizon, as applied by ephem with the default
+#pressure
+_REFRACTION = math.radians(34.0 / 60)
+
+#values stored in the calendar arrays are scaled to 16 bits integers: times in
+#minutes after dusk and altitudes in tenths of degree.
+_MISSING = -32768
+_TIME_SCALE = 60.0
+_ALT_SCALE = 10.0
+
+#version of the computation stored in the calendars: older calendars are 
+#rebuilt by update_calendars
+_VERSION = 3
+
+#time step used to check if a moving body is up in a time window (days)
+_UP_STEP = 10 * ephem.minute
+
+#chunk shape of the (objects x nights) arrays. It is a compromise between the
+#two typical accesses: one night for all the objects and one object for all
+#the nights.
+_CHUNKSHAPE = (256, 64)
+
+
+def calendar_name(location, year):
+    """Returns the name of the node storing the calendar of a location and a
+    year."""
+    name = "".join(c if c.isalnum() else "_" for c in location.lower())
+    return "%s_%d" % (name, year)
+
+
+def catalog_signature(table):
+    """Returns a number that changes whenever the positions stored in a catalog
+    change."""
+    if table.nrows == 0:
+        return 0
+    crc = zlib.crc32(table.cols.ra[:].tostring())
+    crc = zlib.crc32(table.cols.dec[:].tostring(), crc)
+    ephemeris = ephemerides.load(table)
+    if ephemeris is not None:
+        crc = zlib.crc32(repr((ephemeris.start, ephemeris.end)), crc)
+    return crc & 0xffffffff
+
+
+def apparent_positions(ra, dec, date):
+    """Precesses J2000 positions to the apparent geocentric place at date.
+
+    Parameters:
+    ra, dec: arrays of J2000 coordinates (radians)
+    date: an ephem.Date
+
+    Returns:
+    a tuple of two arrays (ra, dec), in radians
+    """
+    body = ephem.FixedBody()
+    body._epoch = ephem.J2000
+    app_ra = np.empty(len(ra))
+    app_dec = np.empty(len(dec))
+    for i in xrange(len(ra)):
+        body._ra = ra[i]
+        body._dec = dec[i]
+        body.compute(date)
+        app_ra[i] = body.g_ra
+        app_dec[i] = body.g_dec
+    return app_ra, app_dec
+
+
+def moving_body_up(ephemeris, nrow, observer, start, end, horizon):
+    """Returns True if a moving body is above the horizon at least once 
+    between start and end, sampled every 10 minutes.
+
+    Parameters:
+    ephemeris: the ephemerides.Ephemeris of the catalog of the body
+    nrow: the row of the body
+    observer: an ephem.Observer instance
+    start, end: ephem dates
+    horizon: the minimum altitude (radians)
+    """
+    dates = np.append(np.arange(start, end, _UP_STEP), end)
+    ra, dec = ephemeris.positions(dates, [nrow])
+    if np.isnan(ra).any():
+        raise ValueError("%s is not covered by %s" % (ephem.Date(end),
+                                                      ephemeris))
+    ra, dec = apparent_positions(ra[0], dec[0], (start + end) / 2)
+    observer = utils.copy_observer(observer)
+    observer.date = start
+    lst = observer.sidereal_time() + (dates - start) * _SIDEREAL_RATE
+    lat = float(observer.lat)
+    alt = np.arcsin(math.sin(lat) * np.sin(dec) +
+                    math.cos(lat) * np.cos(dec) * np.cos(lst - ra))
+    return bool((alt > horizon - _REFRACTION).any())
+
+
+def dark_windows(observer, year):
+    """Computes the astronomical night (dusk to dawn) of every day in a year.
+
+    Parameters:
+    observer: an ephem.Observer instance
+    year: an integer
+
+    Returns:
+    an array of shape (ndays, 2) with the dusk and dawn of every night, as
+    ephem dates. Nights without astronomical darkness are NaN.
+    """
+    observer = utils.copy_observer(observer)
+    observer.horizon = "-18" #astronomical twilight
+    sun = ephem.Sun()
+
+    first_day = ephem.Date("%d/1/1" % year)
+    ndays = int(ephem.Date("%d/1/1" % (year + 1)) - first_day)
+    #local noon, roughly, so that next_setting returns the evening dusk
+    noon_offset = 0.5 - float(observer.lon) / (2 * math.pi)
+
+    nights = np.empty((ndays, 2))
+    nights.fill(np.nan)
+    for day in xrange(ndays):
+        observer.date = first_day + day + noon_offset
+        try:
+            dusk = observer.next_setting(sun, use_center=True)
+            observer.date = dusk
+            dawn = observer.next_rising(sun, use_center=True)
+        except (ephem.AlwaysUpError, ephem.NeverUpError):
+            continue
+        nights[day] = (dusk, dawn)
+    return nights
+
+
+def dark_window(observer):
+    """Computes the astronomical night (dusk to dawn) containing the date of
+    an observer, or the following one if it is during the day.
+
+    Returns:
+    a tuple (dusk, dawn) of ephem dates. ValueError is raised if there is no
+    astronomical darkness.
+    """
+    observer = utils.copy_observer(observer)
+    observer.horizon = "-18" #astronomical twilight
+    sun = ephem.Sun()
+    try:
+        dawn = observer.next_rising(sun, use_center=True)
+        observer.date = dawn
+        dusk = observer.previous_setting(sun, use_center=True)
+    except (ephem.AlwaysUpError, ephem.NeverUpError):
+        raise ValueError("No astronomical darkness at %s on %s" % (
+            observer.name, observer.date))
+    return dusk, dawn
+
+
+def night_visibility(ra, dec, latitude, horizon, lst_dusk, night_length):
+    """Vectorized visibility of a set of objects over a set of nights.
+
+    Parameters:
+    ra, dec: arrays with the apparent positions of the objects (radians), or
+             (objects x nights) arrays for the objects that move
+    latitude: the observer's latitude (radians)
+    horizon: the minimum altitude (radians)
+    lst_dusk: an array with the local sidereal time at each dusk (radians)
+    night_length: an array with the length of each night (days)
+
+    Returns:
+    a tuple of three (objects x nights) arrays (start, end, peak_alt): the
+    rising and the setting of the object during the night, in hours after
+    dusk (NaN if it is never up), and the maximum altitude reached in the
+    night, in degrees. The rising is at dusk if the object is already up, 
+    the setting at dawn if it is still up. In a long night an object close
+    to the pole can set and rise again: start and end are then those of the 
+    longer of the two passes, so that end - start is always a time the 
+    object is up. A circumpolar object is up from dusk to dawn.
+    """
+    ra = np.asarray(ra)
+    dec = np.asarray(dec)
+    if ra.ndim == 1:
+        ra = ra[:, np.newaxis]
+        dec = dec[:, np.newaxis]
+    span = (np.asarray(night_length) * _SIDEREAL_RATE)[np.newaxis, :]
+
+    sin_lat, cos_lat = math.sin(latitude), math.cos(latitude)
+    sin_dec, cos_dec = np.sin(dec), np.cos(dec)
+
+    #the object is up while its hour angle is within [-h0, h0]
+    c = (math.sin(horizon) - sin_lat * sin_dec) / (cos_lat * cos_dec)
+    h0 = np.arccos(np.clip(c, -1, 1))
+
+    #hour angle at dusk, wrapped in [-pi, pi), and at dawn
+    h1 = np.mod(lst_dusk[np.newaxis, :] - ra + math.pi, 2 * math.pi) - math.pi
+    h2 = h1 + span
+
+    #a night is shorter than a sidereal day, so only two passes can overlap
+    s0, e0 = np.maximum(h1, -h0), np.minimum(h2, h0)
+    s1, e1 = np.maximum(h1, 2 * math.pi - h0), np.minimum(h2, 2 * math.pi + h0)
+    up0 = (s0 < e0) & (c <= 1)
+    up1 = (s1 < e1) & (c <= 1)
+
+    hours = 24 * night_length[np.newaxis, :] / span
+    first = np.where(up0, e0 - s0, -1) >= np.where(up1, e1 - s1, -1)
+    start = np.where(up0 | up1, np.where(first, s0, s1), np.nan)
+    end = np.where(up0 | up1, np.where(first, e0, e1), np.nan)
+    start = (start - h1) * hours
+    end = (end - h1) * hours
+    #circumpolar: the two passes meet at h = pi, it is one pass
+    circumpolar = c <= -1
+    start = np.where(circumpolar, 0, start)
+    end = np.where(circumpolar, 24 * night_length[np.newaxis, :], end)
+
+    def altitude(h):
+        return np.arcsin(np.clip(sin_lat * sin_dec + cos_lat * cos_dec * np.cos(h),
+                                 -1, 1))
+    #the meridian (h = 0 or 2 pi) is crossed during the night
+    culminates = ((h1 <= 0) & (h2 >= 0)) | (h2 >= 2 * math.pi)
+    peak = np.where(culminates,
+                    altitude(np.zeros_like(h1)),
+                    np.maximum(altitude(h1), altitude(h2)))
+
+    return start, end, np.degrees(peak)
+
+
+class VisibilityCalendar(object):
+    """A precomputed visibility calendar for a location and a year, stored in
+    the /visibility group of the database.
+
+    For each catalog there are three (objects x nights) 16 bits arrays:
+    start, end: the dark-time interval when the object is above the horizon, in
+                minutes after dusk
+    peak_alt: the highest altitude reached during the dark time, in tenths of
+              degree
+    Missing values (the object is never up or there is no darkness) are stored
+    as -32768. The methods below convert them back to hours and degrees.
+    """
+
+    def __init__(self, master_db, group):
+        self._master_db = master_db
+        self._group = group
+        self.location = group._v_attrs.location
+        self.year = group._v_attrs.year
+        self.nights = group.nights[:]
+
+    def __repr__(self):
+        return "VisibilityCalendar: %s %d" % (self.location, self.year)
+
+    @property
+    def catalogs(self):
+        return self._group._v_groups.keys()
+
+    def night_index(self, time = "now"):
+        """Returns the index of the night containing time, or the following
+        one if time is during the day."""
+        t = utils.create_date(time)
+        dawns = self.nights[:, 1]
+        valid = np.nonzero(~np.isnan(dawns))[0]
+        i = np.searchsorted(dawns[valid], t, side="right")
+        if i == len(valid):
+            raise ValueError("%s is not covered by %s" % (ephem.Date(t), self))
+        return valid[i]
+
+    def observable(self, night, catalog, min_altitude = None, min_hours = 0):
+        """Returns the row numbers of the objects of catalog that are up in the
+        dark time of a night.
+
+        Parameters:
+        night: the index of the night (see night_index)
+        catalog: the name of the catalog
+        min_altitude: if not None, the minimum peak altitude (degrees)
+        min_hours: the minimum number of dark hours the object is up
+        """
+        node = self._group._f_getChild(catalog)
+        start = node.start[:, night].astype(np.int32)
+        end = node.end[:, night]
+        mask = (start != _MISSING) & (end - start >= min_hours * _TIME_SCALE)
+        if min_altitude is not None:
+            mask &= node.peak_alt[:, night] >= min_altitude * _ALT_SCALE
+        return np.nonzero(mask)[0]
+
+    def best_nights(self, catalog, nrow, count = 10):
+        """Returns the best nights to observe an object, sorted by decreasing
+        peak altitude.
+
+        Returns:
+        a list of (dusk, peak altitude, hours up) tuples, dusk is an ephem.Date
+        """
+        node = self._group._f_getChild(catalog)
+        start = node.start[nrow].astype(np.int32)
+        end = node.end[nrow]
+        peak = node.peak_alt[nrow] / _ALT_SCALE
+        hours = (end - start) / _TIME_SCALE
+        candidates = np.nonzero(start != _MISSING)[0]
+        order = np.lexsort((-hours[candidates], -peak[candidates]))
+        return [(ephem.Date(self.nights[i, 0]), peak[i], hours[i])
+                for i in candidates[order[:count]]]
+
+
+def build_calendar(master_db, location, year, horizon = 0):
+    """Precomputes the visibility of every catalog object over a year.
+
+    Parameters:
+    master_db: a catalogs.MasterDatabase instance
+    location: the name of a location in the database
+    year: an integer
+    horizon: the minimum altitude (degrees)
+
+    Returns:
+    a VisibilityCalendar instance. An existing calendar is replaced.
+    """
+    db = master_db.db
+    observer = master_db.create_observer(location)
+    name = calendar_name(observer.name, year)
+
+    if name in db.root.visibility:
+        db.removeNode("/visibility", name, recursive=True)
+    group = db.createGroup("/visibility", name)
+    attrs = group._v_attrs
+    attrs.location = observer.name
+    attrs.year = year
+    attrs.latitude = float(observer.lat)
+    attrs.longitude = float(observer.lon)
+    attrs.elevation = float(observer.elev)
+    attrs.horizon = float(horizon)
+    attrs.version = _VERSION
+
+    nights = dark_windows(observer, year)
+    db.createArray(group, "nights", nights, "Dusk and dawn of every night")
+
+    for table in db.root.catalogs:
+        _build_catalog(group, table)
+    db.flush()
+    return VisibilityCalendar(master_db, group)
+
+
+def _build_catalog(group, table):
+    logging.debug("Building visibility of %s in %s", table.name, group._v_name)
+    nnights = len(group.nights)
+
+    if table.name in group:
+        group._f_getChild(table.name)._f_remove(recursive=True)
+    node = group._v_file.createGroup(group, table.name)
+    node._v_attrs.signature = catalog_signature(table)
+
+    shape = (table.nrows, nnights)
+    chunkshape = (max(1, min(_CHUNKSHAPE[0], table.nrows)),
+                  min(_CHUNKSHAPE[1], nnights))
+    arrays = {}
+    for field in ("start", "end", "peak_alt"):
+        arrays[field] = group._v_file.createCArray(node, field,
+                                                   tables.Int16Atom(dflt=_MISSING),
+                                                   shape,
+                                                   chunkshape=chunkshape)
+    if table.nrows == 0:
+        return
+
+    dusks = _dusks(group)
+    ephemeris = ephemerides.load(table)
+    for first in xrange(0, table.nrows, _BLOCK_ROWS):
+        last = min(first + _BLOCK_ROWS, table.nrows)
+        blocks = _visibility_blocks(group, dusks, table.cols.ra[first:last],
+                                    table.cols.dec[first:last],
+                                    np.arange(first, last), ephemeris)
+        for field, block in blocks.iteritems():
+            arrays[field][first:last] = block
+
+
+def _update_rows(group, table, nrows):
+    """Recomputes the visibility of some rows of a catalog, whose number of
+    rows has not changed since the calendar was built."""
+    logging.debug("Updating visibility of %d rows of %s in %s", len(nrows),
+                  table.name, group._v_name)
+    node = group._f_getChild(table.name)
+    dusks = _dusks(group)
+    ephemeris = ephemerides.load(table)
+    nrows = np.unique(nrows)
+    for first in xrange(0, len(nrows), _BLOCK_ROWS):
+        block_nrows = nrows[first:first + _BLOCK_ROWS]
+        rows = table.readCoordinates(block_nrows)
+        blocks = _visibility_blocks(group, dusks, rows["ra"], rows["dec"],
+                                    block_nrows, ephemeris)
+        for field, block in blocks.iteritems():
+            array = node._f_getChild(field)
+            for n, values in zip(block_nrows, block):
+                array[n] = values
+    node._v_attrs.signature = catalog_signature(table)
+
+
+def _dusks(group):
+    """Returns the nights of a calendar with a dark time (indices), the local
+    sidereal time at their dusk and their length."""
+    attrs = group._v_attrs
+    nights = group.nights[:]
+    observer = ephem.Observer()
+    observer.lat = attrs.latitude
+    observer.lon = attrs.longitude
+    observer.elev = attrs.elevation
+    dark = np.nonzero(~np.isnan(nights[:, 0]))[0]
+    lst_dusk = np.empty(len(dark))
+    for i, n in enumerate(dark):
+        observer.date = nights[n, 0]
+        lst_dusk[i] = observer.sidereal_time()
+    night_length = nights[dark, 1] - nights[dark, 0]
+    return dark, lst_dusk, night_length
+
+
+def _visibility_blocks(group, dusks, ra, dec, nrows, ephemeris):
+    """Computes the visibility of some rows of a catalog in a calendar.
+
+    Parameters:
+    group: the group of the calendar
+    dusks: the nights with a dark time, see _dusks
+    ra, dec: the J2000 positions of the rows (radians)
+    nrows: the row numbers
+    ephemeris: the ephemerides.Ephemeris of the catalog, or None
+
+    Returns:
+    a dictionary field -> (rows x nights) array of 16 bits integers
+    """
+    attrs = group._v_attrs
+    nights = group.nights[:]
+    dark, lst_dusk, night_length = dusks
+
+    #positions are precessed once, at the middle of the year
+    mid_year = ephem.Date("%d/7/1" % attrs.year)
+    horizon = math.radians(attrs.horizon) - _REFRACTION
+    if ephemeris is None:
+        ra, dec = apparent_positions(ra, dec, mid_year)
+    else:
+        #moving bodies: their position in the middle of each night, NaN
+        #(never up) for the nights the ephemeris doesn't cover
+        middle = (nights[dark, 0] + nights[dark, 1]) / 2
+        ra, dec = ephemeris.positions(middle, nrows)
+        shape = ra.shape
+        ra, dec = apparent_positions(ra.ravel(), dec.ravel(), mid_year)
+        ra, dec = ra.reshape(shape), dec.reshape(shape)
+    start, end, peak = night_visibility(ra, dec, attrs.latitude, horizon,
+                                        lst_dusk, night_length)
+    ret = {}
+    for field, values, scale in (("start", start, _TIME_SCALE),
+                                 ("end", end, _TIME_SCALE),
+                                 ("peak_alt", peak, _ALT_SCALE)):
+        values = np.round(values * scale)
+        values[np.isnan(values)] = _MISSING
+        block = np.empty((len(nrows), len(nights)), np.int16)
+        block.fill(_MISSING)
+        block[:, dark] = values
+        ret[field] = block
+    return ret
+
+
+def update_calendars(master_db, changed_rows = None):
+    """Brings the stored calendars up to date with the catalogs and the
+    locations. Only the parts that changed are recomputed: a moved location
+    rebuilds its calendars (as do the calendars built by an older version), a new or modified catalog rebuilds its arrays and a
+    removed catalog or location drops them.
+
+    Parameters:
+    master_db: a catalogs.MasterDatabase instance
+    changed_rows: if given, a dictionary catalog name -> row numbers. Only
+                  these rows are recomputed for a modified catalog, unless
+                  its number of rows has changed.
+    """
+    if changed_rows is None:
+        changed_rows = {}
+    db = master_db.db
+    for group in list(db.root.visibility):
+        attrs = group._v_attrs
+        try:
+            observer = master_db.create_observer(attrs.location)
+        except ValueError:
+            logging.info("Location %s removed, dropping %s", attrs.location,
+                         group._v_name)
+            group._f_remove(recursive=True)
+            continue
+
+        if ((float(observer.lat), float(observer.lon),
+             float(observer.elev)) != (attrs.latitude, attrs.longitude,
+                                       attrs.elevation) or
+            getattr(attrs, "version", 1) < _VERSION):
+            build_calendar(master_db, attrs.location, attrs.year, attrs.horizon)
+            continue
+
+        for table in db.root.catalogs:
+            if table.name not in group:
+                _build_catalog(group, table)
+                continue
+            node = group._f_getChild(table.name)
+            if node._v_attrs.signature == catalog_signature(table):
+                continue
+            if (table.name in changed_rows and
+                node.start.shape[0] == table.nrows):
+                _update_rows(group, table, changed_rows[table.name])
+            else:
+                _build_catalog(group, table)
+        for name in group._v_groups.keys():
+            if name not in db.root.catalogs:
+                group._f_getChild(name)._f_remove(recursive=True)
+    db.flush()